@@ -0,0 +1,169 @@
+import warnings
+
+import numpy as np
+
+import chainer
+from chainer.utils.type_check import InvalidType
+
+from brancher.variables import DeterministicVariable, RandomVariable, ProbabilisticModel
+from brancher.standard_variables import NormalVariable
+from brancher.distributions import NormalDistribution
+
+
+def _sum_to_shape(array, shape):
+    axes = tuple(index for index, (dim, target_dim) in enumerate(zip(array.shape, shape))
+                 if dim != target_dim and target_dim == 1)
+    return np.sum(array, axis=axes, keepdims=True)
+
+
+def _align_dimensions(array, ndim):
+    if array.ndim > ndim and all([dim == 1 for dim in array.shape[ndim:]]):
+        return np.reshape(array, array.shape[:ndim])
+    return np.reshape(array, array.shape + (1,)*(ndim - array.ndim))
+
+
+def _get_normal_likelihood_terms(variable, likelihood_variable, shape, tolerance=1e-4):
+    """
+    Function. It probes the link of a normal likelihood at three values of the prior variable, stacked along the samples
+    axis, and returns the elementwise slope and intercept of its mean and its standard deviation. It returns None if the
+    mean is not an elementwise affine function of the prior variable or if the standard deviation depends on it.
+    """
+    random_state = np.random.RandomState(0) # The probes do not consume the global random state
+    probes = np.concatenate([np.zeros(shape), random_state.uniform(1., 2., size=(2,) + shape[1:])]).astype("float32")
+    parents_values = {parent: parent.value for parent in likelihood_variable.parents if parent is not variable}
+    parents_values.update({variable: chainer.Variable(probes)})
+    try:
+        parameters = likelihood_variable._apply_link(parents_values)
+    except (ValueError, InvalidType):
+        return None
+    mu, sigma = [_align_dimensions(parameters[key].data, len(shape)) for key in ("mu", "sigma")]
+    if mu.ndim != len(shape) or sigma.ndim != len(shape):
+        return None
+    mu, sigma = np.broadcast_arrays(mu, sigma)
+    slopes = [(mu[index:index + 1] - mu[:1])/probes[index:index + 1] for index in (1, 2)]
+    is_affine = np.allclose(slopes[0], slopes[1], atol=tolerance, rtol=tolerance)
+    is_homoscedastic = np.allclose(sigma, sigma[:1], atol=tolerance, rtol=tolerance)
+    if not (is_affine and is_homoscedastic):
+        return None
+    return slopes[0], mu[:1], sigma[:1]
+
+
+def normal_normal_conjugate_update(variable, likelihood_variables):
+    """
+    Function. It returns the posterior of a normal variable whose observed children are normal variables with known
+    standard deviation and a mean that is an elementwise affine function of it, y ~ N(h x + d, r).
+
+    Args:
+        variable: brancher.RandomVariable. The prior variable, with deterministic parents.
+
+        likelihood_variables: List(brancher.RandomVariable). The observed children of the prior variable.
+
+    Returns:
+        brancher.NormalVariable or None if the likelihood is not conjugate.
+    """
+    prior_parameters = variable._get_deterministic_parameters()
+    prior_mu, prior_sigma = np.broadcast_arrays(prior_parameters["mu"].data, prior_parameters["sigma"].data)
+    shape = prior_mu.shape
+    precision, weighted_mean = 1./prior_sigma**2, prior_mu/prior_sigma**2
+    for likelihood_variable in likelihood_variables:
+        likelihood_terms = _get_normal_likelihood_terms(variable, likelihood_variable, shape)
+        if likelihood_terms is None:
+            return None
+        slope, intercept, sigma = likelihood_terms
+        observations = _align_dimensions(likelihood_variable.value.data, len(shape))
+        if observations.ndim != len(shape):
+            return None
+        slope, intercept, sigma, observations = np.broadcast_arrays(slope, intercept, sigma, observations)
+        precision = precision + _sum_to_shape(slope**2/sigma**2, shape)
+        weighted_mean = weighted_mean + _sum_to_shape(slope*(observations - intercept)/sigma**2, shape)
+    mu, sigma = weighted_mean/precision, np.sqrt(1./precision)
+    return NormalVariable(mu[0, 0], sigma[0, 0], variable.name)
+
+
+CONJUGATE_UPDATES = {(NormalDistribution, NormalDistribution): normal_normal_conjugate_update}
+
+
+def register_conjugate_update(prior_distribution_type, likelihood_distribution_type, update):
+    """
+    Function. It registers the closed-form posterior update of a conjugate prior/likelihood pair.
+
+    Args:
+        prior_distribution_type: Type. The class of the distribution of the prior variable.
+
+        likelihood_distribution_type: Type. The class of the distribution of its observed children.
+
+        update: Function. It takes the prior variable and the list of its observed children and returns the posterior
+        variable, or None if the pair is not conjugate for the given links.
+
+    Returns:
+        None
+    """
+    CONJUGATE_UPDATES[(prior_distribution_type, likelihood_distribution_type)] = update
+
+
+def get_conjugate_posterior(variable, model):
+    """
+    Function. It returns the exact posterior of a latent variable whose parents are deterministic and whose children are
+    all observed and form a conjugate pair with it (see CONJUGATE_UPDATES). The posterior of such a variable does not
+    depend on the other latent variables of the model. The exact posterior is computed once at the current parameter
+    values, so variables whose prior or likelihood has learnable parameters are not conjugate.
+
+    Args:
+        variable: brancher.RandomVariable.
+
+        model: brancher.ProbabilisticModel.
+
+    Returns:
+        brancher.RandomVariable or None if the variable is not conjugate.
+    """
+    if not isinstance(variable, RandomVariable) or variable.is_observed:
+        return None
+    if any([type(parent) is not DeterministicVariable or parent.learnable for parent in variable.parents]):
+        return None
+    children = [var for var in model._flatten() if variable in var.parents]
+    if not children:
+        return None
+    for child in children:
+        if not (isinstance(child, RandomVariable) and child.is_observed and child.has_observed_value):
+            return None
+        if any([type(parent) is not DeterministicVariable or parent.learnable
+                for parent in child.parents if parent is not variable]):
+            return None
+    update_keys = {(type(variable.distribution), type(child.distribution)) for child in children}
+    if len(update_keys) != 1 or not update_keys.issubset(CONJUGATE_UPDATES):
+        return None
+    return CONJUGATE_UPDATES[update_keys.pop()](variable, children)
+
+
+def apply_conjugate_updates(joint_model, posterior_model=None):
+    """
+    Function. It replaces the variational factors of the conjugate latent variables of the joint model by their exact
+    posterior and sets the resulting posterior model. The exact factors are computed at the current values of the
+    deterministic parameters of the model.
+
+    Args:
+        joint_model: brancher.ProbabilisticModel.
+
+        posterior_model: brancher.ProbabilisticModel. The variational posterior of the remaining latent variables.
+
+    Returns:
+        List(brancher.Variable). The joint model variables that have an exact posterior.
+    """
+    posterior_variables = list(posterior_model.variables) if posterior_model is not None else []
+    conjugate_posteriors = {}
+    for variable in joint_model._flatten():
+        conjugate_posterior = get_conjugate_posterior(variable, joint_model)
+        if conjugate_posterior is None:
+            continue
+        replaced_variables = [var for var in posterior_variables if var.name == variable.name]
+        remaining_variables = [var for var in posterior_variables if var.name != variable.name]
+        if any([replaced in var._flatten() for var in remaining_variables for replaced in replaced_variables]):
+            warnings.warn("The posterior of {} is used by other variational factors and it is not replaced by its "
+                          "conjugate update".format(variable.name))
+            continue
+        posterior_variables = remaining_variables
+        conjugate_posteriors[variable] = conjugate_posterior
+    if conjugate_posteriors:
+        joint_model.set_posterior_model(ProbabilisticModel(posterior_variables +
+                                                           list(conjugate_posteriors.values())))
+    return list(conjugate_posteriors.keys())
@@ -6,16 +6,23 @@ Module description
 from abc import ABC, abstractmethod
 from collections.abc import Iterable
 import copy
+import threading
 
 import chainer
 import chainer.functions as F
 import numpy as np
-from scipy.special import binom
+from scipy.special import gammaln
 
 from brancher.utilities import broadcast_and_squeeze
 from brancher.utilities import sum_data_dimensions
 from brancher.utilities import get_diagonal
+from brancher.utilities import partial_broadcast
 from brancher.utilities import broadcast_parent_values
+from brancher.utilities import sample_categorical
+from brancher.utilities import sample_indices_without_replacement
+from brancher.utilities import format_minibatch
+from brancher.utilities import linear_recurrence
+from brancher.utilities import RejectionSampler
 
 # TODO: This module is messy with ad hoc solutions for every distribution. You need to make everything more standardized.
 
@@ -88,7 +95,7 @@ class EmpiricalDistribution(ImplicitDistribution):
         -------
         Without replacement
         """
-        if not indices:
+        if len(indices) == 0:
             if weights:
                 p = np.array(weights).astype("float64")
                 p = p/np.sum(p)
@@ -103,31 +110,192 @@ class EmpiricalDistribution(ImplicitDistribution):
                 dataset_size = len(dataset)
             if dataset_size < self.batch_size:
                 raise ValueError("It is impossible to have more samples than the size of the dataset without replacement")
-            if isinstance(dataset, Iterable): # TODO: This is for allowing discrete data, temporary?
-                indices = np.random.choice(range(dataset_size), size=self.batch_size, replace=False, p=p)
-            else:
-                indices = [np.random.choice(range(dataset_size), size=self.batch_size, replace=False, p=p)
-                           for _ in range(number_samples)]
+            if isinstance(dataset, (chainer.Variable, np.ndarray)):
+                indices = sample_indices_without_replacement(dataset_size, self.batch_size,
+                                                             number_samples=number_samples, p=p)
+            else: # TODO: This is for allowing discrete data, temporary?
+                indices = sample_indices_without_replacement(dataset_size, self.batch_size, p=p)[0]
 
         if isinstance(dataset, chainer.Variable):
-            if isinstance(indices, list) and isinstance(indices[0], np.ndarray):
-                if self.is_observed:
-                    sample = F.concat([F.expand_dims(dataset[n, k, :], axis=0) for n, k in enumerate(indices)], axis=0)
-                else:
-                    sample = F.concat([F.expand_dims(dataset[n, :, k, :], axis=0) for n, k in enumerate(indices)], axis=0)
-
-            elif isinstance(indices, list) and isinstance(indices[0], (int, np.int32, np.int64)):
-                if self.is_observed:
-                    sample = dataset[:, indices, :]
-                else:
-                    sample = dataset[:, :, indices, :]
+            indices = np.array(indices)
+            if self.is_observed:
+                data = dataset.data # Observed data does not require an autograd graph
+            else:
+                data = dataset[:, 0]
+            if indices.ndim == 2:
+                sample = data[np.arange(indices.shape[0])[:, None], indices]
+            elif indices.ndim == 1 and np.issubdtype(indices.dtype, np.integer):
+                sample = data[:, indices]
             else:
                 raise IndexError("The indices of an empirical variable should be either a list of integers or a list of arrays")
+            if self.is_observed:
+                sample = chainer.Variable(sample, requires_grad=False)
+            elif indices.ndim == 2:
+                sample = F.expand_dims(sample, axis=2)
+            else:
+                sample = F.expand_dims(sample, axis=1)
+        elif isinstance(dataset, np.ndarray): # Memory-mapped datasets: only the minibatch is loaded and cast
+            indices = np.array(indices)
+            if indices.ndim == 2:
+                sample = dataset[indices]
+            elif indices.ndim == 1 and np.issubdtype(indices.dtype, np.integer):
+                sample = np.repeat(np.expand_dims(dataset[indices], axis=0), number_samples, axis=0)
+            else:
+                raise IndexError("The indices of an empirical variable should be either a list of integers or a list of arrays")
+            sample = format_minibatch(sample, self.is_observed)
         else:
-            sample = list(np.array(dataset)[indices]) # TODO: This is for allowing discrete data, temporary? For julia
+            sample = [dataset[index] for index in indices] # TODO: This is for allowing discrete data, temporary? For julia
         return sample
 
 
+class ShuffledEpochsDistribution(ImplicitDistribution):
+    """
+    Summary. It returns contiguous minibatches of a random permutation of the dataset indices. A new permutation is
+    drawn at the beginning of every epoch, so that every index is returned once per epoch.
+
+    Parameters
+    ----------
+    batch_size : Int.
+
+    seed : Int. Seed of the random permutations. If None the permutations are not reproducible.
+    """
+    def __init__(self, batch_size, seed=None):
+        self.batch_size = batch_size
+        self.random_state = np.random.RandomState(seed)
+        self.epoch = 0
+        self._permutation = None
+        self._position = 0
+        self._lock = threading.Lock()
+
+    @property
+    def epoch_detail(self):
+        if self._permutation is None:
+            return float(self.epoch)
+        return self.epoch + self._position/float(len(self._permutation))
+
+    def get_sample(self, dataset, indices, number_samples, weights=None):
+        """
+        Method. It returns the indices of the next minibatch of the current epoch. When the epoch ends in the middle of
+        a minibatch, the minibatch is completed with the first indices of a new permutation. The indices that are
+        already in the minibatch are moved to the end of the new permutation, so a minibatch never contains duplicated
+        indices and every index is still returned once per epoch.
+
+        Parameters
+        ----------
+        dataset : Iterable. The dataset, only its length is used.
+
+        indices : Ignored.
+
+        number_samples : Ignored. The same minibatch is shared by all samples.
+
+        weights : Ignored.
+
+        Returns
+        -------
+        np.ndarray. Integer array of length batch_size.
+        """
+        dataset_size = len(dataset)
+        if dataset_size < self.batch_size:
+            raise ValueError("It is impossible to have more samples than the size of the dataset without replacement")
+        with self._lock:
+            batch_slices = []
+            number_missing_indices = self.batch_size
+            while number_missing_indices > 0:
+                if self._permutation is None:
+                    permutation = self.random_state.permutation(dataset_size)
+                    if batch_slices:
+                        is_used = np.isin(permutation, np.concatenate(batch_slices))
+                        permutation = np.concatenate([permutation[~is_used], permutation[is_used]])
+                    self._permutation = permutation
+                    self._position = 0
+                end_position = min(self._position + number_missing_indices, dataset_size)
+                batch_slices.append(self._permutation[self._position:end_position])
+                number_missing_indices -= end_position - self._position
+                self._position = end_position
+                if end_position == dataset_size:
+                    self.epoch += 1
+                    self._permutation = None
+        return np.concatenate(batch_slices)
+
+
+class StreamingDistribution(ImplicitDistribution):
+    """
+    Summary. It returns the chunks of data produced by an iterator, one chunk for every call. The leading axis of each
+    chunk indexes the datapoints and different chunks can have different sizes.
+
+    Parameters
+    ----------
+    data_stream : Iterable of np.ndarray.
+    """
+    def __init__(self, data_stream):
+        self.data_stream = iter(data_stream)
+        self._lock = threading.Lock()
+
+    def get_sample(self, number_samples):
+        """
+        One line description
+
+        Parameters
+        ----------
+        Returns
+        -------
+        """
+        with self._lock:
+            try:
+                chunk = next(self.data_stream)
+            except StopIteration:
+                raise ValueError("The data stream is exhausted")
+        sample = np.repeat(np.expand_dims(np.asarray(chunk), axis=0), number_samples, axis=0)
+        return format_minibatch(sample, self.is_observed)
+
+
+class TraceIndexDistribution(ImplicitDistribution):
+    """
+    Summary. It returns one random index of a trace of stored samples for every requested sample.
+
+    Parameters
+    ----------
+    trace_length : Int. The number of stored samples.
+    """
+    def __init__(self, trace_length):
+        self.trace_length = trace_length
+
+    def get_sample(self, number_samples):
+        """
+        One line description
+
+        Parameters
+        ----------
+        Returns
+        -------
+        """
+        return np.random.randint(0, self.trace_length, size=number_samples)
+
+
+class SampleTraceDistribution(ImplicitDistribution):
+    """
+    Summary. It returns the stored samples selected by an index (see TraceIndexDistribution). The variables that share
+    the same index are sampled jointly.
+
+    Parameters
+    ----------
+    trace : np.ndarray. The stored samples, with shape (trace_length, number_datapoints, ...).
+    """
+    def __init__(self, trace):
+        self.trace = trace
+
+    def get_sample(self, index, number_samples):
+        """
+        One line description
+
+        Parameters
+        ----------
+        Returns
+        -------
+        """
+        return chainer.Variable(self.trace[index])
+
+
 ## Unnormalized distributions ##
 class UnnormalizedDistribution(Distribution):
     pass
@@ -137,40 +305,23 @@ class TruncatedDistribution(UnnormalizedDistribution): #TODO: To be removed afte
     def __init__(self, base_distribution, truncation_rule):
         self.base_distribution = base_distribution
         self.truncation_rule = truncation_rule
-
-    def _reject_samples(self, samples, remaining_indices):
-        sample_list, sample_indices = zip(*[(F.expand_dims(s, axis=0), index)
-                                            for index, s in enumerate(samples) if self.truncation_rule(s.data)])
-        return sample_list, [remaining_indices[index] for index in sample_indices]
+        self.rejection_sampler = RejectionSampler(truncation_rule)
 
     def calculate_log_probability(self, x, **kwargs):
         return self.base_distribution.calculate_log_probability(x, **kwargs)
 
     def get_sample(self, number_samples, max_depth=20, **kwargs):
-        total_sampled_indices = set()
-        while not total_sampled_indices:
-            truncated_samples = {}
-            original_range = range(number_samples)
-            remaining_indices = range(number_samples)
-            original_input_parents = kwargs
-            iteration_index = 0
-            while total_sampled_indices != set(original_range) and iteration_index < max_depth:
-                input_parents = {parent: value[remaining_indices, :] if value.shape[0] == number_samples else value
-                                 for parent, value in original_input_parents.items()}
-                try:
-                    if iteration_index < max_depth:
-                        sample_list, sample_indices = self._reject_samples(self.base_distribution.get_sample(number_samples=number_samples,
-                                                                                                             **input_parents), remaining_indices)
-                        remaining_indices = [index for index in remaining_indices if index not in total_sampled_indices]
-                        truncated_samples.update({index: sample for index, sample in zip(sample_indices, sample_list)})
-                        total_sampled_indices.update(set(sample_indices))
-                        iteration_index += 1
-                    else:
-                        pass
-                except ValueError:
-                    iteration_index += 1
-                    pass
-        return F.concat([value for (key, value) in sorted(truncated_samples.items())], axis=0)
+        parameters_shapes = [value.shape[0] for value in kwargs.values()]
+        number_samples = max([number_samples] + parameters_shapes)
+
+        def get_candidates(sample_indices):
+            input_parents = {parent: value[sample_indices] if value.shape[0] == number_samples
+                             else F.broadcast_to(value, (len(sample_indices),) + value.shape[1:])
+                             for parent, value in kwargs.items()}
+            return self.base_distribution.get_sample(number_samples=len(sample_indices), **input_parents)
+
+        return self.rejection_sampler.get_sample(get_candidates, number_samples,
+                                                 get_decision_variable=lambda x: x.data, max_rounds=max_depth)
 
 
 ## Univariate distributions ##
@@ -211,6 +362,67 @@ class NormalDistribution(UnivariateDistribution):
         return sample
 
 
+class TruncatedNormalDistribution(UnivariateDistribution):
+    """
+    Summary. Normal distribution truncated to the interval (lower, upper). The samples are drawn exactly by inverse
+    CDF, x = mu + sigma*ndtri(ndtr(alpha) + u*(ndtr(beta) - ndtr(alpha))) with u uniform in (0, 1), so the sampling time
+    does not depend on the probability of the interval and the gradients flow through mu, sigma and the bounds. If
+    the interval is in the upper tail, the sample is computed from the mirrored interval in the lower tail, where the
+    normal CDF does not lose precision.
+    """
+    bound = 1e15  # Infinite bounds are replaced by finite values to keep the gradients finite
+    standardized_bound = 30.
+
+    def _get_standardized_bounds(self, mu, sigma, lower, upper):
+        lower = F.clip(lower, -self.bound, self.bound)
+        upper = F.clip(upper, -self.bound, self.bound)
+        return (lower - mu)/sigma, (upper - mu)/sigma
+
+    @staticmethod
+    def _mirror_to_lower_tail(alpha, beta):
+        is_mirrored = alpha.data > 0
+        return F.where(is_mirrored, -beta, alpha), F.where(is_mirrored, -alpha, beta), is_mirrored
+
+    def calculate_log_probability(self, x, mu, sigma, lower, upper):
+        """
+        One line description
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        """
+        x, mu, sigma, lower, upper = broadcast_and_squeeze(x, mu, sigma, lower, upper)
+        alpha, beta = self._get_standardized_bounds(mu, sigma, lower, upper)
+        alpha, beta, _ = self._mirror_to_lower_tail(alpha, beta)
+        log_normalization = F.log_ndtr(beta) + F.log1p(-F.exp(F.log_ndtr(alpha) - F.log_ndtr(beta)))
+        log_probability = -0.5*F.log(2*np.pi*sigma**2) - 0.5*(x - mu)**2/(sigma**2) - log_normalization
+        return sum_data_dimensions(log_probability)
+
+    def get_sample(self, mu, sigma, lower, upper, number_samples):
+        """
+        One line description
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        """
+        mu, sigma, lower, upper = broadcast_and_squeeze(mu, sigma, lower, upper)
+        alpha, beta = self._get_standardized_bounds(mu, sigma, lower, upper)
+        alpha, beta = [F.clip(F.cast(bound, "float64"), -self.standardized_bound, self.standardized_bound)
+                       for bound in (alpha, beta)]
+        alpha, beta, is_mirrored = self._mirror_to_lower_tail(alpha, beta)
+        lower_cdf, upper_cdf = F.ndtr(alpha), F.ndtr(beta)
+        uniform_sample = np.random.uniform(0., 1., size=mu.shape)
+        standard_sample = F.ndtri(lower_cdf + uniform_sample*(upper_cdf - lower_cdf))
+        standard_sample = F.cast(F.where(is_mirrored, -standard_sample, standard_sample), mu.dtype)
+        sample = F.minimum(F.maximum(mu + sigma*standard_sample, lower), upper)  # Guard against rounding errors
+        return sample
+
+
 class CauchyDistribution(UnivariateDistribution):
     """
     Summary
@@ -312,10 +524,45 @@ class LogitNormalDistribution(UnivariateDistribution):
         return F.sigmoid(logit_sample)
 
 
+def _get_binomial_log_coefficient(distribution, x, n, parameter):
+    """
+    Function. It broadcasts the values of a binomial variable with its number of trials and its probability parameter
+    and it returns them together with the logarithm of the binomial coefficient. Floating point samples (relaxed or
+    straight-through, see brancher.gradient_estimators) are kept differentiable and the coefficient is extended to real
+    values by the log gamma function. Otherwise the coefficient is computed with gammaln, which does not overflow for
+    large n, and it is cached on the distribution. It is only recomputed when the value of the variable (e.g. a new
+    observed dataset or minibatch), the number of trials or the shape of the samples change.
+
+    Args:
+        distribution: brancher.BinomialDistribution or brancher.LogitBinomialDistribution.
+
+        x, n, parameter: chainer.Variable.
+
+    Returns:
+        Tuple of x, n, parameter and the log binomial coefficient.
+    """
+    input_x, input_n = x, n.data
+    x, n, parameter = broadcast_and_squeeze(x, n, parameter)
+    if np.issubdtype(x.dtype, np.floating):
+        n = n.data.astype(x.dtype)
+        return x, n, parameter, F.lgamma(n + 1) - F.lgamma(x + 1) - F.lgamma(n - x + 1)
+    x, n = x.data, n.data
+    cache = distribution.log_coefficient_cache
+    if (cache is None or cache[0] is not input_x or cache[2].shape != x.shape
+            or not np.array_equal(cache[1], input_n)):
+        log_coefficient = (gammaln(n + 1) - gammaln(x + 1) - gammaln(n - x + 1)).astype(parameter.dtype)
+        cache = (input_x, input_n, log_coefficient)
+        distribution.log_coefficient_cache = cache
+    return x, n, parameter, cache[2]
+
+
 class BinomialDistribution(UnivariateDistribution):
     """
     Summary
     """
+    def __init__(self):
+        self.log_coefficient_cache = None
+
     def calculate_log_probability(self, x, n, p):
         """
         One line description
@@ -326,9 +573,8 @@ class BinomialDistribution(UnivariateDistribution):
         Returns
         -------
         """
-        x, n, p = broadcast_and_squeeze(x, n, p)
-        x, n = x.data, n.data
-        log_probability = np.log(binom(n, x)) + x*F.log(p) + (n-x)*F.log(1-p)
+        x, n, p, log_binomial_coefficient = _get_binomial_log_coefficient(self, x, n, p)
+        log_probability = log_binomial_coefficient + x*F.log(p) + (n-x)*F.log(1-p)
         return sum_data_dimensions(log_probability)
 
     def get_sample(self, n, p, number_samples):
@@ -350,6 +596,9 @@ class LogitBinomialDistribution(UnivariateDistribution):
     """
     Summary
     """
+    def __init__(self):
+        self.log_coefficient_cache = None
+
     def calculate_log_probability(self, x, n, z):
         """
         One line description
@@ -360,13 +609,12 @@ class LogitBinomialDistribution(UnivariateDistribution):
         Returns
         -------
         """
-        x, n, z = broadcast_and_squeeze(x, n, z)
-        x, n = x.data, n.data
+        x, n, z, log_binomial_coefficient = _get_binomial_log_coefficient(self, x, n, z)
         alpha = F.relu(-z).data
         beta = F.relu(z).data
         success_term = x*alpha - x*F.log(np.exp(alpha) + F.exp(alpha-z))
         failure_term = (n-x)*beta - (n-x)*F.log(np.exp(beta) + F.exp(beta+z))
-        log_probability = np.log(binom(n, x)) + success_term + failure_term
+        log_probability = log_binomial_coefficient + success_term + failure_term
         return sum_data_dimensions(log_probability)
 
     def get_sample(self, n, z, number_samples):
@@ -426,7 +674,15 @@ class CholeskyMultivariateNormal(MultivariateDistribution): #TODO: This needs to
 class CategoricalDistribution(MultivariateDistribution):
     """
     Summary
+
+    Parameters
+    ----------
+    one_hot : Bool. If true the samples are one-hot vectors along the category axis, otherwise they are category
+    indices stored in a category axis of size one.
     """
+    def __init__(self, one_hot=True):
+        self.one_hot = one_hot
+
     def calculate_log_probability(self, x, p):
         """
         One line description
@@ -437,8 +693,12 @@ class CategoricalDistribution(MultivariateDistribution):
         Returns
         -------
         """
+        if not self.one_hot:
+            categories = np.reshape(np.arange(p.shape[2]), (1, 1, p.shape[2]) + (1,)*(p.ndim - 3))
+            x = chainer.Variable((x.data == categories).astype("int32"))
         x, p = broadcast_and_squeeze(x, p)
-        x = x.data
+        if not np.issubdtype(x.dtype, np.floating): # Floating point samples are kept differentiable
+            x = x.data
         log_probability = F.sum(x*F.log(p), axis=2)
         return sum_data_dimensions(log_probability)
 
@@ -454,16 +714,25 @@ class CategoricalDistribution(MultivariateDistribution):
         """
         p_values = p.data
         p_shape = p_values.shape
-        sample = np.swapaxes(np.array([[np.random.multinomial(1, p_values[j, k, :])
-                                        for j in range(p_shape[0])]
-                                       for k in range(p_shape[1])]), axis1=0, axis2=1)
-        return chainer.Variable(sample.astype("int32"))
+        p_values = np.reshape(p_values, newshape=p_shape[:2] + tuple([np.prod(p_shape[2:])]))
+        if self.one_hot:
+            sample = np.reshape(sample_categorical(p_values), newshape=p_shape)
+        else:
+            sample = np.reshape(sample_categorical(p_values, one_hot=False), newshape=p_shape[:2] + (1,)*(len(p_shape) - 2))
+        return chainer.Variable(sample)
 
 
 class SoftmaxCategoricalDistribution(MultivariateDistribution): #TODO: Work in progress!!!
     """
         Summary
+
+        Parameters
+        ----------
+        one_hot : Bool. If true the samples are one-hot vectors along the category axis, otherwise they are category
+        indices (labels) stored in a category axis of size one.
         """
+    def __init__(self, one_hot=True):
+        self.one_hot = one_hot
 
     def calculate_log_probability(self, x, z):
         """
@@ -475,8 +744,15 @@ class SoftmaxCategoricalDistribution(MultivariateDistribution): #TODO: Work in p
         Returns
         -------
         """
+        is_one_hot = self.one_hot and x.ndim > 2 and x.shape[2] == z.shape[2] and z.shape[2] > 1
+        if is_one_hot and np.issubdtype(x.dtype, np.floating): # Floating point samples are kept differentiable
+            x, z = broadcast_and_squeeze(x, z)
+            log_probability = F.sum(x*F.log_softmax(z, axis=2), axis=2)
+            return sum_data_dimensions(log_probability)
+        if is_one_hot:
+            x = chainer.Variable(np.argmax(x.data, axis=2)[:, :, None])
         reshaped_dict, n_samples, n_datapoints = broadcast_parent_values({"x": x, "z": z})
-        labels = np.reshape(reshaped_dict["x"].data, newshape=(n_samples*n_datapoints, 1))
+        labels = np.reshape(np.rint(reshaped_dict["x"].data), newshape=(n_samples*n_datapoints, 1)).astype("int32")
         log_probability = -F.softmax_cross_entropy(reshaped_dict["z"], labels, reduce="no")
         log_probability = F.reshape(log_probability, shape=(n_samples, n_datapoints))
         return log_probability
@@ -496,11 +772,11 @@ class SoftmaxCategoricalDistribution(MultivariateDistribution): #TODO: Work in p
         p_values = F.softmax(z, axis=2).data
         p_shape = p_values.shape
         p_values = np.reshape(p_values.astype("float64"), newshape=p_shape[:2] + tuple([np.prod(p_shape[2:])])) #TODO: This should go in a more general class (Future refactoring)
-        sample = np.swapaxes(np.array([[np.random.multinomial(1, p_values[j, k, :]/np.sum(p_values[j, k, :]))
-                                        for j in range(p_shape[0])]
-                                       for k in range(p_shape[1])]), axis1=0, axis2=1)
-        sample = np.reshape(sample, newshape=p_shape)
-        return chainer.Variable(sample.astype("int32"))
+        if self.one_hot:
+            sample = np.reshape(sample_categorical(p_values), newshape=p_shape)
+        else:
+            sample = np.reshape(sample_categorical(p_values, one_hot=False), newshape=p_shape[:2] + (1,)*(len(p_shape) - 2))
+        return chainer.Variable(sample)
 
 
 class ConcreteDistribution(MultivariateDistribution):
@@ -539,6 +815,146 @@ class ConcreteDistribution(MultivariateDistribution):
         return F.softmax((F.log(p) + gumbel_sample)/tau, axis=2)
 
 
+# Stochastic processes #
+class AutoregressiveDistribution(Distribution):
+    """
+    Summary. Gaussian first order autoregressive process x_0 ~ N(initial_mu, initial_sigma) and
+    x_t ~ N(b x_{t-1} + drift, sigma). The whole trajectory is stored along the third axis of the samples, which have
+    shape (number_samples, number_datapoints, length, 1, 1). The parameters b, drift and sigma can be either scalars or
+    arrays with one value for each time step.
+
+    Parameters
+    ----------
+    length : Int. The number of time steps.
+    """
+    def __init__(self, length):
+        self.length = length
+
+    def _reshape_parameters(self, *parameters):
+        parameters = partial_broadcast(*parameters)
+        number_samples, number_datapoints = parameters[0].shape[:2]
+        return [F.reshape(p, shape=(number_samples, number_datapoints, -1)) for p in parameters]
+
+    def _get_step_parameter(self, parameter):
+        return parameter[:, :, 1:] if parameter.shape[2] == self.length else parameter
+
+    def calculate_log_probability(self, x, b, drift, sigma, initial_mu, initial_sigma):
+        """
+        One line description
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        """
+        x, b, drift, sigma, initial_mu, initial_sigma = self._reshape_parameters(x, b, drift, sigma,
+                                                                                 initial_mu, initial_sigma)
+        b, drift, sigma = [self._get_step_parameter(p) for p in (b, drift, sigma)]
+        residuals = x[:, :, 1:] - b*x[:, :, :-1] - drift
+        transition_log_probability = -0.5*F.log(2*np.pi*sigma**2) - 0.5*residuals**2/(sigma**2)
+        initial_log_probability = (-0.5*F.log(2*np.pi*initial_sigma**2) -
+                                   0.5*(x[:, :, :1] - initial_mu)**2/(initial_sigma**2))
+        return F.sum(initial_log_probability, axis=2) + F.sum(transition_log_probability, axis=2)
+
+    def get_sample(self, b, drift, sigma, initial_mu, initial_sigma, number_samples):
+        """
+        One line description
+
+        Parameters
+        ----------
+
+        Returns
+        -------
+        """
+        b, drift, sigma, initial_mu, initial_sigma = self._reshape_parameters(b, drift, sigma, initial_mu, initial_sigma)
+        number_samples, number_datapoints = b.shape[:2]
+        shape = (number_samples, number_datapoints, self.length)
+        noise = np.random.normal(0, 1, size=shape).astype("float32")
+        initial_innovation = F.broadcast_to(initial_mu + initial_sigma*noise[:, :, :1],
+                                            shape=(number_samples, number_datapoints, 1))
+        innovations = F.broadcast_to(self._get_step_parameter(drift) +
+                                     self._get_step_parameter(sigma)*noise[:, :, 1:],
+                                     shape=(number_samples, number_datapoints, self.length - 1))
+        batch_size = number_samples*number_datapoints
+        u = F.reshape(F.concat([initial_innovation, innovations], axis=2), shape=(batch_size, self.length))
+        sample = linear_recurrence(u, F.reshape(b, shape=(batch_size, -1)))
+        return F.reshape(sample, shape=shape + tuple([1, 1]))
+
+
+## Kullback-Leibler divergences ##
+def normal_kl_divergence(q_parameters, p_parameters):
+    """
+    Summary. KL divergence between two normal distributions. It is also the KL divergence between two log-normal
+    distributions with the same parameters since the divergence is invariant under the exponential map.
+    """
+    q_mu, q_sigma, p_mu, p_sigma = broadcast_and_squeeze(q_parameters["mu"], q_parameters["sigma"],
+                                                         p_parameters["mu"], p_parameters["sigma"])
+    kl_divergence = F.log(p_sigma) - F.log(q_sigma) + 0.5*(q_sigma**2 + (q_mu - p_mu)**2)/(p_sigma**2) - 0.5
+    return sum_data_dimensions(kl_divergence)
+
+
+def cholesky_normal_kl_divergence(q_parameters, p_parameters):
+    """
+    Summary. KL divergence between two multivariate normal distributions parameterized by the Cholesky factors of
+    their covariance matrices.
+    """
+    q_mu, p_mu = partial_broadcast(q_parameters["mu"], p_parameters["mu"])
+    q_chol, p_chol = partial_broadcast(q_parameters["chol_cov"], p_parameters["chol_cov"])
+    batch_shape, dim = q_chol.shape[:2], q_chol.shape[2]
+    inv_p_chol = F.batch_inv(F.reshape(p_chol, shape=(-1, dim, dim)))
+    whitened_chol = F.matmul(inv_p_chol, F.reshape(q_chol, shape=(-1, dim, dim)))
+    whitened_difference = F.matmul(inv_p_chol, F.reshape(p_mu - q_mu, shape=(-1, dim, 1)))
+    log_det_ratio = (F.sum(F.log(F.absolute(get_diagonal(p_chol))), axis=2) -
+                     F.sum(F.log(F.absolute(get_diagonal(q_chol))), axis=2))
+    quadratic_terms = F.reshape(F.sum(whitened_chol**2, axis=(1, 2)) + F.sum(whitened_difference**2, axis=(1, 2)),
+                                shape=batch_shape)
+    return 0.5*(quadratic_terms - dim) + log_det_ratio
+
+
+KL_DIVERGENCES = {(NormalDistribution, NormalDistribution): normal_kl_divergence,
+                  (LogNormalDistribution, LogNormalDistribution): normal_kl_divergence,
+                  (CholeskyMultivariateNormal, CholeskyMultivariateNormal): cholesky_normal_kl_divergence}
+
+
+def register_kl_divergence(q_distribution_type, p_distribution_type, kl_function):
+    """
+    Summary. It registers a function kl_function(q_parameters, p_parameters) that returns the KL divergence between
+    two distributions of the given types.
+    """
+    KL_DIVERGENCES[(q_distribution_type, p_distribution_type)] = kl_function
+
+
+def has_analytic_kl_divergence(q_distribution, p_distribution):
+    return (type(q_distribution), type(p_distribution)) in KL_DIVERGENCES
+
+
+def kl_divergence(q_distribution, p_distribution, q_parameters, p_parameters):
+    """
+    Summary. It returns the KL divergence KL(q||p) between two distributions given their parameters.
+
+    Parameters
+    ----------
+    q_distribution : brancher.Distribution
+
+    p_distribution : brancher.Distribution
+
+    q_parameters : Dictionary(String: chainer.Variable)
+
+    p_parameters : Dictionary(String: chainer.Variable)
+
+    Returns
+    -------
+    chainer.Variable
+    """
+    try:
+        kl_function = KL_DIVERGENCES[(type(q_distribution), type(p_distribution))]
+    except KeyError:
+        raise NotImplementedError("The KL divergence between {} and {} is not implemented".format(type(q_distribution).__name__,
+                                                                                                 type(p_distribution).__name__))
+    return kl_function(q_parameters, p_parameters)
+
+
 # StochasticProcesses #
 # class StochasticProcesses(MultivariateDistribution):
 #     pass
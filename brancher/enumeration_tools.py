@@ -0,0 +1,148 @@
+import numpy as np
+
+import chainer
+import chainer.functions as F
+
+import brancher.distributions as distributions
+from brancher.utilities import broadcast_sum
+
+
+def _get_categorical_support(distribution, parameters):
+    probabilities = parameters["p"] if "p" in parameters else parameters["z"]
+    category_shape = probabilities.shape[2:]
+    number_categories = int(np.prod(category_shape))
+    if distribution.one_hot:
+        return np.reshape(np.eye(number_categories, dtype="float32"), (number_categories, 1) + category_shape)
+    return np.reshape(np.arange(number_categories, dtype="float32"),
+                      (number_categories, 1) + (1,)*len(category_shape))
+
+
+def _get_binomial_support(distribution, parameters):
+    number_values = int(np.max(parameters["n"].data)) + 1
+    return np.reshape(np.arange(number_values, dtype="float32"), (number_values, 1, 1, 1))
+
+
+ENUMERABLE_SUPPORTS = {distributions.CategoricalDistribution: _get_categorical_support,
+                       distributions.SoftmaxCategoricalDistribution: _get_categorical_support,
+                       distributions.BinomialDistribution: _get_binomial_support,
+                       distributions.LogitBinomialDistribution: _get_binomial_support}
+
+
+def register_enumerable_support(distribution_type, get_support):
+    """
+    Function. It registers the finite support of a discrete distribution.
+
+    Args:
+        distribution_type: Type. The class of the discrete distribution.
+
+        get_support: Function. It takes the distribution and the dictionary of its parameters and returns an array
+        with the values of the support stacked along the first axis. Values outside the support of some of the
+        elements must have zero probability.
+
+    Returns:
+        None
+    """
+    ENUMERABLE_SUPPORTS[distribution_type] = get_support
+
+
+def get_support(variable, samples):
+    """
+    Function. It returns the support of a discrete variable, given the samples of its random parents.
+
+    Args:
+        variable: brancher.RandomVariable.
+
+        samples: Dictionary(brancher.Variable: chainer.Variable).
+
+    Returns:
+        np.ndarray or None if the distribution of the variable does not have a registered support.
+    """
+    if type(variable.distribution) not in ENUMERABLE_SUPPORTS:
+        return None
+    parents_values = {parent: samples[parent] if parent in samples else parent.value
+                      for parent in variable.parents}
+    parameters = variable._apply_link(parents_values)
+    return ENUMERABLE_SUPPORTS[type(variable.distribution)](variable.distribution, parameters)
+
+
+def get_enumerated_variables(latent_variables, samples, max_enumeration_size):
+    """
+    Function. It returns the discrete latent variables that have a registered support (see ENUMERABLE_SUPPORTS) and
+    their supports. Variables are added in topological order as long as the number of joint values of the enumerated
+    variables is at most max_enumeration_size. Variables whose parents are enumerated are never enumerated since their
+    support could depend on the value of the parents.
+
+    Args:
+        latent_variables: List(brancher.RandomVariable). Latent variables in topological order.
+
+        samples: Dictionary(brancher.Variable: chainer.Variable). Values of the random parents of the variables.
+
+        max_enumeration_size: Int.
+
+    Returns:
+        Dictionary(brancher.RandomVariable: np.ndarray).
+    """
+    supports = {}
+    enumeration_size = 1
+    for var in latent_variables:
+        if any([parent in supports for parent in var.parents]):
+            continue
+        support = get_support(var, samples)
+        if support is not None and enumeration_size*len(support) <= max_enumeration_size:
+            supports[var] = support
+            enumeration_size *= len(support)
+    return supports
+
+
+def get_enumerated_factors(random_variables, enumerated_variables):
+    """
+    Function. It returns the random variables whose log probability factor depends on the value of the enumerated
+    variables, i.e. the enumerated variables and their children.
+    """
+    return [var for var in random_variables
+            if var in enumerated_variables or any([parent in enumerated_variables for parent in var.parents])]
+
+
+def get_enumerated_log_probability(model, factors, supports, samples, number_samples, for_gradient=False):
+    """
+    Function. It returns the log probability factors of the enumerated variables and of their children, summed exactly
+    over all the joint values of the enumerated variables. The joint values are stacked along the samples axis, so that
+    every factor is evaluated for all of them with a single call, and they are summed with logsumexp.
+
+    Args:
+        model: brancher.ProbabilisticModel.
+
+        factors: List(brancher.RandomVariable). Variables of the model whose factor depends on the enumerated variables
+        (see get_enumerated_factors).
+
+        supports: Dictionary(brancher.RandomVariable: np.ndarray). Supports of the enumerated variables (see
+        get_enumerated_variables).
+
+        samples: Dictionary(brancher.Variable: chainer.Variable). Values of the other variables of the model.
+
+        number_samples: Int.
+
+    Returns:
+        chainer.Variable. The marginal log probability factors, with the samples along the first axis.
+    """
+    support_indices = np.meshgrid(*[np.arange(len(support)) for support in supports.values()], indexing="ij")
+    support_indices = [np.reshape(indices, (-1,)) for indices in support_indices]
+    enumeration_size = len(support_indices[0])
+
+    def stack(value, axis=0):
+        value_shape = value.shape[1:]
+        value = F.broadcast_to(F.expand_dims(value, axis=axis), (enumeration_size, number_samples) + value_shape)
+        return F.reshape(value, (enumeration_size*number_samples,) + value_shape)
+
+    enumerated_samples = {var: stack(value) if isinstance(value, chainer.Variable) and value.shape[0] == number_samples
+                          else value
+                          for var, value in samples.items() if var not in supports}
+    enumerated_samples.update({var: stack(chainer.Variable(support[indices]), axis=1)
+                               for (var, support), indices in zip(supports.items(), support_indices)})
+    log_probability_terms = model.calculate_log_probability_terms(enumerated_samples, for_gradient=for_gradient,
+                                                                  excluded_variables=[var for var in model._flatten()
+                                                                                      if var not in factors])
+    log_probability = broadcast_sum(list(log_probability_terms.values()))
+    log_probability = F.broadcast_to(log_probability, (enumeration_size*number_samples,) + log_probability.shape[1:])
+    log_probability = F.reshape(log_probability, (enumeration_size, number_samples) + log_probability.shape[1:])
+    return F.logsumexp(log_probability, axis=0)
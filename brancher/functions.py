@@ -4,13 +4,15 @@ import chainer
 import chainer.functions as F
 
 from brancher.variables import var2link
-from brancher.variables import Variable, PartialLink
+from brancher.variables import Variable, PartialLink, NormalWeights
+from brancher.variables import join_matmul_weights
 
 
 class BrancherFunction(object):
 
-    def __init__(self, fn):
+    def __init__(self, fn, weights_argument=False):
         self.fn = fn
+        self.weights_argument = weights_argument
         if isinstance(fn, (chainer.Link, chainer.Chain, chainer.ChainList)):
             self.links = {fn}
         else:
@@ -21,6 +23,9 @@ class BrancherFunction(object):
         link_kwargs = {name: var2link(arg) for name, arg in kwargs.items()}
         arg_vars = {var for link in link_args if isinstance(link, PartialLink) for var in link.vars}
         kwarg_vars = {var for _, link in link_kwargs.items() if isinstance(link, PartialLink) for var in link.vars}
+        if self.weights_argument and args and isinstance(args[0], Variable):
+            link_args[0].matmul_weights = {args[0]}
+        matmul_weights = join_matmul_weights(link_args + list(link_kwargs.values()))
 
         def fn(values):
             args = [x.fn(values) if isinstance(x, PartialLink) else x for x in link_args]
@@ -28,7 +33,7 @@ class BrancherFunction(object):
                            for name, x in link_kwargs.items()})
             return self.fn(*args, **kwargs)
 
-        return PartialLink(arg_vars.union(kwarg_vars), fn, self.links)
+        return PartialLink(arg_vars.union(kwarg_vars), fn, self.links, matmul_weights=matmul_weights)
 
     @staticmethod
     def _is_var(self, arg):
@@ -38,3 +43,14 @@ class BrancherFunction(object):
 is_chainer_fn = lambda k, v: type(v) is types.FunctionType and not k.startswith('_') #TODO: Work in progress
 brancher_fns = {name: BrancherFunction(v) for name, v in F.__dict__.items() if is_chainer_fn(name, v)}
 globals().update(brancher_fns)
+
+
+def _matmul(a, b, **kwargs):
+    if isinstance(a, NormalWeights):
+        if kwargs:
+            raise NotImplementedError("The local reparameterization does not support the optional arguments of matmul")
+        return a.matmul(b)
+    return F.matmul(a, b, **kwargs)
+
+
+matmul = BrancherFunction(_matmul, weights_argument=True)
@@ -0,0 +1,192 @@
+"""
+Gradient estimators
+---------
+Module description
+"""
+import copy
+
+import numpy as np
+import chainer
+import chainer.functions as F
+
+import brancher.distributions as distributions
+from brancher.utilities import broadcast_and_squeeze
+
+
+def _relax_categorical(distribution, logits, temperature):
+    if not distribution.one_hot:
+        raise ValueError("The relaxation of categorical variables requires one-hot samples")
+    shape = logits.shape
+    number_categories = int(np.prod(shape[2:]))
+    logits = F.reshape(logits, shape[:2] + (number_categories,))
+    perturbed_logits = logits + np.random.gumbel(0., 1., size=logits.shape).astype(logits.dtype)
+    soft_sample = F.softmax(perturbed_logits/temperature, axis=2)
+    hard_sample = np.argmax(perturbed_logits.data, axis=2)[:, :, None] == np.arange(number_categories)
+    return F.reshape(soft_sample, shape), np.reshape(hard_sample.astype(logits.dtype), shape)
+
+
+def _relax_binomial(n, logits, temperature):
+    n, logits = broadcast_and_squeeze(n, logits)
+    number_trials = n.data.astype("int32")
+    trials_shape = (int(np.max(number_trials)),) + (1,)*logits.ndim
+    is_trial = (np.reshape(np.arange(trials_shape[0]), trials_shape) < number_trials).astype(logits.dtype)
+    logistic_sample = np.random.logistic(0., 1., size=trials_shape[:1] + logits.shape).astype(logits.dtype)
+    perturbed_logits = F.broadcast_to(logits, logistic_sample.shape) + logistic_sample
+    soft_sample = F.sum(is_trial*F.sigmoid(perturbed_logits/temperature), axis=0)
+    hard_sample = np.sum(is_trial*(perturbed_logits.data > 0), axis=0).astype(logits.dtype)
+    return soft_sample, hard_sample
+
+
+def _relax_probabilities_categorical(distribution, parameters, temperature):
+    return _relax_categorical(distribution, F.log(parameters["p"]), temperature)
+
+
+def _relax_softmax_categorical(distribution, parameters, temperature):
+    return _relax_categorical(distribution, parameters["z"], temperature)
+
+
+def _relax_probabilities_binomial(distribution, parameters, temperature):
+    p = parameters["p"]
+    return _relax_binomial(parameters["n"], F.log(p) - F.log(1 - p), temperature)
+
+
+def _relax_logit_binomial(distribution, parameters, temperature):
+    return _relax_binomial(parameters["n"], parameters["z"], temperature)
+
+
+RELAXED_SAMPLES = {distributions.CategoricalDistribution: _relax_probabilities_categorical,
+                   distributions.SoftmaxCategoricalDistribution: _relax_softmax_categorical,
+                   distributions.BinomialDistribution: _relax_probabilities_binomial,
+                   distributions.LogitBinomialDistribution: _relax_logit_binomial}
+
+
+def register_relaxed_sample(distribution_type, relaxed_sample):
+    """
+    Function. It registers the continuous relaxation of a discrete distribution.
+
+    Args:
+        distribution_type: Type. The class of the discrete distribution.
+
+        relaxed_sample: Function. It takes the distribution, the dictionary of its parameters and the temperature and
+        returns a relaxed sample (chainer.Variable) and the discrete sample obtained from the same noise (np.ndarray).
+
+    Returns:
+        None
+    """
+    RELAXED_SAMPLES[distribution_type] = relaxed_sample
+
+
+class GradientEstimator(object):
+    """
+    Summary. Estimator of the gradient of the ELBO with respect to the parameters of a posterior variable. The default
+    estimator samples from the distribution of the variable, which is only differentiable for reparameterizable
+    distributions. Estimators are assigned to the discrete variables of the posterior model by
+    stochastic_variational_inference.
+    """
+    def get_sample(self, distribution, parameters, number_samples):
+        return distribution.get_sample(**parameters, number_samples=number_samples)
+
+    def get_surrogate_term(self, variable, elbo_samples, samples):
+        """
+        Method. It returns a term with value zero that is added to the ELBO estimate for correcting its gradient.
+
+        Args:
+            variable: brancher.RandomVariable. The posterior variable.
+
+            elbo_samples: chainer.Variable. Single sample estimates of the ELBO, with the samples along the first axis.
+
+            samples: Dictionary(brancher.Variable: chainer.Variable). The samples of the posterior model.
+
+        Returns:
+            chainer.Variable or Float.
+        """
+        return 0.
+
+    def cleargrads(self):
+        pass
+
+    def update(self):
+        pass
+
+
+class GumbelSoftmaxEstimator(GradientEstimator):
+    """
+    Summary. Reparameterization of categorical and binomial variables through their Gumbel-softmax (concrete)
+    relaxation (see RELAXED_SAMPLES). With straight_through, the value of the sample is the discrete sample and its
+    gradient is the gradient of the relaxed sample. Otherwise, the relaxed sample itself is used in the ELBO.
+
+    Parameters
+    ----------
+    temperature : Float. Temperature of the relaxation, lower values are closer to the discrete distribution and give
+    higher variance gradients.
+
+    straight_through : Bool.
+    """
+    def __init__(self, temperature=0.5, straight_through=True):
+        self.temperature = temperature
+        self.straight_through = straight_through
+
+    def get_sample(self, distribution, parameters, number_samples):
+        if type(distribution) not in RELAXED_SAMPLES:
+            raise ValueError("The distribution {} does not have a registered "
+                             "relaxation".format(type(distribution).__name__))
+        relaxed_sample, discrete_sample = RELAXED_SAMPLES[type(distribution)](distribution, parameters,
+                                                                            self.temperature)
+        if self.straight_through:
+            return relaxed_sample - relaxed_sample.data + discrete_sample
+        return relaxed_sample
+
+
+class ScoreFunctionEstimator(GradientEstimator):
+    """
+    Summary. Score function (REINFORCE) estimator. The samples of the variable are not differentiable and the gradient
+    of the ELBO with respect to the parameters of the variable is estimated as the average of
+    (elbo - baseline)*grad log q(x). The baseline is a control variate that is learned by minimizing the mean squared
+    difference with the single sample ELBO estimates.
+
+    Parameters
+    ----------
+    baseline : Bool. If false, no control variate is used.
+
+    baseline_optimizer : chainer.Optimizer. Optimizer of the baseline. With SGD the baseline is an exponential moving
+    average of the ELBO estimates.
+    """
+    def __init__(self, baseline=True, baseline_optimizer=chainer.optimizers.SGD(0.1)):
+        self.baseline_link = None
+        if baseline:
+            self.baseline_link = chainer.Link()
+            with self.baseline_link.init_scope():
+                self.baseline_link.baseline = chainer.Parameter(np.zeros((1,), dtype="float32"))
+            self.baseline_optimizer = copy.deepcopy(baseline_optimizer)
+            self.baseline_optimizer.setup(self.baseline_link)
+        self.is_initialized = False
+
+    def get_sample(self, distribution, parameters, number_samples):
+        sample = distribution.get_sample(**parameters, number_samples=number_samples)
+        if np.issubdtype(sample.dtype, np.integer):  # The samples can be used as inputs of continuous variables
+            return chainer.Variable(sample.data.astype("float32"))
+        return sample
+
+    def get_surrogate_term(self, variable, elbo_samples, samples):
+        number_samples = elbo_samples.shape[0]
+        elbo_samples = F.sum(F.reshape(elbo_samples, (number_samples, -1)), axis=1).data
+        log_probability = variable.calculate_log_probability(samples, for_gradient=True, include_parents=False)
+        log_probability = F.sum(F.reshape(log_probability, (number_samples, -1)), axis=1)
+        if self.baseline_link is None:
+            surrogate_term = F.mean(elbo_samples*log_probability)
+            return surrogate_term - surrogate_term.data
+        baseline = self.baseline_link.baseline
+        if not self.is_initialized:
+            baseline.array[:] = np.mean(elbo_samples)
+            self.is_initialized = True
+        surrogate_term = F.mean((elbo_samples - baseline.array)*log_probability)
+        baseline_loss = F.mean((elbo_samples - F.broadcast_to(baseline, elbo_samples.shape))**2)
+        return surrogate_term - surrogate_term.data - (baseline_loss - baseline_loss.data)
+
+    def cleargrads(self):
+        if self.baseline_link is not None:
+            self.baseline_link.cleargrads()
+
+    def update(self):
+        if self.baseline_link is not None:
+            self.baseline_optimizer.update()
@@ -3,6 +3,7 @@ Inference
 ---------
 Module description
 """
+import copy
 import warnings
 from abc import ABC, abstractmethod
 from collections.abc import Iterable
@@ -13,12 +14,20 @@ import numpy as np
 from tqdm import tqdm
 
 from brancher.optimizers import ProbabilisticOptimizer
-from brancher.variables import DeterministicVariable, Variable, ProbabilisticModel
+import brancher.distributions as distributions
+import brancher.geometric_ranges as geometric_ranges
+from brancher.variables import DeterministicVariable, Variable, RandomVariable, ProbabilisticModel, PartialLink
+from brancher.standard_variables import NormalVariable, AutoregressiveVariable, TraceIndex, SampleTraceVariable
 from brancher.transformations import truncate_model
+from brancher.kalman_filter_tools import extract_linear_gaussian_chain, kalman_filter, kalman_smoother
+from brancher.conjugacy_tools import apply_conjugate_updates
 
+from brancher.utilities import broadcast_sum
 from brancher.utilities import reassign_samples
+from brancher.utilities import get_model_mapping
 from brancher.utilities import zip_dict
 from brancher.utilities import sum_from_dim
+from brancher.utilities import vectorized_truncation_rule
 
 
 # def maximal_likelihood(random_variable, number_iterations, optimizer=chainer.optimizers.SGD(0.001)):
@@ -48,16 +57,36 @@ def stochastic_variational_inference(joint_model, number_iterations, number_samp
                                      optimizer=chainer.optimizers.Adam(0.001),
                                      input_values={}, inference_method=None,
                                      posterior_model=None, sampler_model=None,
-                                     pretraining_iterations=0): #TODO: input values
+                                     pretraining_iterations=0, prefetch_minibatches=0,
+                                     conjugate_updates=False, gradient_estimators={}): #TODO: input values
     """
     Summary
 
     Parameters
     ---------
+    prefetch_minibatches : Int. If larger than zero, the minibatches of the observed variables are sampled in a
+    background thread and up to prefetch_minibatches of them are kept ready for the next iterations.
+
+    conjugate_updates : Bool. If true, the variational factors of the conjugate latent variables are replaced by their
+    exact posterior (see brancher.conjugacy_tools) and only the remaining variables are optimized. If all the latent
+    variables are conjugate, no iteration is run.
+
+    gradient_estimators : Dict(str or brancher.RandomVariable: brancher.GradientEstimator). Gradient estimators of the
+    discrete variables of the posterior model, given by name or as posterior variables (see
+    brancher.gradient_estimators). They are only used during the optimization.
     """
     if not inference_method:
         warnings.warn("The inference method was not specified, using the default reverse KL variational inference")
         inference_method = ReverseKL()
+    if conjugate_updates:
+        conjugate_variables = apply_conjugate_updates(joint_model, posterior_model or joint_model.posterior_model)
+        joint_model.diagnostics.update({"conjugate variables": [var.name for var in conjugate_variables]})
+        if conjugate_variables:
+            posterior_model = joint_model.posterior_model
+        latent_variables = [var for var in joint_model._flatten()
+                            if isinstance(var, RandomVariable) and not var.is_observed]
+        if set(latent_variables).issubset(conjugate_variables):
+            number_iterations = 0
     if not posterior_model:
         posterior_model = joint_model.posterior_model
     if not sampler_model: #TODO: clean up
@@ -82,21 +111,80 @@ def stochastic_variational_inference(joint_model, number_iterations, number_samp
 
     inference_method.check_model_compatibility(joint_model, posterior_model, sampler_model)
 
+    estimated_variables = {posterior_model.get_variable(var) if isinstance(var, str) else var: estimator
+                           for var, estimator in gradient_estimators.items()}
+    for var, estimator in estimated_variables.items():
+        var.gradient_estimator = estimator
+
+    if prefetch_minibatches:
+        joint_model.start_prefetching(queue_size=prefetch_minibatches)
+    try:
+        for iteration in tqdm(range(number_iterations)):
+            loss = inference_method.compute_loss(joint_model, posterior_model, sampler_model, number_samples)
+
+            if np.isfinite(loss.data).all():
+                [opt.chain.cleargrads() for opt in optimizers_list]
+                [estimator.cleargrads() for estimator in estimated_variables.values()]
+                loss.backward()
+                optimizers_list[0].update()
+                [estimator.update() for estimator in estimated_variables.values()]
+                if iteration > pretraining_iterations:
+                    [opt.update() for opt in optimizers_list[1:]]
+            else:
+                warnings.warn("Numerical error, skipping sample")
+            loss_list.append(loss.data)
+    finally:
+        joint_model.stop_prefetching()
+        for var in estimated_variables:
+            var.gradient_estimator = None
+    joint_model.diagnostics.update({"loss curve": np.array(loss_list)})
+
+    inference_method.post_process(joint_model) #TODO: this could be implemented with a with block
+
+
+def markov_chain_monte_carlo(joint_model, number_iterations, number_chains, inference_method=None, input_values={}):
+    """
+    Summary. It runs number_iterations transitions of a set of Markov chains that are simulated in parallel along the
+    samples axis and sets the visited states as the posterior model of the joint model.
+
+    Parameters
+    ---------
+    number_chains : Int. Number of parallel chains.
+
+    inference_method : brancher.InferenceMethod. Markov chain Monte Carlo method, HamiltonianMonteCarlo by default.
+    """
+    if not inference_method:
+        inference_method = HamiltonianMonteCarlo()
+    _run_sample_based_inference(joint_model, number_iterations, number_chains, inference_method, input_values)
+
+
+def particle_inference(joint_model, number_iterations, number_particles, inference_method=None, input_values={}):
+    """
+    Summary. It runs number_iterations updates of a set of particles stored along the samples axis and sets the final
+    particles as the posterior model of the joint model.
+
+    Parameters
+    ---------
+    number_particles : Int.
+
+    inference_method : brancher.InferenceMethod. Particle method, SteinVariationalGradientDescent by default.
+    """
+    if not inference_method:
+        inference_method = SteinVariationalGradientDescent()
+    _run_sample_based_inference(joint_model, number_iterations, number_particles, inference_method, input_values)
+
+
+def _run_sample_based_inference(joint_model, number_iterations, number_samples, inference_method, input_values):
+    joint_model.update_observed_submodel()
+    inference_method.check_model_compatibility(joint_model, None, None)
+
+    loss_list = []
     for iteration in tqdm(range(number_iterations)):
-        loss = inference_method.compute_loss(joint_model, posterior_model, sampler_model, number_samples)
-
-        if np.isfinite(loss.data).all():
-            [opt.chain.cleargrads() for opt in optimizers_list]
-            loss.backward()
-            optimizers_list[0].update()
-            if iteration > pretraining_iterations:
-                [opt.update() for opt in optimizers_list[1:]]
-        else:
-            warnings.warn("Numerical error, skipping sample")
+        loss = inference_method.compute_loss(joint_model, None, None, number_samples, input_values)
         loss_list.append(loss.data)
     joint_model.diagnostics.update({"loss curve": np.array(loss_list)})
 
-    inference_method.post_process(joint_model) #TODO: this could be implemented with a with block
+    inference_method.post_process(joint_model)
 
 
 class InferenceMethod(ABC):
@@ -120,23 +208,411 @@ class InferenceMethod(ABC):
 
 
 class ReverseKL(InferenceMethod):
+    """
+    Summary
+
+    Parameters
+    ---------
+    analytic_kl : Bool. If true, the KL divergence between posterior and prior variables is computed in closed form
+    whenever it is available (see brancher.distributions.KL_DIVERGENCES) and only the remaining terms of the ELBO are
+    estimated by sampling. It is off by default.
+
+    local_reparameterization : Bool. If true, the outputs of BF.matmul are sampled directly instead of the normal weights
+    that feed them (see brancher.variables.NormalWeights).
 
-    def __init__(self):
+    enumerate_discrete : Bool. If true, the discrete latent variables with a finite support are summed out exactly in
+    the ELBO instead of being sampled (see brancher.enumeration_tools). Enumerated variables do not need a posterior.
+
+    max_enumeration_size : Int. Maximum number of joint values of the enumerated variables. The remaining discrete
+    variables are sampled from the posterior model.
+    """
+    def __init__(self, analytic_kl=False, local_reparameterization=False, enumerate_discrete=False,
+                 max_enumeration_size=64):
         self.learnable_model = True
         self.needs_sampler = False
         self.learnable_sampler = False
+        self.analytic_kl = analytic_kl
+        self.local_reparameterization = local_reparameterization
+        self.enumerate_discrete = enumerate_discrete
+        self.max_enumeration_size = max_enumeration_size
 
     def check_model_compatibility(self, joint_model, posterior_model, sampler_model):
         pass #TODO: Check differentiability of the model
 
     def compute_loss(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
         loss = -joint_model.estimate_log_model_evidence(number_samples=number_samples,
-                                                        method="ELBO", input_values=input_values, for_gradient=True)
+                                                        method="ELBO", input_values=input_values, for_gradient=True,
+                                                        analytic_kl=self.analytic_kl,
+                                                        local_reparameterization=self.local_reparameterization,
+                                                        enumerate_discrete=self.enumerate_discrete,
+                                                        max_enumeration_size=self.max_enumeration_size)
         return loss
 
     def post_process(self, joint_model):
         pass
 
+
+class KalmanSmoother(InferenceMethod):
+    """
+    Summary. Exact inference for scalar linear-Gaussian chains (see brancher.kalman_filter_tools). The latent chain is
+    integrated out by a Kalman filter and its exact posterior is computed by a Rauch-Tung-Striebel smoother. When the
+    chain depends on latent variables that are not part of it (e.g. a transition coefficient b), these variables need a
+    variational posterior and they are trained by stochastic_variational_inference on the ELBO of the collapsed model
+    log p(y|b) + log p(b) - log q(b). If all the coefficients are known, the exact posterior can be computed directly
+    with KalmanSmoother().compute_posterior(joint_model).
+
+    Parameters
+    ----------
+    number_post_samples : Int. Number of posterior samples of the variables outside the chain used to estimate their
+    posterior mean. The posterior of the chain is computed conditional on that mean.
+    """
+    def __init__(self, number_post_samples=1000):
+        self.learnable_model = True
+        self.needs_sampler = False
+        self.learnable_sampler = False
+        self.number_post_samples = number_post_samples
+
+    @staticmethod
+    def _get_global_values(joint_model, posterior_model, q_samples):
+        joint_samples = posterior_model.posterior_sample2joint_sample(q_samples)
+        return {var: value for var, value in joint_samples.items()
+                if isinstance(var, RandomVariable) and not var.is_observed}
+
+    def check_model_compatibility(self, joint_model, posterior_model, sampler_model):
+        if posterior_model is None:
+            extract_linear_gaussian_chain(joint_model)
+        else:
+            global_values = self._get_global_values(joint_model, posterior_model, posterior_model._get_sample(1))
+            extract_linear_gaussian_chain(joint_model, global_values)
+
+    def compute_loss(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
+        q_samples = posterior_model._get_sample(number_samples, input_values=input_values)
+        global_values = self._get_global_values(joint_model, posterior_model, q_samples)
+        chain = extract_linear_gaussian_chain(joint_model, global_values)
+        log_likelihood = kalman_filter(chain)[-1]
+        global_prior = [var.calculate_log_probability(global_values, include_parents=False)
+                        for var in global_values]
+        log_likelihood = F.reshape(log_likelihood, (number_samples, 1))
+        elbo = broadcast_sum([log_likelihood] + global_prior) - posterior_model.calculate_log_probability(q_samples)
+        return -F.mean(elbo)
+
+    def compute_posterior(self, joint_model, global_values={}):
+        """
+        Method. It computes the exact posterior of the chain given the values of the variables outside the chain and
+        returns it as a probabilistic model. The log marginal likelihood of the observations is stored in the
+        diagnostics of the joint model.
+
+        Args:
+            joint_model: brancher.ProbabilisticModel.
+
+            global_values: Dictionary(brancher.Variable: chainer.Variable). A single value for each latent variable
+            outside the chain.
+
+        Returns:
+            brancher.ProbabilisticModel.
+        """
+        chain = extract_linear_gaussian_chain(joint_model, global_values).get_data()
+        b, drift, sigma, log_likelihood = kalman_smoother(chain)
+        b, drift, sigma = b[0], drift[0], sigma[0]
+        if chain.is_autoregressive:
+            variable = chain.latent_variables[0]
+            posterior_variables = [AutoregressiveVariable(b=b, drift=drift, sigma=sigma, plate=variable.plate,
+                                                          name=variable.name, initial_mu=float(drift[0]),
+                                                          initial_sigma=float(sigma[0]))]
+        else:
+            posterior_variables = []
+            for t, variable in enumerate(chain.latent_variables):
+                if t == 0:
+                    mu = float(drift[t])
+                else:
+                    mu = float(b[t])*posterior_variables[-1] + float(drift[t])
+                posterior_variables.append(NormalVariable(mu, float(sigma[t]), variable.name))
+        joint_model.diagnostics.update({"log marginal likelihood": float(log_likelihood[0])})
+        if global_values:
+            chain_names = [var.name for var in chain.latent_variables]
+            global_variables = [var for var in joint_model.posterior_model.variables if var.name not in chain_names]
+            return ProbabilisticModel(global_variables + posterior_variables)
+        joint_model.set_posterior_model(ProbabilisticModel(posterior_variables))
+        return joint_model.posterior_model
+
+    def post_process(self, joint_model):
+        posterior_model = joint_model.posterior_model
+        q_samples = posterior_model._get_sample(self.number_post_samples)
+        global_values = {var: F.mean(value, axis=0, keepdims=True)
+                         for var, value in self._get_global_values(joint_model, posterior_model, q_samples).items()}
+        joint_model.set_posterior_model(self.compute_posterior(joint_model, global_values))
+
+
+SUPPORT_RANGES = {distributions.NormalDistribution: geometric_ranges.UnboundedRange(),
+                  distributions.CauchyDistribution: geometric_ranges.UnboundedRange(),
+                  distributions.LogNormalDistribution: geometric_ranges.RightHalfLine(0.),
+                  distributions.LogitNormalDistribution: geometric_ranges.Interval(0., 1.),
+                  distributions.AutoregressiveDistribution: geometric_ranges.UnboundedRange()}
+
+
+def get_latent_variables(joint_model):
+    return [var for var in joint_model._flatten() if isinstance(var, RandomVariable) and not var.is_observed]
+
+
+def check_support_ranges(joint_model, method_name):
+    unsupported_variables = [var.name for var in get_latent_variables(joint_model)
+                             if type(var.distribution) not in SUPPORT_RANGES]
+    if unsupported_variables:
+        raise ValueError("{} requires continuous latent variables with a known support, the variables {} are not "
+                         "supported".format(method_name, unsupported_variables))
+
+
+def initialize_unconstrained_states(joint_model, number_samples, input_values={}):
+    """
+    Function. It returns number_samples initial states of the latent variables of the model in their unconstrained
+    space (see SUPPORT_RANGES). As in Stan, the states are drawn uniformly in (-2, 2).
+    """
+    initial_sample = joint_model._get_sample(number_samples, input_values=input_values)
+    return {var: np.random.uniform(-2., 2., size=initial_sample[var].shape)
+            for var in get_latent_variables(joint_model)}
+
+
+def _apply_support_transform(var, x):
+    y = SUPPORT_RANGES[type(var.distribution)].forward_transform(x, None)
+    return y.fn({}) if isinstance(y, PartialLink) else y
+
+
+def get_unconstrained_log_probability(joint_model, states, input_values={}):
+    """
+    Function. It returns the log probability of a batch of unconstrained states of the latent variables, stored along
+    the samples axis, and its gradient. The log probability includes the log Jacobian of the transformations in
+    SUPPORT_RANGES.
+
+    Args:
+        joint_model: brancher.ProbabilisticModel.
+
+        states: Dictionary(brancher.Variable: np.ndarray). Unconstrained states of the latent variables.
+
+    Returns:
+        Tuple of a np.ndarray of shape (number_samples,) and a dictionary(brancher.Variable: np.ndarray) of gradients.
+    """
+    unconstrained_values = {var: chainer.Variable(state.astype("float32")) for var, state in states.items()}
+    values = dict(input_values)
+    log_jacobian = 0.
+    for var, x in unconstrained_values.items():
+        if isinstance(SUPPORT_RANGES[type(var.distribution)], geometric_ranges.UnboundedRange):
+            values[var] = x
+            continue
+        y = _apply_support_transform(var, x)
+        derivative, = chainer.grad([F.sum(y)], [x], enable_double_backprop=True)
+        log_jacobian += sum_from_dim(F.log(F.absolute(derivative)), dim_index=1)
+        values[var] = y
+    log_probability = joint_model.calculate_log_probability(values, for_gradient=True)
+    log_probability = sum_from_dim(log_probability, dim_index=1) + log_jacobian
+    gradients = chainer.grad([F.sum(log_probability)], list(unconstrained_values.values()))
+    return log_probability.data, {var: g.data for var, g in zip(unconstrained_values.keys(), gradients)}
+
+
+def constrain_states(states):
+    return {var: _apply_support_transform(var, chainer.Variable(state.astype("float32"))).data
+            for var, state in states.items()}
+
+
+def get_sample_trace_model(trace):
+    """
+    Function. It returns a probabilistic model that samples jointly from a list of stored states of the latent variables.
+    """
+    index = TraceIndex(trace_length=sum([list(states.values())[0].shape[0] for states in trace]), name="trace_index")
+    return ProbabilisticModel([SampleTraceVariable(np.concatenate([states[var] for states in trace], axis=0),
+                                                   index=index, name=var.name)
+                               for var in trace[0].keys()])
+
+
+class HamiltonianMonteCarlo(InferenceMethod):
+    """
+    Summary. Hamiltonian Monte Carlo with many chains simulated in parallel. The state of all the chains is stored along
+    the samples axis, so that each leapfrog step evaluates the log probability of the joint model and its gradient once
+    for all the chains. Constrained latent variables are sampled in an unconstrained space given by the geometric ranges
+    in SUPPORT_RANGES and the log probability is corrected by the log Jacobian of the transformation. As in Stan, the
+    chains are initialized uniformly in (-2, 2) in the unconstrained space. The step size of each chain is adapted to the
+    target acceptance rate during the first transitions and the states visited afterwards are stored as posterior
+    samples.
+
+    Parameters
+    ----------
+    step_size : Float. Initial leapfrog step size. During the trajectories it is jittered by +-20% to avoid periodic
+    orbits.
+
+    number_leapfrog_steps : Int.
+
+    number_adaptation_steps : Int. Number of initial transitions used to adapt the step sizes. Their states are discarded.
+
+    target_acceptance : Float.
+
+    thinning : Int. Only one state every thinning transitions is stored.
+    """
+    def __init__(self, step_size=0.1, number_leapfrog_steps=10, number_adaptation_steps=100, target_acceptance=0.65,
+                 adaptation_rate=0.1, thinning=1):
+        self.learnable_model = False
+        self.needs_sampler = False
+        self.learnable_sampler = False
+        self.step_size = step_size
+        self.number_leapfrog_steps = number_leapfrog_steps
+        self.number_adaptation_steps = number_adaptation_steps
+        self.target_acceptance = target_acceptance
+        self.adaptation_rate = adaptation_rate
+        self.thinning = thinning
+        self.states = None
+
+    def check_model_compatibility(self, joint_model, posterior_model, sampler_model):
+        check_support_ranges(joint_model, "Hamiltonian Monte Carlo")
+
+    def _initialize(self, joint_model, number_chains, input_values):
+        self.states = initialize_unconstrained_states(joint_model, number_chains, input_values)
+        self.number_chains = number_chains
+        self.log_step_sizes = np.log(self.step_size)*np.ones((number_chains,))
+        self.log_probability, self.gradients = get_unconstrained_log_probability(joint_model, self.states, input_values)
+        self.number_transitions = 0
+        self.acceptance_rates = []
+        self.trace = []
+
+    @staticmethod
+    def _get_kinetic_energy(momenta):
+        return sum([np.sum(p**2, axis=tuple(range(1, p.ndim))) for p in momenta.values()])/2.
+
+    def compute_loss(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
+        """
+        Method. It performs one Hamiltonian Monte Carlo transition of all the chains and returns their mean potential
+        energy.
+        """
+        if self.states is None or self.number_chains != number_samples:
+            self._initialize(joint_model, number_samples, input_values)
+
+        def reshape(array, state):
+            return np.reshape(array, array.shape + (1,)*(state.ndim - 1))
+
+        step_sizes = np.exp(self.log_step_sizes)*np.random.uniform(0.8, 1.2, size=(number_samples,))
+        momenta = {var: np.random.normal(size=state.shape) for var, state in self.states.items()}
+        initial_energy = -self.log_probability + self._get_kinetic_energy(momenta)
+        states, log_probability, gradients = dict(self.states), self.log_probability, self.gradients
+        momenta = {var: p + reshape(step_sizes, p)*gradients[var]/2. for var, p in momenta.items()}
+        for step in range(self.number_leapfrog_steps):
+            states = {var: x + reshape(step_sizes, x)*momenta[var] for var, x in states.items()}
+            log_probability, gradients = get_unconstrained_log_probability(joint_model, states, input_values)
+            scale = 1. if step < self.number_leapfrog_steps - 1 else 0.5
+            momenta = {var: p + scale*reshape(step_sizes, p)*gradients[var] for var, p in momenta.items()}
+        final_energy = -log_probability + self._get_kinetic_energy(momenta)
+
+        with np.errstate(invalid="ignore", over="ignore"):
+            log_acceptance = np.nan_to_num(initial_energy - final_energy, nan=-np.inf)
+            acceptance_probability = np.exp(np.minimum(log_acceptance, 0.))
+        accepted = np.log(np.random.uniform(size=log_acceptance.shape)) < log_acceptance
+        self.states = {var: np.where(reshape(accepted, x), states[var], x) for var, x in self.states.items()}
+        self.log_probability = np.where(accepted, log_probability, self.log_probability)
+        self.gradients = {var: np.where(reshape(accepted, g), gradients[var], g) for var, g in self.gradients.items()}
+
+        if self.number_transitions < self.number_adaptation_steps:
+            self.log_step_sizes += self.adaptation_rate*(acceptance_probability - self.target_acceptance)
+        elif (self.number_transitions - self.number_adaptation_steps) % self.thinning == 0:
+            self.trace.append(constrain_states(self.states))
+        self.number_transitions += 1
+        self.acceptance_rates.append(np.mean(acceptance_probability))
+        return chainer.Variable(np.array(-np.mean(self.log_probability), dtype="float32"))
+
+    def post_process(self, joint_model):
+        joint_model.diagnostics.update({"acceptance rate": np.array(self.acceptance_rates),
+                                        "step size": np.exp(self.log_step_sizes)})
+        if not self.trace:
+            warnings.warn("No sample has been stored, the number of iterations should be larger than the number of "
+                          "adaptation steps")
+            return
+        joint_model.set_posterior_model(get_sample_trace_model(self.trace))
+
+
+class SteinVariationalGradientDescent(InferenceMethod):
+    """
+    Summary. Stein variational gradient descent. The particles of all the latent variables are stored as learnable
+    tensors along the samples axis, in the unconstrained space given by SUPPORT_RANGES. At every iteration the log
+    probability gradient of all the particles is evaluated in a single call and the kernel interactions are computed
+    from a single matrix of pairwise distances, so that the cost of an iteration does not grow with Python loops over the
+    particles. All the particles are updated in one optimizer step.
+
+    Parameters
+    ----------
+    optimizer : chainer.Optimizer. Optimizer of the particles, the Stein variational gradient is used as ascent
+    direction.
+
+    kernel_bandwidth : Float. Bandwidth h of the kernel k(x, y) = exp(-|x - y|^2/h). If None, the median heuristic
+    h = median(|x - y|^2)/log(number_particles + 1) is used at every iteration.
+    """
+    def __init__(self, optimizer=chainer.optimizers.Adam(0.05), kernel_bandwidth=None):
+        self.learnable_model = False
+        self.needs_sampler = False
+        self.learnable_sampler = False
+        self.optimizer = optimizer
+        self.kernel_bandwidth = kernel_bandwidth
+        self.particles = None
+
+    def check_model_compatibility(self, joint_model, posterior_model, sampler_model):
+        check_support_ranges(joint_model, "Stein variational gradient descent")
+
+    def _initialize(self, joint_model, number_particles, input_values):
+        states = initialize_unconstrained_states(joint_model, number_particles, input_values)
+        self.number_particles = number_particles
+        self.particles = {var: chainer.Parameter(state.astype("float32")) for var, state in states.items()}
+        self.particle_link = chainer.Link()
+        with self.particle_link.init_scope():
+            for index, particles in enumerate(self.particles.values()):
+                setattr(self.particle_link, "particles_{}".format(index), particles)
+        self.particle_optimizer = copy.deepcopy(self.optimizer)
+        self.particle_optimizer.setup(self.particle_link)
+
+    def get_stein_variational_gradient(self, particles, gradients):
+        """
+        Method. It returns the Stein variational gradient
+        phi(x_i) = sum_j [k(x_j, x_i) grad log p(x_j) + grad_{x_j} k(x_j, x_i)]/number_particles.
+
+        Args:
+            particles: np.ndarray. Flattened particles, with shape (number_particles, number_dimensions).
+
+            gradients: np.ndarray. Gradients of the log probability at the particles, with the same shape.
+
+        Returns:
+            np.ndarray.
+        """
+        squared_norms = np.sum(particles**2, axis=1)
+        squared_distances = np.maximum(squared_norms[:, None] + squared_norms[None, :] -
+                                       2*np.matmul(particles, particles.T), 0.)
+        if self.kernel_bandwidth:
+            bandwidth = self.kernel_bandwidth
+        else:
+            bandwidth = max(np.median(squared_distances)/np.log(len(particles) + 1), 1e-8)
+        kernel = np.exp(-squared_distances/bandwidth)
+        repulsion = 2*(particles*np.sum(kernel, axis=1, keepdims=True) - np.matmul(kernel, particles))/bandwidth
+        return (np.matmul(kernel, gradients) + repulsion)/len(particles)
+
+    def compute_loss(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
+        """
+        Method. It performs one update of all the particles and returns their mean negative log probability.
+        """
+        if self.particles is None or self.number_particles != number_samples:
+            self._initialize(joint_model, number_samples, input_values)
+        states = {var: particles.array for var, particles in self.particles.items()}
+        log_probability, gradients = get_unconstrained_log_probability(joint_model, states, input_values)
+
+        def flatten(array):
+            return np.reshape(array, (number_samples, -1))
+
+        variables = list(self.particles.keys())
+        flat_particles = np.concatenate([flatten(states[var]) for var in variables], axis=1)
+        flat_gradients = np.concatenate([flatten(gradients[var]) for var in variables], axis=1)
+        stein_gradient = self.get_stein_variational_gradient(flat_particles, flat_gradients)
+        split_indices = np.cumsum([flatten(states[var]).shape[1] for var in variables])[:-1]
+        for var, var_gradient in zip(variables, np.split(stein_gradient, split_indices, axis=1)):
+            self.particles[var].grad = -np.reshape(var_gradient, states[var].shape).astype("float32")
+        self.particle_optimizer.update()
+        return chainer.Variable(np.array(-np.mean(log_probability), dtype="float32"))
+
+    def post_process(self, joint_model):
+        states = {var: particles.array for var, particles in self.particles.items()}
+        joint_model.set_posterior_model(get_sample_trace_model([constrain_states(states)]))
+
+
 class WassersteinVariationalGradientDescent(InferenceMethod): #TODO: Work in progress
 
     def __init__(self, variational_samplers, particles,
@@ -157,10 +633,12 @@ class WassersteinVariationalGradientDescent(InferenceMethod): #TODO: Work in pro
             self.deviation_statistics = deviation_statistics
         else:
             self.deviation_statistics = lambda lst: sum(lst)
+        self._model_mappings = {}
 
         def model_statistics(dic):
             num_samples = list(dic.values())[0].shape[0]
-            reassigned_particles = [reassign_samples(p._get_sample(num_samples), source_model=p, target_model=dic)
+            reassigned_particles = [reassign_samples(p._get_sample(num_samples),
+                                                     model_mapping=self._get_model_mapping(p, dic))
                                     for p in particles]
 
             statistics = [self.deviation_statistics([self.cost_function(value_pair[0], value_pair[1]).data
@@ -168,7 +646,7 @@ class WassersteinVariationalGradientDescent(InferenceMethod): #TODO: Work in pro
                           for p in reassigned_particles]
             return np.array(statistics).transpose()
 
-        truncation_rules = [lambda a, idx=index: True if (idx == np.argmin(a)) else False
+        truncation_rules = [vectorized_truncation_rule(lambda a, idx=index: np.argmin(a, axis=1) == idx)
                             for index in range(len(particles))]
 
         self.sampler_model = [truncate_model(model=sampler,
@@ -176,6 +654,19 @@ class WassersteinVariationalGradientDescent(InferenceMethod): #TODO: Work in pro
                                              model_statistics=model_statistics)
                               for sampler, rule in zip(variational_samplers, truncation_rules)]
 
+    def _get_model_mapping(self, source_model, target_model):
+        """
+        Method. It returns the mapping between the variables of the source and the target models. The samplers and the
+        particles do not change during inference, so the mapping is computed once for each pair of models.
+        """
+        if isinstance(target_model, dict):
+            mapping_key = (source_model, frozenset(target_model))
+        else:
+            mapping_key = (source_model, target_model)
+        if mapping_key not in self._model_mappings:
+            self._model_mappings[mapping_key] = get_model_mapping(source_model, target_model)
+        return self._model_mappings[mapping_key]
+
     def check_model_compatibility(self, joint_model, posterior_model, sampler_model):
         assert isinstance(sampler_model, Iterable) and all([isinstance(subsampler, (Variable, ProbabilisticModel))
                                                             for subsampler in sampler_model]), "The Wasserstein Variational GD method require a list of variables or probabilistic models as sampler"
@@ -199,7 +690,7 @@ class WassersteinVariationalGradientDescent(InferenceMethod): #TODO: Work in pro
                                                                        q_model=sampler,
                                                                        for_gradient=False).flatten()
                                   for samples, sampler in zip(samples_list, sampler_model)]
-        reassigned_samples_list = [reassign_samples(samples, source_model=sampler, target_model=particle)
+        reassigned_samples_list = [reassign_samples(samples, model_mapping=self._get_model_mapping(sampler, particle))
                                    for samples, sampler, particle in zip(samples_list, sampler_model, particle_list)]
         pair_list = [zip_dict(particle._get_sample(1), samples)
                      for particle, samples in zip(particle_list, reassigned_samples_list)]
@@ -0,0 +1,351 @@
+import numpy as np
+
+import chainer
+import chainer.functions as F
+
+from brancher.variables import DeterministicVariable, RandomVariable
+from brancher.distributions import NormalDistribution, AutoregressiveDistribution
+from brancher.utilities import _scan_linear_recurrence
+
+
+class LinearGaussianChain(object):
+    """
+    Summary. Scalar linear-Gaussian state space model x_0 ~ N(c_0, q_0), x_t ~ N(a_t x_{t-1} + c_t, q_t) and
+    y_t ~ N(h_t x_t + d_t, r_t) extracted from a probabilistic model. The coefficients are stored as arrays of shape
+    (number_samples, length), with one row for each sample of the variables that are not part of the chain.
+
+    Parameters
+    ----------
+    latent_variables : List(brancher.RandomVariable). Either the chain of scalar normal variables ordered in time or a
+    single autoregressive variable that contains the whole chain.
+
+    observed_mask : np.ndarray. Boolean array of shape (length,) that is true at the observed time steps.
+    """
+    def __init__(self, latent_variables, a, c, q, h, d, r, y, observed_mask):
+        self.latent_variables = latent_variables
+        self.a, self.c, self.q = a, c, q
+        self.h, self.d, self.r = h, d, r
+        self.y = y
+        self.observed_mask = observed_mask
+
+    @property
+    def length(self):
+        return len(self.observed_mask)
+
+    @property
+    def is_autoregressive(self):
+        return isinstance(self.latent_variables[0].distribution, AutoregressiveDistribution)
+
+    def get_data(self):
+        """
+        Method. It returns a copy of the chain whose coefficients are np.ndarrays detached from the computational graph.
+        """
+        arrays = [val.data if isinstance(val, chainer.Variable) else val
+                  for val in (self.a, self.c, self.q, self.h, self.d, self.r, self.y)]
+        return LinearGaussianChain(self.latent_variables, *arrays, observed_mask=self.observed_mask)
+
+
+def _get_parent_value(parent, values):
+    if parent in values:
+        return values[parent]
+    elif type(parent) is DeterministicVariable:
+        return parent.value
+    else:
+        raise ValueError("The variable {} is neither deterministic nor given as input".format(parent.name))
+
+
+def _to_rows(parameter, number_samples, length):
+    parameter = F.reshape(parameter, (parameter.shape[0], -1))
+    return F.broadcast_to(parameter, (number_samples, length))
+
+
+def _get_affine_parameters(variable, chain_parent, values, shape, tolerance=1e-4):
+    """
+    Function. It probes the link of a normal variable at three values of its latent parent, stacked along the datapoints
+    axis so that the link is evaluated once, and returns the slope and the intercept of its mean and its standard
+    deviation. It raises a ValueError if the mean is not affine in the parent or
+    if the standard deviation depends on it.
+    """
+    if type(variable.distribution) is not NormalDistribution:
+        raise ValueError("The variable {} is not normal".format(variable.name))
+    parents_values = {parent: _get_parent_value(parent, values) for parent in variable.parents
+                      if parent is not chain_parent}
+    if chain_parent is None:
+        parameters = variable._apply_link(parents_values)
+        return 0.*parameters["mu"], parameters["mu"], parameters["sigma"]
+    probes = np.reshape(np.arange(3, dtype="float32"), (1, 3) + (1,)*(len(shape) - 2))
+    parents_values.update({chain_parent: chainer.Variable(probes*np.ones(shape, dtype="float32"))})
+    parameters = variable._apply_link(parents_values)
+    mu = F.broadcast_to(parameters["mu"], parameters["mu"].shape[:1] + (3,) + parameters["mu"].shape[2:])
+    sigma = F.broadcast_to(parameters["sigma"], mu.shape)
+    mu0, mu1, mu2 = mu[:, :1], mu[:, 1:2], mu[:, 2:]
+    is_affine = np.allclose((mu2 - mu1).data, (mu1 - mu0).data, atol=tolerance, rtol=tolerance)
+    is_homoscedastic = np.allclose(sigma.data, sigma.data[:, :1], atol=tolerance, rtol=tolerance)
+    if not (is_affine and is_homoscedastic):
+        raise ValueError("The variable {} is not a linear-Gaussian function of {}".format(variable.name,
+                                                                                          chain_parent.name))
+    return mu1 - mu0, mu0, sigma[:, :1]
+
+
+def extract_linear_gaussian_chain(model, input_values={}):
+    """
+    Function. It detects a scalar linear-Gaussian chain in a probabilistic model and returns its coefficients. The chain
+    is either a sequence of scalar normal variables whose means are affine in the previous variable or a single
+    autoregressive variable. The observed variables have to be normal with a mean that is affine in a single latent
+    variable of the chain. The latent variables that are not part of the chain (e.g. a transition coefficient) have to
+    be given in input_values.
+
+    Args:
+        model: brancher.ProbabilisticModel.
+
+        input_values: Dictionary(brancher.Variable: chainer.Variable). Values of the latent variables that are not part of
+        the chain. Each sample of these values defines a row of the coefficients.
+
+    Returns:
+        brancher.LinearGaussianChain. It raises a ValueError if the model does not have the required structure.
+    """
+    variables = [var for var in model._flatten() if isinstance(var, RandomVariable)]
+    latent_variables = [var for var in variables if not var.is_observed and var not in input_values]
+    observed_variables = [var for var in variables if var.is_observed]
+    if not latent_variables:
+        raise ValueError("The model does not have latent variables")
+    if any([not var.has_observed_value for var in observed_variables]):
+        raise ValueError("The observed variables of a linear-Gaussian chain cannot have a random dataset")
+    number_samples = max([val.shape[0] for val in input_values.values()] + [1])
+
+    if len(latent_variables) == 1 and isinstance(latent_variables[0].distribution, AutoregressiveDistribution):
+        variable = latent_variables[0]
+        length = variable.distribution.length
+        parameters = variable._apply_link({parent: _get_parent_value(parent, input_values)
+                                           for parent in variable.parents})
+        a, c, q = [_to_rows(parameters[key], number_samples, length) for key in ("b", "drift", "sigma")]
+        c = F.concat([_to_rows(parameters["initial_mu"], number_samples, 1), c[:, 1:]], axis=1)
+        q = F.concat([_to_rows(parameters["initial_sigma"], number_samples, 1), q[:, 1:]], axis=1)**2
+        observation_steps = {}
+        for observed in observed_variables:
+            if variable not in observed.parents:
+                raise ValueError("The observed variable {} is not an observation of the chain".format(observed.name))
+            slope, intercept, sigma = _get_affine_parameters(observed, variable, input_values,
+                                                             shape=(1, 1, length, 1, 1))
+            if observed.value.shape[1] != 1 or np.prod(observed.value.shape[2:]) != length:
+                raise ValueError("The observed variable {} should have a single value for each time step".format(observed.name))
+            if observation_steps:
+                raise ValueError("The autoregressive chain can only have a single observed variable")
+            observation_steps = {"h": _to_rows(slope, number_samples, length),
+                                 "d": _to_rows(intercept, number_samples, length),
+                                 "r": _to_rows(sigma, number_samples, length)**2,
+                                 "y": np.reshape(observed.value.data, (1, length))}
+        if not observation_steps:
+            raise ValueError("The chain does not have observations")
+        observed_mask = np.ones((length,), dtype=bool)
+        return LinearGaussianChain([variable], a, c, q, observed_mask=observed_mask, **observation_steps)
+
+    chain_parents = {}
+    for variable in latent_variables:
+        latent_parents = [parent for parent in variable.parents if parent in latent_variables]
+        if len(latent_parents) > 1:
+            raise ValueError("The variable {} has more than one latent parent".format(variable.name))
+        chain_parents[variable] = latent_parents[0] if latent_parents else None
+    roots = [var for var, parent in chain_parents.items() if parent is None]
+    children = {}
+    for variable, parent in chain_parents.items():
+        if parent is not None:
+            if parent in children:
+                raise ValueError("The variable {} has more than one latent child".format(parent.name))
+            children[parent] = variable
+    if len(roots) != 1:
+        raise ValueError("The latent variables do not form a single chain")
+    chain = [roots[0]]
+    while chain[-1] in children:
+        chain.append(children[chain[-1]])
+    if len(chain) != len(latent_variables):
+        raise ValueError("The latent variables do not form a single chain")
+
+    scalar_shape = (1, 1, 1, 1)
+    transitions = [_get_affine_parameters(variable, chain_parents[variable], input_values, shape=scalar_shape)
+                   for variable in chain]
+    observations = {}
+    for observed in observed_variables:
+        latent_parents = [parent for parent in observed.parents if parent in latent_variables]
+        if len(latent_parents) != 1:
+            raise ValueError("The observed variable {} should depend on exactly one latent variable".format(observed.name))
+        if latent_parents[0] in observations:
+            raise ValueError("The variable {} has more than one observation".format(latent_parents[0].name))
+        if np.prod(observed.value.shape[1:]) != 1:
+            raise ValueError("The observed variable {} should be a single scalar".format(observed.name))
+        observations[latent_parents[0]] = (_get_affine_parameters(observed, latent_parents[0], input_values,
+                                                                  shape=scalar_shape),
+                                           np.reshape(observed.value.data, (1, 1)))
+    if not observations:
+        raise ValueError("The chain does not have observations")
+
+    def stack(parameters):
+        return F.concat([_to_rows(p, number_samples, 1) for p in parameters], axis=1)
+
+    zero, one = chainer.Variable(np.zeros((1, 1), dtype="float32")), chainer.Variable(np.ones((1, 1), dtype="float32"))
+    a, c, sigma = [stack(p) for p in zip(*transitions)]
+    h, d, r = [stack(p) for p in zip(*[observations[var][0] if var in observations else (zero, zero, one)
+                                       for var in chain])]
+    y = np.concatenate([observations[var][1] if var in observations else np.zeros((1, 1), dtype="float32")
+                        for var in chain], axis=1)
+    observed_mask = np.array([var in observations for var in chain])
+    return LinearGaussianChain(chain, a, c, sigma**2, h, d, r**2, y, observed_mask)
+
+
+def _run_kalman_filter(a, c, q, h, d, r, y, observed_mask):
+    """
+    Function. It runs the Kalman filter on np.ndarrays of shape (number_samples, length). The Riccati recursion of the
+    variances is a single loop over the time steps on whole columns and the means are computed with one linear
+    recurrence (see brancher.utilities._scan_linear_recurrence). The unobserved time steps have a null observation
+    coefficient.
+
+    Returns:
+        Tuple of np.ndarrays with the predicted means and variances, the filtered means and variances, the Kalman gains,
+        the innovations, the innovation variances and the log likelihood of each time step.
+    """
+    a, c, q, h, d, r, y = [np.broadcast_to(np.asarray(array, dtype="float64"), np.shape(a))
+                           for array in (a, c, q, h, d, r, y)]
+    h = np.where(observed_mask, h, 0.)
+    r = np.where(observed_mask, r, 1.)
+    offset = np.where(observed_mask, y - d, 0.)
+    predicted_variances, filtered_variances = np.empty_like(q), np.empty_like(q)
+    variance = q[:, 0]
+    for t in range(a.shape[1]):
+        if t > 0:
+            variance = a[:, t]**2*filtered_variances[:, t - 1] + q[:, t]
+        predicted_variances[:, t] = variance
+        filtered_variances[:, t] = variance*r[:, t]/(h[:, t]**2*variance + r[:, t])
+    innovation_variances = h**2*predicted_variances + r
+    gains = predicted_variances*h/innovation_variances
+    residual_coefficients = r/innovation_variances
+    transition = residual_coefficients*a
+    transition[:, 0] = 0.
+    filtered_means = _scan_linear_recurrence(residual_coefficients*c + gains*offset, transition)
+    predicted_means = c.copy()
+    predicted_means[:, 1:] += a[:, 1:]*filtered_means[:, :-1]
+    innovations = offset - h*predicted_means
+    log_likelihoods = np.where(observed_mask, -0.5*np.log(2*np.pi*innovation_variances)
+                               - 0.5*innovations**2/innovation_variances, 0.)
+    return (predicted_means, predicted_variances, filtered_means, filtered_variances, gains, innovations,
+            innovation_variances, log_likelihoods)
+
+
+class KalmanFilterLogLikelihood(chainer.Function):
+    """
+    Chainer function computing the log marginal likelihood of the observations of a linear-Gaussian chain with the
+    Kalman filter. The inputs are the coefficients a, c, q, h, d and r of shape (number_samples, length) and the output
+    has shape (number_samples,). The backward pass runs the adjoint recursions of the filter, so the computational
+    graph has a single node regardless of the length of the chain.
+
+    Parameters
+    ----------
+    y : np.ndarray. Observations of shape (1, length) or (number_samples, length).
+
+    observed_mask : np.ndarray. Boolean array of shape (length,) that is true at the observed time steps.
+    """
+    def __init__(self, y, observed_mask):
+        self.y = y
+        self.observed_mask = observed_mask
+
+    def forward(self, inputs):
+        self.filtered = _run_kalman_filter(*inputs, y=self.y, observed_mask=self.observed_mask)
+        return np.sum(self.filtered[-1], axis=1).astype(inputs[0].dtype),
+
+    def backward(self, inputs, grad_outputs):
+        a, c, q, h, d, r = [np.broadcast_to(np.asarray(array, dtype="float64"), inputs[0].shape) for array in inputs]
+        gy, = grad_outputs
+        mask = self.observed_mask
+        h = np.where(mask, h, 0.)
+        r = np.where(mask, r, 1.)
+        predicted_means, predicted_variances, filtered_means, filtered_variances, gains, innovations, \
+            innovation_variances, _ = self.filtered
+        glog_likelihood = np.where(mask, gy[:, None].astype("float64"), 0.)
+        residual_coefficients = r/innovation_variances
+        glog_likelihood_variance = glog_likelihood*(-0.5/innovation_variances
+                                                    + 0.5*innovations**2/innovation_variances**2)
+
+        transition = np.zeros_like(a)
+        transition[:, 1:] = residual_coefficients[:, :-1]*a[:, 1:]
+        gpredicted_means = _scan_linear_recurrence(glog_likelihood*h*innovations/innovation_variances, transition,
+                                                   reverse=True)
+        gfiltered_means = np.zeros_like(a)
+        gfiltered_means[:, :-1] = a[:, 1:]*gpredicted_means[:, 1:]
+        ggains = gfiltered_means*innovations
+        ginnovations = gfiltered_means*gains - glog_likelihood*innovations/innovation_variances
+
+        transition[:, 1:] = residual_coefficients[:, :-1]**2*a[:, 1:]**2
+        gpredicted_variances = _scan_linear_recurrence(ggains*h*r/innovation_variances**2
+                                                       + h**2*glog_likelihood_variance, transition, reverse=True)
+        gfiltered_variances = np.zeros_like(a)
+        gfiltered_variances[:, :-1] = a[:, 1:]**2*gpredicted_variances[:, 1:]
+        ginnovation_variances = (-gfiltered_variances*predicted_variances*r/innovation_variances**2
+                                 - ggains*predicted_variances*h/innovation_variances**2 + glog_likelihood_variance)
+
+        ga = np.zeros_like(a)
+        ga[:, 1:] = (gpredicted_means[:, 1:]*filtered_means[:, :-1]
+                     + 2*gpredicted_variances[:, 1:]*a[:, 1:]*filtered_variances[:, :-1])
+        gc = gpredicted_means
+        gq = gpredicted_variances
+        gh = np.where(mask, ggains*predicted_variances/innovation_variances - ginnovations*predicted_means
+                      + 2*ginnovation_variances*h*predicted_variances, 0.)
+        gd = np.where(mask, -ginnovations, 0.)
+        gr = np.where(mask, ginnovation_variances + gfiltered_variances*predicted_variances/innovation_variances, 0.)
+        return tuple(gradient.astype(array.dtype) for gradient, array in zip((ga, gc, gq, gh, gd, gr), inputs))
+
+
+def kalman_filter(chain):
+    """
+    Function. It runs the Kalman filter on a linear-Gaussian chain. When the coefficients of the chain are
+    chainer.Variables, the log marginal likelihood is the output of a KalmanFilterLogLikelihood node and it can be
+    differentiated with respect to them.
+
+    Args:
+        chain: brancher.LinearGaussianChain.
+
+    Returns:
+        Tuple with the predicted means and variances and the filtered means and variances, as np.ndarrays of shape
+        (number_samples, length), and the log marginal likelihood of the observations, of shape (number_samples,).
+    """
+    coefficients = (chain.a, chain.c, chain.q, chain.h, chain.d, chain.r)
+    if isinstance(chain.a, np.ndarray):
+        filtered = _run_kalman_filter(*coefficients, y=chain.y, observed_mask=chain.observed_mask)
+        log_likelihood = np.sum(filtered[-1], axis=1)
+    else:
+        function = KalmanFilterLogLikelihood(chain.y, chain.observed_mask)
+        log_likelihood = function(*coefficients)
+        filtered = function.filtered
+    return filtered[:4] + (log_likelihood,)
+
+
+def kalman_smoother(chain):
+    """
+    Function. It runs the Kalman filter and the Rauch-Tung-Striebel smoother on a linear-Gaussian chain with
+    np.ndarray coefficients. The posterior of the chain is itself a Gaussian Markov chain and it is returned in forward
+    form, x_0 ~ N(drift_0, sigma_0) and x_t ~ N(b_t x_{t-1} + drift_t, sigma_t).
+
+    Args:
+        chain: brancher.LinearGaussianChain.
+
+    Returns:
+        Tuple of np.ndarrays (b, drift, sigma) of shape (number_samples, length) and the log marginal likelihood.
+    """
+    predicted_means, predicted_variances, filtered_means, filtered_variances, log_likelihood = kalman_filter(chain)
+    a = np.broadcast_to(np.asarray(chain.a, dtype="float64"), filtered_means.shape)
+    gains = np.zeros_like(filtered_means)
+    gains[:, 1:] = filtered_variances[:, :-1]*a[:, 1:]/predicted_variances[:, 1:]
+    shifted_predicted_means, shifted_predicted_variances = np.zeros_like(gains), np.zeros_like(gains)
+    shifted_predicted_means[:, :-1] = predicted_means[:, 1:]
+    shifted_predicted_variances[:, :-1] = predicted_variances[:, 1:]
+    previous_gains = np.zeros_like(gains)
+    previous_gains[:, :-1] = gains[:, 1:]
+    smoothed_means = _scan_linear_recurrence(filtered_means - previous_gains*shifted_predicted_means, gains,
+                                             reverse=True)
+    smoothed_variances = _scan_linear_recurrence(filtered_variances - previous_gains**2*shifted_predicted_variances,
+                                                 gains**2, reverse=True)
+    b = np.zeros_like(smoothed_means)
+    b[:, 1:] = gains[:, 1:]*smoothed_variances[:, 1:]/smoothed_variances[:, :-1]
+    drift = smoothed_means.copy()
+    drift[:, 1:] -= b[:, 1:]*smoothed_means[:, :-1]
+    variance = smoothed_variances.copy()
+    variance[:, 1:] -= b[:, 1:]**2*smoothed_variances[:, :-1]
+    return b, drift, np.sqrt(np.maximum(variance, 1e-12)), log_likelihood
@@ -1,4 +1,5 @@
 import numpy as np
+from scipy.spatial import cKDTree
 
 import chainer
 import chainer.functions as F
@@ -7,29 +8,96 @@ from brancher.variables import DeterministicVariable
 
 
 class VoronoiSet(object):
+    """
+    Summary. Partition of the sample space into the Voronoi regions of a list of particles. The assignment of a batch of
+    samples is computed in a single vectorized operation. With the default squared Euclidean cost a KD-tree is used when
+    the number of particles is at least kd_tree_threshold.
 
-    def __init__(self, particles, cost=lambda x, y: np.sum((x - y)**2)):
+    Parameters
+    ----------
+    particles : List(brancher.DeterministicVariable or chainer.Variable). Locations of the particles.
+
+    cost : Function. Cost between a sample and a particle location. If None, the squared Euclidean distance is used.
+    Custom costs are evaluated pair by pair.
+
+    kd_tree_threshold : Int.
+    """
+    def __init__(self, particles, cost=None, kd_tree_threshold=64):
         self.cost = cost
         self.particles = particles
+        self.kd_tree_threshold = kd_tree_threshold
         self.locations = None
+        self.kd_tree = None
         self.update_locations()
 
     def update_locations(self):
+        """
+        Method. It reads the current location of every particle into a (number_particles, number_dimensions) array. It
+        is called once for every assignment of a batch of samples.
+        """
         if isinstance(self.particles, list):
             if isinstance(self.particles[0], chainer.Variable):
-                self.locations = [part.data for part in self.particles]
+                locations = [part.data for part in self.particles]
             elif isinstance(self.particles[0], DeterministicVariable):
-                self.locations = [part.value[0, 0, :].data for part in self.particles]
+                locations = [part.value[0, 0, :].data for part in self.particles]
             else:
                 raise ValueError("The location of the particles should be either deterministic brancher variables, chainer variables or np.array")
         else:
             raise ValueError("The location of the particles should be inserted as a list of locations")
+        self.locations = np.reshape(np.array(locations), (len(locations), -1))
+        if self.cost is None and len(locations) >= self.kd_tree_threshold:
+            self.kd_tree = cKDTree(self.locations)
+        else:
+            self.kd_tree = None
 
-    def __call__(self, x, index):
+    def assign(self, samples):
+        """
+        Method. It returns the index of the Voronoi region of each sample.
+
+        Args:
+            samples: np.ndarray or chainer.Variable. Array of samples with shape (number_samples, ...). The size of each
+            sample has to be equal to the size of the particle locations.
+
+        Returns:
+            np.ndarray. Integer array with shape (number_samples,).
+        """
         self.update_locations()
-        distances = [self.cost(x, y) for y in self.locations]
-        if np.argmin(distances) == index:
-            return True
+        samples = samples.data if isinstance(samples, chainer.Variable) else np.array(samples)
+        number_samples = samples.shape[0]
+        if samples.size != number_samples*self.locations.shape[1]:
+            raise ValueError("The samples have shape {} while the particles have size {}".format(samples.shape,
+                                                                                              self.locations.shape[1]))
+        samples = np.reshape(samples, (number_samples, -1))
+        if self.cost is not None:
+            distances = np.array([[self.cost(x, y) for y in self.locations] for x in samples])
+        elif self.kd_tree is not None:
+            return self.kd_tree.query(samples)[1]
         else:
-            return False
+            distances = (np.sum(samples**2, axis=1, keepdims=True) - 2*np.matmul(samples, self.locations.T) +
+                         np.sum(self.locations**2, axis=1))
+        return np.argmin(distances, axis=1)
+
+    def get_truncation_rule(self, index):
+        """
+        Method. It returns a vectorized truncation rule that accepts the samples in the Voronoi region of the index-th
+        particle (see brancher.distributions.TruncatedDistribution).
+        """
+        return VoronoiRegion(self, index)
+
+    def __call__(self, x, index):
+        return self.assign(np.expand_dims(x, axis=0))[0] == index
+
+
+class VoronoiRegion(object):
+    """
+    Summary. Vectorized truncation rule of a Voronoi region. Given an array of samples with shape (number_samples, ...)
+    it returns a boolean mask of the samples that are in the region.
+    """
+    is_vectorized = True
+
+    def __init__(self, voronoi_set, index):
+        self.voronoi_set = voronoi_set
+        self.index = index
 
+    def __call__(self, samples):
+        return self.voronoi_set.assign(samples) == self.index
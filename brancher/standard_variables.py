@@ -8,6 +8,7 @@ import chainer.functions as F
 import brancher.distributions as distributions
 import brancher.geometric_ranges as geometric_ranges
 from brancher.variables import var2link, Variable, DeterministicVariable, RandomVariable, PartialLink
+from brancher.variables import join_matmul_weights
 from brancher.utilities import join_sets_list
 import brancher.functions as BF
 
@@ -18,30 +19,37 @@ class VariableConstructor(RandomVariable):
 
     Parameters
     ----------
+    plate : brancher.Plate. If given, the variable contains plate.size conditionally independent copies stored along
+    the third axis of its value. Parameters that do not depend on variables of the same plate are shared among the
+    copies, numeric parameters are given one (learnable) value for each copy.
     """
-    def __init__(self, name, learnable, ranges, is_observed=False, **kwargs):
+    def __init__(self, name, learnable, ranges, is_observed=False, plate=None, **kwargs):
 
         class VarLink(chainer.ChainList):
 
             def __init__(self):
                 self.kwargs = kwargs
+                self.shared_parameters = [k for k, x in kwargs.items()
+                                          if plate is not None and all([var.plate is not plate for var in var2link(x).vars])]
                 links = [link
                          for partial_link in kwargs.values()
                          for link in var2link(partial_link).links]
                 super().__init__(*links)
 
             def __call__(self, values):
-                return {k: var2link(x).fn(values) for k, x in self.kwargs.items()}
+                output = {k: var2link(x).fn(values) for k, x in self.kwargs.items()}
+                output.update({k: plate.broadcast(output[k]) for k in self.shared_parameters})
+                return output
 
         self.name = name
-        self._evaluated = False
         self._observed = is_observed
         self._observed_value = None
         self._current_value = None
+        self.plate = plate
         self.construct_deterministic_parents(learnable, ranges, kwargs)
         self.parents = join_sets_list([var2link(x).vars for x in kwargs.values()])
+        self._matmul_weights = join_matmul_weights([var2link(x) for x in kwargs.values()])
         self.link = VarLink()
-        self.samples = []
         self.ranges = {}
         self.dataset = None
         self.has_random_dataset = False
@@ -52,6 +60,8 @@ class VariableConstructor(RandomVariable):
     def construct_deterministic_parents(self, learnable, ranges, kwargs):
         for parameter_name, value in kwargs.items():
             if not isinstance(value, (Variable, PartialLink)):
+                if self.plate is not None:
+                    value = self.plate.expand_value(value)
                 if isinstance(value, np.ndarray):
                     dim = value.shape[0] #TODO: This is probably not general enough
                 elif isinstance(value, numbers.Number):
@@ -60,6 +70,7 @@ class VariableConstructor(RandomVariable):
                     dim = [] #TODO: You should consider the other possible cases individually
                 deterministic_parent = DeterministicVariable(ranges[parameter_name].inverse_transform(value, dim),
                                                              self.name + "_" + parameter_name, learnable, is_observed=self._observed)
+                deterministic_parent.plate = self.plate
                 kwargs.update({parameter_name: ranges[parameter_name].forward_transform(deterministic_parent, dim)})
 
 
@@ -101,13 +112,21 @@ class EmpiricalVariable(VariableConstructor):
 
     Parameters
     ----------
+    dataset : np.ndarray, chainer.Variable, list, np.memmap or String. If the dataset is a np.memmap or the path of a
+    .npy file, the data is kept on disk and only the sampled minibatches are loaded in memory and cast to float32/int32.
     """
     def __init__(self, dataset, name, learnable=False, is_observed=False, batch_size=(), indices=(), weights=()):
         self._type = "Empirical"
+        if isinstance(dataset, str):
+            dataset = np.load(dataset, mmap_mode="r")
         ranges = {"dataset": geometric_ranges.UnboundedRange(),
                   "batch_size": geometric_ranges.UnboundedRange(),
                   "indices": geometric_ranges.UnboundedRange(),
                   "weights": geometric_ranges.UnboundedRange()}
+        if isinstance(dataset, (np.ndarray, chainer.Variable)):
+            self.dataset_size = dataset.shape[0]
+        else:
+            self.dataset_size = len(dataset)
         super().__init__(name, dataset=dataset, indices=indices, weights=weights,
                          learnable=learnable, ranges=ranges, is_observed=is_observed)
         self.distribution = distributions.EmpiricalDistribution()
@@ -117,7 +136,7 @@ class EmpiricalVariable(VariableConstructor):
             self.batch_size = batch_size
         elif indices:
             self.distribution.batch_size = len(indices)
-            self.batch_size = batch_size #TODO: Clean up here?
+            self.batch_size = len(indices)
         else:
             raise ValueError("Either the indices or the batch size has to be given as input")
 
@@ -128,15 +147,88 @@ class RandomIndices(EmpiricalVariable):
 
     Parameters
     ----------
+    shuffled_epochs : Bool. If true, the indices are returned as contiguous minibatches of a random permutation of the
+    dataset that is redrawn at every epoch, instead of being sampled independently at every draw.
+
+    seed : Int. Seed of the permutations used when shuffled_epochs is true.
     """
-    def __init__(self, dataset_size, batch_size, name, is_observed=False):
+    def __init__(self, dataset_size, batch_size, name, is_observed=False, shuffled_epochs=False, seed=None):
         self._type = "Random Index"
-        super().__init__(dataset=list(range(dataset_size)),
+        super().__init__(dataset=range(dataset_size),
                          batch_size=batch_size, is_observed=is_observed, name=name)
+        if shuffled_epochs:
+            self.distribution = distributions.ShuffledEpochsDistribution(batch_size=batch_size, seed=seed)
 
     def __len__(self):
         return self.batch_size
 
+    @property
+    def epoch(self):
+        """
+        Number of completed passes over the dataset. Only available when shuffled_epochs is true.
+        """
+        return self.distribution.epoch
+
+    @property
+    def epoch_detail(self):
+        """
+        Number of passes over the dataset including the fraction of the current epoch. Only available when
+        shuffled_epochs is true.
+        """
+        return self.distribution.epoch_detail
+
+
+class StreamingEmpiricalVariable(VariableConstructor):
+    """
+    Summary. It returns the chunks of data produced by an iterator, one chunk every time the variable is sampled. When
+    another variable observes it, the log likelihood of each chunk is rescaled by dataset_size / chunk size.
+
+    Parameters
+    ----------
+    data_stream : Iterable of np.ndarray. The leading axis of each chunk indexes the datapoints.
+
+    dataset_size : Int. The (possibly approximate) total number of datapoints in the stream.
+    """
+    def __init__(self, data_stream, dataset_size, name, is_observed=False):
+        self._type = "Streaming Empirical"
+        super().__init__(name, learnable=False, ranges={}, is_observed=is_observed)
+        self.distribution = distributions.StreamingDistribution(data_stream)
+        self.distribution.is_observed = is_observed
+        self.dataset_size = dataset_size
+
+
+class TraceIndex(VariableConstructor):
+    """
+    Summary. Random index of a trace of stored samples, such as the states visited by a set of Markov chains.
+
+    Parameters
+    ----------
+    trace_length : Int. The number of stored samples.
+    """
+    def __init__(self, trace_length, name):
+        self._type = "Trace index"
+        super().__init__(name, learnable=False, ranges={})
+        self.distribution = distributions.TraceIndexDistribution(trace_length)
+
+
+class SampleTraceVariable(VariableConstructor):
+    """
+    Summary. Variable whose samples are drawn from a trace of stored samples. The variables that share the same
+    brancher.TraceIndex are sampled jointly, so that a model of sample traces reproduces the joint distribution of the
+    stored samples.
+
+    Parameters
+    ----------
+    trace : np.ndarray. The stored samples, with shape (trace_length, number_datapoints, ...).
+
+    index : brancher.TraceIndex.
+    """
+    def __init__(self, trace, index, name):
+        self._type = "Sample trace"
+        ranges = {"index": geometric_ranges.UnboundedRange()}
+        super().__init__(name, index=index, learnable=False, ranges=ranges)
+        self.distribution = distributions.SampleTraceDistribution(trace)
+
 
 class NormalVariable(VariableConstructor):
     """
@@ -145,29 +237,32 @@ class NormalVariable(VariableConstructor):
     Parameters
     ----------
     """
-    def __init__(self, mu, sigma, name, learnable=False):
+    def __init__(self, mu, sigma, name, learnable=False, plate=None):
         self._type = "Normal"
         ranges = {"mu": geometric_ranges.UnboundedRange(),
                   "sigma": geometric_ranges.RightHalfLine(0.)}
-        super().__init__(name, mu=mu, sigma=sigma, learnable=learnable, ranges=ranges)
+        super().__init__(name, mu=mu, sigma=sigma, learnable=learnable, ranges=ranges, plate=plate)
         self.distribution = distributions.NormalDistribution()
 
 
-# class TruncatedNormalVariable(UnnormalizedVariable): #TODO: Refactopring in progress, this class will probably be eliminated
-#     """
-#     Summary
-#
-#     Parameters
-#     ----------
-#     """
-#     def __init__(self, mu, sigma, truncation_rule, name, learnable=False):
-#         self._type = "Truncated Normal"
-#         self.is_normalized = False
-#         ranges = {"mu": geometric_ranges.UnboundedRange(),
-#                   "sigma": geometric_ranges.RightHalfLine(0.)}
-#         super().__init__(name, mu=mu, sigma=sigma, learnable=learnable, ranges=ranges)
-#         self.distribution = distributions.TruncatedDistribution(base_distribution=distributions.NormalDistribution(),
-#                                                                 truncation_rule=truncation_rule)
+class TruncatedNormalVariable(VariableConstructor):
+    """
+    Summary. Normal variable truncated to the interval (lower, upper), with an exactly normalized density. Infinite
+    bounds give one-sided truncations. The bounds are never learnable.
+
+    Parameters
+    ----------
+    """
+    def __init__(self, mu, sigma, lower, upper, name, learnable=False, plate=None):
+        self._type = "Truncated Normal"
+        ranges = {"mu": geometric_ranges.UnboundedRange(),
+                  "sigma": geometric_ranges.RightHalfLine(0.)}
+        lower, upper = [bound if isinstance(bound, (Variable, PartialLink))
+                        else DeterministicVariable(bound, name + "_" + bound_name, learnable=False)
+                        for bound, bound_name in ((lower, "lower"), (upper, "upper"))]
+        super().__init__(name, mu=mu, sigma=sigma, lower=lower, upper=upper, learnable=learnable, ranges=ranges,
+                         plate=plate)
+        self.distribution = distributions.TruncatedNormalDistribution()
 
 
 class CauchyVariable(VariableConstructor):
@@ -177,11 +272,11 @@ class CauchyVariable(VariableConstructor):
     Parameters
     ----------
     """
-    def __init__(self, mu, sigma, name, learnable=False):
+    def __init__(self, mu, sigma, name, learnable=False, plate=None):
         self._type = "Cauchy"
         ranges = {"mu": geometric_ranges.UnboundedRange(),
                   "sigma": geometric_ranges.RightHalfLine(0.)}
-        super().__init__(name, mu=mu, sigma=sigma, learnable=learnable, ranges=ranges)
+        super().__init__(name, mu=mu, sigma=sigma, learnable=learnable, ranges=ranges, plate=plate)
         self.distribution = distributions.CauchyDistribution()
 
 
@@ -192,11 +287,11 @@ class LogNormalVariable(VariableConstructor):
     Parameters
     ----------
     """
-    def __init__(self, mu, sigma, name, learnable=False):
+    def __init__(self, mu, sigma, name, learnable=False, plate=None):
         self._type = "Log Normal"
         ranges = {"mu": geometric_ranges.UnboundedRange(),
                   "sigma": geometric_ranges.RightHalfLine(0.)}
-        super().__init__(name, mu=mu, sigma=sigma, learnable=learnable, ranges=ranges)
+        super().__init__(name, mu=mu, sigma=sigma, learnable=learnable, ranges=ranges, plate=plate)
         self.distribution = distributions.LogNormalDistribution()
 
 
@@ -207,11 +302,11 @@ class LogitNormalVariable(VariableConstructor):
     Parameters
     ----------
     """
-    def __init__(self, mu, sigma, name, learnable=False):
+    def __init__(self, mu, sigma, name, learnable=False, plate=None):
         self._type = "Logit Normal"
         ranges = {"mu": geometric_ranges.UnboundedRange(),
                   "sigma": geometric_ranges.RightHalfLine(0.)}
-        super().__init__(name, mu=mu, sigma=sigma, learnable=learnable, ranges=ranges)
+        super().__init__(name, mu=mu, sigma=sigma, learnable=learnable, ranges=ranges, plate=plate)
         self.distribution = distributions.LogitNormalDistribution()
 
 
@@ -222,23 +317,50 @@ class BinomialVariable(VariableConstructor):
     Parameters
     ----------
     """
-    def __init__(self, n, p=None, logit_p=None, name="Binomial", learnable=False):
+    def __init__(self, n, p=None, logit_p=None, name="Binomial", learnable=False, plate=None):
         self._type = "Binomial"
         if p is not None and logit_p is None:
             ranges = {"n": geometric_ranges.UnboundedRange(),
                       "p": geometric_ranges.Interval(0., 1.)}
-            super().__init__(name, n=n, p=p, learnable=learnable, ranges=ranges)
+            super().__init__(name, n=n, p=p, learnable=learnable, ranges=ranges, plate=plate)
             self.distribution = distributions.BinomialDistribution()
         elif logit_p is not None and p is None:
             ranges = {"n": geometric_ranges.UnboundedRange(),
                       "z": geometric_ranges.UnboundedRange()}
-            super().__init__(name, n=n, z=logit_p, learnable=learnable, ranges=ranges)
+            super().__init__(name, n=n, z=logit_p, learnable=learnable, ranges=ranges, plate=plate)
             self.distribution = distributions.LogitBinomialDistribution()
         else:
             raise ValueError("Either p or " +
                              "logit_p needs to be provided as input")
 
 
+class AutoregressiveVariable(VariableConstructor):
+    """
+    Summary. Gaussian first order autoregressive time series x_0 ~ N(initial_mu, initial_sigma) and
+    x_t ~ N(b x_{t-1} + drift, sigma) whose whole trajectory is stored in a single tensor. The log probability is
+    evaluated with vectorized operations on the shifted trajectory and the samples are computed with a single scan.
+
+    Parameters
+    ----------
+    plate : brancher.Plate. The time axis. Its size is the length of the time series. Variables defined on the same plate
+    (e.g. noisy observations of the series) are evaluated at all time steps at once.
+
+    drift, sigma, b : Numeric, np.ndarray or brancher variable. The parameters can have one value per time step; for
+    instance a learnable posterior with a drift array of shape (length,) is parameterized by a single tensor.
+    """
+    def __init__(self, b, sigma, plate, name, drift=0., initial_mu=0., initial_sigma=1., learnable=False):
+        self._type = "Autoregressive"
+        ranges = {"b": geometric_ranges.UnboundedRange(),
+                  "drift": geometric_ranges.UnboundedRange(),
+                  "sigma": geometric_ranges.RightHalfLine(0.),
+                  "initial_mu": geometric_ranges.UnboundedRange(),
+                  "initial_sigma": geometric_ranges.RightHalfLine(0.)}
+        super().__init__(name, b=b, drift=drift, sigma=sigma, initial_mu=initial_mu, initial_sigma=initial_sigma,
+                         learnable=learnable, ranges=ranges)
+        self.plate = plate
+        self.distribution = distributions.AutoregressiveDistribution(length=plate.size)
+
+
 class CategoricalVariable(VariableConstructor): #TODO: Work in progress
     """
     Summary
@@ -246,16 +368,16 @@ class CategoricalVariable(VariableConstructor): #TODO: Work in progress
     Parameters
     ----------
     """
-    def __init__(self, p=None, softmax_p=None, name="Categorical", learnable=False):
+    def __init__(self, p=None, softmax_p=None, name="Categorical", learnable=False, one_hot=True):
         self._type = "Categorical"
         if p is not None and softmax_p is None:
             ranges = {"p": geometric_ranges.Simplex()}
             super().__init__(name, p=p, learnable=learnable, ranges=ranges)
-            self.distribution = distributions.CategoricalDistribution()
+            self.distribution = distributions.CategoricalDistribution(one_hot=one_hot)
         elif softmax_p is not None and p is None:
             ranges = {"z": geometric_ranges.UnboundedRange()}
             super().__init__(name, z=softmax_p, learnable=learnable, ranges=ranges)
-            self.distribution = distributions.SoftmaxCategoricalDistribution()
+            self.distribution = distributions.SoftmaxCategoricalDistribution(one_hot=one_hot)
         else:
             raise ValueError("Either p or " +
                              "softmax_p needs to be provided as input")
@@ -9,6 +9,7 @@ from collections import abc
 from collections.abc import Iterable
 
 import numpy as np
+from scipy.signal import lfilter
 import chainer
 import chainer.functions as F
 
@@ -72,6 +73,68 @@ def join_sets_list(sets_list):
         return set()
 
 
+def topological_sort(nodes, get_parents):
+    """
+    It returns a list containing the input nodes and all their ancestors without duplicates. Every node appears after
+    all its parents. The graph is traversed iteratively so that deep graphs do not hit the recursion limit.
+
+    Args:
+        nodes: Iterable. The nodes from which the traversal starts.
+
+        get_parents: Callable. It maps a node to an iterable of its parents.
+
+    Returns:
+        List.
+    """
+    order = []
+    visited = set()
+    for root in nodes:
+        if root in visited:
+            continue
+        visited.add(root)
+        stack = [(root, iter(get_parents(root)))]
+        while stack:
+            node, parents = stack[-1]
+            for parent in parents:
+                if parent not in visited:
+                    visited.add(parent)
+                    stack.append((parent, iter(get_parents(parent))))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+    return order
+
+
+def get_name_index(nodes, get_parents):
+    """
+    It returns a dictionary mapping the names of the input nodes and of all their ancestors to the nodes. When several
+    nodes share a name, the one that is kept is the last one in the depth-first ordering where every node comes after
+    its parents and the ancestors of the first input nodes come first. This is the ordering of the recursive
+    BrancherClass._flatten and it is not the ordering of topological_sort. The ordering is scanned backwards (node first,
+    then the parents in reverse order) without building it, and every node is visited once.
+
+    Args:
+        nodes: Iterable. The nodes from which the traversal starts.
+
+        get_parents: Callable. It maps a node to an iterable of its parents.
+
+    Returns:
+        Dictionary(String: node).
+    """
+    name_index = {}
+    visited = set()
+    stack = list(nodes)
+    while stack:
+        node = stack.pop()
+        if node in visited:
+            continue
+        visited.add(node)
+        name_index.setdefault(node.name, node)
+        stack.extend(get_parents(node))
+    return name_index
+
+
 def sum_from_dim(var, dim_index):
     data_dim = len(var.shape)
     for dim in reversed(range(dim_index, data_dim)):
@@ -83,12 +146,24 @@ def sum_data_dimensions(var):
     return sum_from_dim(var, dim_index=2)
 
 
-def partial_broadcast(*args):
+def partial_broadcast(*args, number_samples=1):
     shapes0, shapes1 = zip(*[(x.shape[0], x.shape[1]) for x in args])
-    s0, s1 = np.max(shapes0), np.max(shapes1)
+    s0, s1 = max(np.max(shapes0), number_samples), np.max(shapes1)
     return [F.broadcast_to(x, shape=(s0, s1) + x.shape[2:]) for x in args]
 
 
+def broadcast_sum(args):
+    """
+    It broadcasts a list of arrays to a common shape and sums them with a single reduction.
+    """
+    if not args:
+        return 0.
+    if len(args) == 1:
+        return args[0]
+    shape = np.broadcast_shapes(*[arg.shape for arg in args])
+    return F.sum(F.stack([F.broadcast_to(arg, shape) for arg in args], axis=0), axis=0)
+
+
 def broadcast_and_squeeze(*args):
     if all([np.prod(val.shape[2:]) == 1 for val in args]):
         args = [F.reshape(val, shape=val.shape[:2] + tuple([1, 1])) for val in args] #TODO: Work in progress
@@ -97,9 +172,9 @@ def broadcast_and_squeeze(*args):
     return broadcasted_values
 
 
-def broadcast_parent_values(parents_values):
+def broadcast_parent_values(parents_values, number_samples=1):
     keys_list, values_list = zip(*[(key, value) for key, value in parents_values.items()])
-    broadcasted_values = partial_broadcast(*values_list)
+    broadcasted_values = partial_broadcast(*values_list, number_samples=number_samples)
     original_shapes = [val.shape for val in broadcasted_values]
     data_shapes = [s[2:] for s in original_shapes]
     number_samples, number_datapoints = original_shapes[0][0:2]
@@ -120,6 +195,143 @@ def get_diagonal(tensor):
     return F.reshape(subdiagonal, shape=(dim1, dim2, dim_matrix))
 
 
+def sample_categorical(probabilities, one_hot=True):
+    """
+    It draws one category for each probability vector stored along the last axis of the input with a single vectorized
+    inverse-CDF pass. The probabilities do not need to be normalized.
+
+    Args:
+        probabilities: np.ndarray. Array of non-negative probabilities with the categories along the last axis.
+
+        one_hot: Bool. If true the samples are returned as one-hot vectors, otherwise as category indices.
+
+    Returns:
+        np.ndarray. Array with the same shape as the input if one_hot is true, otherwise without the last axis.
+    """
+    number_categories = probabilities.shape[-1]
+    cumulative_probabilities = np.cumsum(probabilities, axis=-1)
+    thresholds = cumulative_probabilities[..., -1:]*np.random.uniform(0, 1, size=probabilities.shape[:-1] + (1,))
+    indices = np.minimum(np.sum(cumulative_probabilities <= thresholds, axis=-1), number_categories - 1)
+    if one_hot:
+        return (np.expand_dims(indices, axis=-1) == np.arange(number_categories)).astype("int32")
+    return indices.astype("int32")
+
+
+def sample_indices_without_replacement(population_size, batch_size, number_samples=1, p=None):
+    """
+    It draws number_samples independent sets of batch_size distinct indices from range(population_size). Without
+    probabilities, the indices are drawn with replacement and the repeated ones are redrawn until all are distinct. This
+    costs O(batch_size) per set instead of materializing a permutation of the whole population. With probabilities, the
+    sets are drawn by taking the largest exponential keys, which matches sequential sampling without replacement.
+
+    Args:
+        population_size: Int.
+
+        batch_size: Int.
+
+        number_samples: Int.
+
+        p: np.ndarray. Optional normalized probabilities of the indices.
+
+    Returns:
+        np.ndarray. Integer array of shape (number_samples, batch_size).
+    """
+    if batch_size > population_size:
+        raise ValueError("It is impossible to have more samples than the size of the dataset without replacement")
+    if p is not None:
+        keys = np.log(np.random.uniform(0, 1, size=(number_samples, population_size)))/p
+        return np.argpartition(-keys, batch_size - 1, axis=1)[:, :batch_size]
+    if 2*batch_size > population_size:
+        return np.argsort(np.random.uniform(0, 1, size=(number_samples, population_size)), axis=1)[:, :batch_size]
+    indices = np.random.randint(0, population_size, size=(number_samples, batch_size))
+    while True:
+        order = np.argsort(indices, axis=1, kind="stable")
+        sorted_indices = np.take_along_axis(indices, order, axis=1)
+        sorted_repetitions = np.zeros(indices.shape, dtype=bool)
+        sorted_repetitions[:, 1:] = sorted_indices[:, 1:] == sorted_indices[:, :-1]
+        if not sorted_repetitions.any():
+            return indices
+        repetitions = np.zeros(indices.shape, dtype=bool)
+        np.put_along_axis(repetitions, order, sorted_repetitions, axis=1)
+        indices[repetitions] = np.random.randint(0, population_size, size=np.sum(repetitions))
+
+
+def _scan_linear_recurrence(u, b, reverse=False):
+    """
+    It solves y_t = b_t y_{t-1} + u_t along the second axis (or y_t = b_{t+1} y_{t+1} + u_t if reverse is true) with a
+    single pass over the time steps. If the coefficient is the same for all the rows and time steps it uses lfilter.
+    """
+    if np.all(b == b.flat[0]):
+        coefficient = b.flat[0]
+        if reverse:
+            return lfilter([1.], [1., -coefficient], u[:, ::-1], axis=1)[:, ::-1].astype(u.dtype)
+        return lfilter([1.], [1., -coefficient], u, axis=1).astype(u.dtype)
+    b = np.broadcast_to(b, u.shape)
+    y = np.empty_like(u)
+    length = u.shape[1]
+    if reverse:
+        y[:, -1] = u[:, -1]
+        for t in reversed(range(length - 1)):
+            y[:, t] = b[:, t + 1]*y[:, t + 1] + u[:, t]
+    else:
+        y[:, 0] = u[:, 0]
+        for t in range(1, length):
+            y[:, t] = b[:, t]*y[:, t - 1] + u[:, t]
+    return y
+
+
+class LinearRecurrence(chainer.Function):
+    """
+    Chainer function computing y_t = b_t y_{t-1} + u_t, with y_0 = u_0, along the second axis of u. The coefficients b
+    have shape (batch_size, 1) or (batch_size, length).
+    """
+    def forward(self, inputs):
+        u, b = inputs
+        self.y = _scan_linear_recurrence(u, b)
+        return self.y,
+
+    def backward(self, inputs, grad_outputs):
+        u, b = inputs
+        gy, = grad_outputs
+        gu = _scan_linear_recurrence(gy, b, reverse=True)
+        gb = np.zeros_like(u)
+        gb[:, 1:] = gu[:, 1:]*self.y[:, :-1]
+        if b.shape[1] == 1:
+            gb = np.sum(gb, axis=1, keepdims=True)
+        return gu, gb.astype(b.dtype)
+
+
+def linear_recurrence(u, b):
+    return LinearRecurrence()(u, b)
+
+
+def cast_array(data):
+    """
+    Summary. It casts 64 bits numpy arrays to the 32 bits dtypes used by chainer. Other arrays are returned unchanged.
+    """
+    if data.dtype is np.dtype(np.float64):
+        return data.astype("float32")
+    elif data.dtype is np.dtype(np.int64):
+        return data.astype("int32")
+    return data
+
+
+def format_minibatch(sample, is_observed):
+    """
+    Summary. It casts a numpy minibatch of shape (number_samples, batch_size, ...) and it reshapes it as the samples of
+    the empirical variables, adding the trailing axes added by coerce_to_dtype to observed data.
+    """
+    sample = cast_array(np.asarray(sample))
+    if is_observed:
+        if sample.ndim == 2:
+            sample = np.reshape(sample, sample.shape + tuple([1, 1]))
+        elif sample.ndim == 3:
+            sample = np.reshape(sample, sample.shape + tuple([1]))
+        return chainer.Variable(sample, requires_grad=False)
+    else:
+        return F.expand_dims(chainer.Variable(sample), axis=1)
+
+
 def coerce_to_dtype(data, is_observed=False): #TODO: for Julia: Very important
     """Summary"""
     dtype = type(data)
@@ -130,12 +342,7 @@ def coerce_to_dtype(data, is_observed=False): #TODO: for Julia: Very important
     elif dtype is int or dtype is np.int32 or dtype is np.int64:
         result = chainer.Variable(data * np.ones(shape=(1, 1), dtype="int32"))
     elif dtype is np.ndarray:
-        if data.dtype is np.dtype(np.float64):
-            result = chainer.Variable(data.astype("float32"))
-        elif data.dtype is np.dtype(np.int64):
-            result = chainer.Variable(data.astype("int32"))
-        else:
-            result = chainer.Variable(data)
+        result = chainer.Variable(cast_array(data))
     elif issubclass(dtype, abc.Iterable):
         result = data  # TODO: This is for allowing discrete data, temporary?
         return result
@@ -178,22 +385,17 @@ def uniform_shapes(*args):
 
 
 def get_model_mapping(source_model, target_model):
-    model_mapping = {}
     if isinstance(target_model, dict):
         target_variables = list(target_model.keys())
     else:
-        target_variables = target_model._flatten()
-    for p_var in target_variables:
-        try:
-            model_mapping.update({source_model.get_variable(p_var.name): p_var})
-        except KeyError:
-            pass
-    return model_mapping
+        target_variables = list(target_model._get_variable_index().values())
+    source_index = source_model._get_variable_index()
+    return {source_index[p_var.name]: p_var for p_var in target_variables if p_var.name in source_index}
 
 
 def reassign_samples(samples, model_mapping=(), source_model=(), target_model=()):
     out_sample = {}
-    if model_mapping:
+    if isinstance(model_mapping, dict):
         pass
     elif source_model and target_model:
         model_mapping = get_model_mapping(source_model, target_model)
@@ -230,19 +432,129 @@ def get_memory(obj, seen=None):
 
 #TODO: Truncation material, to be cleaned up
 
-def reject_samples(samples, model_statistics, truncation_rule): #TODO: Work in progress
-    decision_variable = model_statistics(samples) #samples -> tensor
-    sample_indices = [index for index, value in enumerate(decision_variable) if truncation_rule(value)]
-    num_accepted_samples = len(sample_indices)
+def vectorized_truncation_rule(truncation_rule):
+    """
+    Function. It marks a truncation rule as vectorized. A vectorized rule takes the whole array of decision variables,
+    with shape (number_samples, ...), and returns the boolean mask of the accepted samples.
+    """
+    truncation_rule.is_vectorized = True
+    return truncation_rule
+
+
+def get_acceptance_mask(decision_variable, truncation_rule):
+    """
+    Function. It returns a boolean array with shape (number_samples,) that is True for the samples that satisfy the
+    truncation rule. Vectorized rules are evaluated once on the whole array, other rules are evaluated sample by sample.
+    """
+    if getattr(truncation_rule, "is_vectorized", False):
+        mask = np.array(truncation_rule(decision_variable), dtype=bool)
+        return np.all(np.reshape(mask, (mask.shape[0], -1)), axis=1)
+    return np.array([bool(truncation_rule(value)) for value in decision_variable], dtype=bool)
+
+
+def reject_samples(samples, model_statistics, truncation_rule):
+    mask = get_acceptance_mask(model_statistics(samples), truncation_rule)
+    num_accepted_samples = int(np.sum(mask))
     if num_accepted_samples == 0:
         return None, 0, 0.1 #TODO: Improve
     else:
-        remaining_samples = {var: value[sample_indices, :] for var, value in samples.items()}
-
-        acceptance_probability = num_accepted_samples/float(decision_variable.shape[0])
+        sample_indices = np.flatnonzero(mask)
+        remaining_samples = {var: value[sample_indices] for var, value in samples.items()}
+        acceptance_probability = num_accepted_samples/float(len(mask))
         return remaining_samples, num_accepted_samples, acceptance_probability
 
 
+class RejectionSampler(object):
+    """
+    Summary. Vectorized rejection sampler. The candidates of all the missing samples are drawn in a single batch, the
+    truncation rule is evaluated as a boolean mask and the accepted candidates are gathered with a single indexing
+    operation. The sampler keeps a running estimate of the acceptance probability, which is used for choosing the
+    number of candidates so that most calls only need one round.
+
+    Parameters
+    ----------
+    truncation_rule : Function. Per-sample or vectorized (see vectorized_truncation_rule) truncation rule.
+
+    max_number_candidates : Int. Maximum number of candidates drawn in a round.
+    """
+    def __init__(self, truncation_rule, max_number_candidates=10**6):
+        self.truncation_rule = truncation_rule
+        self.max_number_candidates = max_number_candidates
+        self.number_proposed = 0
+        self.number_accepted = 0
+
+    @property
+    def acceptance_probability(self):
+        return (self.number_accepted + 1.)/(self.number_proposed + 2.)
+
+    def get_number_copies(self, number_missing_samples):
+        """
+        Method. It returns the number of candidates drawn for each missing sample. The expected number of accepted
+        candidates exceeds the number of missing samples by two standard deviations.
+        """
+        number_candidates = (number_missing_samples + 2*np.sqrt(number_missing_samples) + 1)/self.acceptance_probability
+        number_candidates = min(number_candidates, self.max_number_candidates)
+        return max(int(np.ceil(number_candidates/number_missing_samples)), 1)
+
+    def get_sample(self, get_candidates, number_samples, get_decision_variable=lambda x: x, max_rounds=20):
+        """
+        Method. It returns number_samples samples that satisfy the truncation rule.
+
+        Args:
+            get_candidates: Function. It takes an integer array with the sample index of each candidate and returns
+            the candidates, as an array or as a dictionary of arrays with the candidates along the first axis.
+
+            number_samples: Int.
+
+            get_decision_variable: Function. It maps the candidates to the input of the truncation rule.
+
+            max_rounds: Int. Maximum number of rounds of rejection.
+
+        Returns:
+            chainer.Variable or Dict(brancher.Variable: chainer.Variable). The i-th sample is a candidate for the i-th
+            sample index.
+        """
+        remaining_indices = np.arange(number_samples)
+        accepted_list, accepted_indices = [], []
+        for _ in range(max_rounds):
+            number_missing_samples = len(remaining_indices)
+            number_copies = self.get_number_copies(number_missing_samples)
+            candidates = get_candidates(np.tile(remaining_indices, number_copies))
+            mask = get_acceptance_mask(get_decision_variable(candidates), self.truncation_rule)
+            self.number_proposed += len(mask)
+            self.number_accepted += int(np.sum(mask))
+            mask = np.reshape(mask, (number_copies, number_missing_samples))
+            is_accepted = np.any(mask, axis=0)
+            candidate_indices = np.argmax(mask, axis=0)*number_missing_samples + np.arange(number_missing_samples)
+            if np.any(is_accepted):
+                accepted_list.append(_gather_samples(candidates, candidate_indices[is_accepted], mask.size))
+                accepted_indices.append(remaining_indices[is_accepted])
+            remaining_indices = remaining_indices[~is_accepted]
+            if len(remaining_indices) == 0:
+                order = np.argsort(np.concatenate(accepted_indices))
+                samples = _concatenate_gathered_samples(accepted_list)
+                return _gather_samples(samples, order, number_samples)
+        raise ValueError("{} samples were not accepted by the truncation rule after {} rounds, the estimated acceptance "
+                         "probability is {}".format(len(remaining_indices), max_rounds, self.acceptance_probability))
+
+
+def _gather_samples(samples, indices, number_candidates):
+    if isinstance(samples, dict):
+        return {var: _gather_samples(value, indices, number_candidates) for var, value in samples.items()}
+    if samples.shape[0] == number_candidates:
+        return samples[indices]
+    return F.broadcast_to(samples, (len(indices),) + samples.shape[1:]) # Values that are shared by all the candidates
+
+
+def _concatenate_gathered_samples(samples_list):
+    if isinstance(samples_list[0], dict):
+        return {var: _concatenate_gathered_samples([samples[var] for samples in samples_list])
+                for var in samples_list[0]}
+    if len(samples_list) == 1:
+        return samples_list[0]
+    return F.concat(samples_list, axis=0)
+
+
 def concatenate_samples(samples_list):
     if len(samples_list) == 1:
         return samples_list[0]
@@ -8,15 +8,20 @@ import operator
 import numbers
 import collections
 from collections.abc import Iterable
+import queue
+import threading
 
 import chainer
 import chainer.links as L
 import chainer.functions as F
 import numpy as np
 
-from brancher.utilities import join_dicts_list, join_sets_list
+from brancher.utilities import join_sets_list
 from brancher.utilities import flatten_list
+from brancher.utilities import topological_sort
+from brancher.utilities import get_name_index
 from brancher.utilities import partial_broadcast
+from brancher.utilities import broadcast_sum
 from brancher.utilities import coerce_to_dtype
 from brancher.utilities import broadcast_parent_values
 from brancher.utilities import split_dict
@@ -25,15 +30,271 @@ from brancher.utilities import tile_parameter
 from brancher.utilities import get_model_mapping
 from brancher.utilities import reassign_samples
 
+import brancher.distributions as distributions
+import brancher.enumeration_tools as enumeration_tools
+
 from brancher.pandas_interface import reformat_sample_to_pandas
 from brancher.pandas_interface import reformat_model_summary
 from brancher.pandas_interface import pandas_frame2dict
 from brancher.pandas_interface import pandas_frame2value
 
+class EvaluationContext(object):
+    """
+    EvaluationContext stores the state of a single sampling or log probability evaluation call. Variables read the
+    values of their parents from the context and never store per-call state on themselves, so the same model can be
+    evaluated concurrently from several threads as long as each call uses its own context.
+
+    Parameters
+    ----------
+    number_samples : Int. The number of samples requested by the call.
+
+    observed : Bool. It specifies whether the observed variables should be sampled from their observations.
+
+    input_values : Dictionary(brancher.Variable: chainer.Variable). The values provided as input to the call. These are
+    the values at which the log probability is evaluated.
+
+    for_gradient : Bool.
+
+    normalized : Bool.
+    """
+    def __init__(self, number_samples=1, observed=False, input_values={}, for_gradient=False, normalized=True):
+        self.number_samples = number_samples
+        self.observed = observed
+        self.input_values = input_values
+        self.for_gradient = for_gradient
+        self.normalized = normalized
+        self.samples = {}
+
+    def sample(self, sampling_plan):
+        """
+        Method. It samples the variables of a sampling plan in order and stores the samples in the context.
+
+        Args:
+            sampling_plan: List of brancher.Variable. A list in which every variable comes after its sampling parents.
+
+        Returns:
+            Dictionary(brancher.Variable: chainer.Variable).
+        """
+        for var in sampling_plan:
+            self.samples[var] = var._sample_from_context(self)
+        return self.samples
+
+    def get_sampling_plan(self, root_variables, execution_plan):
+        """
+        Method. It returns the sub-list of an execution plan containing the variables that need to be sampled in order
+        to sample the root variables. Input values and observed values are leaves of the sampling graph.
+
+        Args:
+            root_variables: List of brancher.Variable.
+
+            execution_plan: List of brancher.Variable. A topological ordering containing the root variables and all the
+            variables that can be required for sampling them.
+
+        Returns:
+            List of brancher.Variable.
+        """
+        required_variables = set(root_variables)
+        for var in reversed(execution_plan):
+            if var in required_variables:
+                required_variables.update(var._get_sampling_parents(self))
+        return [var for var in execution_plan if var in required_variables]
+
+
+class MinibatchPrefetcher(object):
+    """
+    MinibatchPrefetcher samples the observed variables of a model in a background thread and stores the samples in a
+    bounded queue, so that minibatches are gathered while the main thread evaluates the loss and its gradient.
+
+    Parameters
+    ----------
+    model : brancher.ProbabilisticModel. The observed submodel to be sampled.
+
+    queue_size : Int. The maximum number of prefetched minibatches.
+    """
+    def __init__(self, model, queue_size=2):
+        self.model = model
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                samples = self.model._get_sample(1, observed=True)
+            except Exception as error:
+                samples = error
+            while not self._stop_event.is_set():
+                try:
+                    self.queue.put(samples, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(samples, Exception):
+                return
+
+    def get(self):
+        """
+        Method. It returns the next prefetched sample of the observed variables.
+
+        Returns:
+            Dictionary(brancher.Variable: chainer.Variable).
+        """
+        samples = self.queue.get()
+        if isinstance(samples, Exception):
+            raise samples
+        return samples
+
+    def stop(self):
+        """
+        Method. It stops the background thread and discards the prefetched samples.
+        """
+        self._stop_event.set()
+        self._thread.join()
+
+
+class NormalWeights(object):
+    """
+    NormalWeights replaces the samples of a normally distributed weight matrix that is only used as the left operand
+    of BF.matmul. The weights are never sampled: BF.matmul samples its output directly from the normal distribution
+    implied by the distribution of the weights (local reparameterization trick), with independent noise for every sample
+    and datapoint.
+
+    Parameters
+    ----------
+    mu : chainer.Variable. The mean of the weights, with shape (1, 1, output_dim, input_dim).
+
+    sigma : chainer.Variable. The standard deviation of the weights, with shape (1, 1, output_dim, input_dim).
+
+    number_samples : Int.
+    """
+    def __init__(self, mu, sigma, number_samples):
+        mu, sigma = F.broadcast(mu, sigma)
+        self.mu = F.reshape(mu, shape=mu.shape[2:])
+        self.sigma = F.reshape(sigma, shape=sigma.shape[2:])
+        self.number_samples = number_samples
+        self.shape = (number_samples, 1) + self.mu.shape
+
+    def matmul(self, x):
+        """
+        Method. It samples the product between the weights and a batch of matrices.
+
+        Args:
+            x: chainer.Variable. An array with shape (batch_size, input_dim, number_columns).
+
+        Returns:
+            chainer.Variable. An array with shape (batch_size, output_dim, number_columns).
+        """
+        if x.ndim != 3:
+            raise ValueError("The local reparameterization requires the right operand of matmul to be a batch of matrices")
+        batch_size, input_dim, number_columns = x.shape
+        flat_x = F.reshape(F.transpose(x, axes=(0, 2, 1)), shape=(batch_size*number_columns, input_dim))
+        mean = F.linear(flat_x, self.mu)
+        variance = F.linear(flat_x**2, self.sigma**2)
+        noise = np.random.normal(0, 1, size=mean.shape).astype(mean.dtype)
+        sample = mean + F.sqrt(variance + 1e-8)*noise
+        return F.transpose(F.reshape(sample, shape=(batch_size, number_columns, -1)), axes=(0, 2, 1))
+
+
+class Plate(object):
+    """
+    Plate declares a named axis of conditionally independent copies of a variable. A variable constructed with a plate
+    stores all its copies in a single tensor of shape (number_samples, number_datapoints, size, ...), e.g.
+    (number_samples, number_datapoints, size, 1, 1) for scalar copies, and it evaluates all of them with one vectorized
+    call of its distribution.
+
+    Parameters
+    ----------
+    name : String. The name of the axis.
+
+    size : Int. The number of copies.
+    """
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    def __repr__(self):
+        return "Plate({}, {})".format(self.name, self.size)
+
+    def expand_value(self, value):
+        """
+        Method. It returns a numeric parameter with one value for each copy. Arrays whose leading axis has the size of
+        the plate are interpreted as already containing one value per copy; other values are shared among the copies.
+
+        Args:
+            value: Numeric or np.ndarray.
+
+        Returns:
+            np.ndarray.
+        """
+        value = np.array(value)
+        if value.ndim == 0:
+            value = np.reshape(value, newshape=(1, 1))
+        elif value.shape[0] == self.size:
+            return np.reshape(value, newshape=value.shape + tuple([1, 1])) if value.ndim == 1 else value
+        return np.broadcast_to(value, shape=(self.size,) + value.shape).copy()
+
+    def expand_observation(self, data):
+        """
+        Method. It reshapes observed data so that the plate axis follows the datapoints axis. Data whose second axis
+        has the size of the plate contain one datapoint per entry of their leading axis, data whose leading axis has
+        the size of the plate are a single datapoint. Scalar copies get two trailing singleton axes and vector copies
+        get one, as for variables without a plate.
+
+        Args:
+            data: np.ndarray or chainer.Variable.
+
+        Returns:
+            np.ndarray or chainer.Variable. An array with shape (number_datapoints, size, ...).
+        """
+        shape = data.shape
+        if len(shape) > 1 and shape[1] == self.size:
+            new_shape = shape
+        elif len(shape) > 0 and shape[0] == self.size:
+            new_shape = (1,) + shape
+        else:
+            raise ValueError("The observed data of shape {} do not match the size {} of the plate {}".format(shape,
+                                                                                                             self.size,
+                                                                                                             self.name))
+        if len(new_shape) == 2:
+            new_shape = new_shape + tuple([1, 1])
+        elif len(new_shape) == 3:
+            new_shape = new_shape + tuple([1])
+        if isinstance(data, chainer.Variable):
+            return F.reshape(data, shape=new_shape)
+        return np.reshape(data, newshape=new_shape)
+
+    def broadcast(self, value):
+        """
+        Method. It adds the plate axis to the value of a parameter that is shared among the copies.
+
+        Args:
+            value: chainer.Variable. An array with shape (number_samples*number_datapoints, ...).
+
+        Returns:
+            chainer.Variable. An array with shape (number_samples*number_datapoints, size, ...).
+        """
+        return F.broadcast_to(F.expand_dims(value, axis=1), shape=(value.shape[0], self.size) + value.shape[1:])
+
+
 class BrancherClass(ABC):
     """
     BrancherClass is the abstract superclass of all Brancher variables and models.
     """
+    _structure_version = 0
+
+    @staticmethod
+    def _update_structure_version():
+        """
+        Static method. It signals that the structure of the graph has changed (e.g. a variable has been observed) so that
+        the compiled models get recompiled before their next use.
+
+        Args: None.
+
+        Returns: None.
+        """
+        BrancherClass._structure_version += 1
+
     @abstractmethod
     def _flatten(self):
         """
@@ -44,6 +305,18 @@ class BrancherClass(ABC):
     def flatten(self):
         return set(self._flatten())
 
+    def _get_variable_index(self):
+        """
+        Method. It returns a dictionary mapping the names of the variables in the model to the variables. If several
+        variables share a name, the one that comes last in the flattened list is returned.
+
+        Args: None.
+
+        Returns:
+            Dictionary(String: brancher.Variable).
+        """
+        return {var.name: var for var in self._flatten()}
+
     def get_variable(self, var_name):
         """
         It returns the variable in the model with the requested name.
@@ -55,11 +328,10 @@ class BrancherClass(ABC):
             brancher.Variable.
 
         """
-        flat_list = self._flatten()
         try:
-            return {var.name: var for var in flat_list}[var_name]
-        except ValueError:
-            raise ValueError("The variable {} is not present in the model".format(var_name))
+            return self._get_variable_index()[var_name]
+        except KeyError:
+            raise KeyError("The variable {} is not present in the model".format(var_name))
 
 
 class Variable(BrancherClass):
@@ -67,6 +339,8 @@ class Variable(BrancherClass):
     Variable is the abstract superclass of deterministic and random variables. Variables are the building blocks of
     all probabilistic models in Brancher.
     """
+    plate = None
+
     @abstractmethod
     def calculate_log_probability(self, values, reevaluate):
         """
@@ -77,8 +351,8 @@ class Variable(BrancherClass):
             model as keys and chainer.Variables as values. This dictionary has to provide values for all variables of
             the model except for the deterministic variables.
 
-            reevaluate: Bool. If false it returns the output of the latest call. It avoid unnecessary computations when
-            multiple children variables ask for the log probability of the same paternt variable.
+            reevaluate: Bool. Kept for backward compatibility. Implementations evaluate each factor of the model
+            exactly once per call, so the flag has no effect.
 
         Returns:
             chainer.Variable. the log probability of the input values given the model.
@@ -95,9 +369,7 @@ class Variable(BrancherClass):
         Args:
             number_samples: Int.
 
-            resample: Bool. If true it returns its previously stored sampled. It is used when multiple children variables
-            ask for a sample to the same parent. In this case the resample variable is False since the children should be
-            fed with the same value of the parent.
+            resample: Bool. Unused. Every variable is sampled once per call and shared by all its children.
 
             observed: Bool. It specifies whether the samples should be interpreted frequentistically as samples from the
             observations of as Bayesian samples from the prior model. The first batch dimension is reserved to Bayesian
@@ -121,14 +393,51 @@ class Variable(BrancherClass):
         raw_sample = {self: self._get_sample(number_samples, resample=False,
                                              observed=self.is_observed, input_values=reformatted_input_values)[self]}
         sample = reformat_sample_to_pandas(raw_sample, number_samples)
-        self.reset()
         return sample
 
+    @abstractmethod
+    def _get_sampling_parents(self, context):
+        """
+        Abstract method. It returns the variables whose samples are required in order to sample the variable.
+
+        Args:
+            context: brancher.EvaluationContext.
+
+        Returns:
+            Iterable of brancher.Variable.
+        """
+        pass
+
+    @abstractmethod
+    def _sample_from_context(self, context):
+        """
+        Abstract method. It returns a sample of the variable given the samples of the variables returned by
+        _get_sampling_parents, which have to be already stored in the context. It does not recurse over the graph.
+
+        Args:
+            context: brancher.EvaluationContext.
+
+        Returns:
+            chainer.Variable.
+        """
+        pass
+
+    def _get_graph_parents(self):
+        """
+        Method. It returns all the variables that can be used as sampling parents of the variable. It is used for
+        compiling probabilistic models.
+
+        Args: None.
+
+        Returns: Tuple of brancher.Variable.
+        """
+        return tuple(self.parents)
+
     @abstractmethod
     def reset(self):
         """
-        Abstract method. It recursively reset the self._evalueted and self._current_value attributes of the variable and
-        all downstream variables. It is used after sampling and evaluating the log probability of a model.
+        Abstract method. It resets the values explicitly assigned to the variable and to all its ancestors. Sampling and
+        evaluating the log probability do not modify the variables, so it does not need to be called after them.
 
         Args: None.
 
@@ -172,11 +481,13 @@ class Variable(BrancherClass):
 
         Returns: PartialLink
         """
+        matmul_weights = set()
         if isinstance(other, PartialLink):
             vars = other.vars
             vars.add(self)
             fn = lambda values: op(values[self], other.fn(values))
             links = other.links
+            matmul_weights = other.matmul_weights - {self}
         elif isinstance(other, Variable):
             vars = {self, other}
             fn = lambda values: op(values[self], values[other])
@@ -188,7 +499,7 @@ class Variable(BrancherClass):
         else:
             raise TypeError('') #TODO
 
-        return PartialLink(vars=vars, fn=fn, links=links)
+        return PartialLink(vars=vars, fn=fn, links=links, matmul_weights=matmul_weights)
 
     def __add__(self, other):
         return self._apply_operator(other, operator.add)
@@ -277,8 +588,7 @@ class DeterministicVariable(Variable):
             model as keys and chainer.Variables as values. This dictionary has to provide values for all variables of
             the model except for the deterministic variables.
 
-            reevaluate: Bool. If false it returns the output of the latest call. It avoid unnecessary computations when
-            multiple children variables ask for the log probability of the same paternt variable.
+            reevaluate: Bool. Unused.
 
         Returns:
             chainer.Variable. the log probability of the input values given the model.
@@ -300,15 +610,22 @@ class DeterministicVariable(Variable):
     def is_observed(self):
         return self._observed
 
-    def _get_sample(self, number_samples, resample=False, observed=False, input_values={}):
-        if self in input_values:
-            value = input_values[self]
+    def _get_sampling_parents(self, context):
+        return ()
+
+    def _sample_from_context(self, context):
+        if self in context.input_values:
+            value = context.input_values[self]
         else:
             value = self.value
         if isinstance(value, chainer.Variable):
-            return {self: tile_parameter(value, number_samples=number_samples)}
+            return tile_parameter(value, number_samples=context.number_samples)
         else:
-            return {self: value} #TODO: This is for allowing discrete data, temporary? (for Julia)
+            return value #TODO: This is for allowing discrete data, temporary? (for Julia)
+
+    def _get_sample(self, number_samples, resample=False, observed=False, input_values={}):
+        context = EvaluationContext(number_samples=number_samples, observed=observed, input_values=input_values)
+        return {self: self._sample_from_context(context)}
 
     def reset(self):
         pass
@@ -332,15 +649,20 @@ class RandomVariable(Variable):
     link : callable
         Summary
     """
+    _flattened_variables = None
+    _variable_index = None
+    _cache_version = None
+    _matmul_weights = set()
+    dataset_size = None
+    gradient_estimator = None  # Set by stochastic_variational_inference (see brancher.gradient_estimators)
+
     def __init__(self, distribution, name, parents, link):
         self.name = name
         self.distribution = distribution
         self.link = link
         self.parents = parents
         self._type = "Random"
-        self.samples = []
 
-        self._evaluated = False
         self._observed = False
         self._observed_value = None
         self._current_value = None
@@ -366,7 +688,10 @@ class RandomVariable(Variable):
         cont_values, discrete_values = split_dict(parents_values,
                                                   condition=lambda key, val: isinstance(val, chainer.Variable))
         if cont_values:
-            reshaped_dict, number_samples, number_datapoints = broadcast_parent_values(cont_values)
+            number_weight_samples = max([val.number_samples for val in discrete_values.values()
+                                         if isinstance(val, NormalWeights)] + [1])
+            reshaped_dict, number_samples, number_datapoints = broadcast_parent_values(cont_values,
+                                                                                       number_samples=number_weight_samples)
             reshaped_dict.update(discrete_values)
         else:
             reshaped_dict = discrete_values
@@ -379,72 +704,127 @@ class RandomVariable(Variable):
     def calculate_log_probability(self, input_values, reevaluate=True, for_gradient=False,
                                   include_parents=True, normalized=True):
         """
-        Method. It returns the log probability of the values given the model. This value is always 0 since the probability
-        of a deterministic variable having its value is always 1.
+        Method. It returns the log probability of the values given the model. The factors of the variable and of all
+        its ancestors are evaluated once each, without recursion, and summed with a single broadcasted reduction.
 
         Args:
             values: Dictionary(brancher.Variable: chainer.Variable). A dictionary having the brancher.variables of the
             model as keys and chainer.Variables as values. This dictionary has to provide values for all variables of
             the model except for the deterministic variables.
 
-            reevaluate: Bool. If false it returns the output of the latest call. It avoid unnecessary computations when
-            multiple children variables ask for the log probability of the same paternt variable.
+            reevaluate: Bool. Unused. Every factor is always evaluated exactly once.
+
+            include_parents: Bool. If false it only returns the log probability factor of the variable itself.
 
         Returns:
             chainer.Variable. the log probability of the input values given the model.
 
         """
-        if self._evaluated and not reevaluate:
-            return 0.
+        context = EvaluationContext(input_values=input_values, for_gradient=for_gradient, normalized=normalized)
+        if not include_parents:
+            return self._calculate_log_probability_factor(context)
+        return broadcast_sum([var._calculate_log_probability_factor(context)
+                              for var in self._flatten() if isinstance(var, RandomVariable)])
+
+    def _calculate_log_probability_factor(self, context):
+        """
+        Method. It returns the log probability of the value of the variable given the values of its parents, without
+        including the log probability of the parents.
+
+        Args:
+            context: brancher.EvaluationContext. Its input values have to provide the values of the variable (if not
+            observed) and of all its random parents.
+
+        Returns:
+            chainer.Variable.
+        """
+        input_values = context.input_values
         if self in input_values:
             value = input_values[self]
         else:
             value = self.value
-
-        self._evaluated = True
-        deterministic_parents_values = {parent: parent.value for parent in self.parents
-                                        if (type(parent) is DeterministicVariable)}
-        parents_input_values = {parent: parent_input for parent, parent_input in input_values.items() if parent in self.parents}
-        parents_values = {**parents_input_values, **deterministic_parents_values}
+        parents_values = {parent: parent.value if type(parent) is DeterministicVariable else input_values[parent]
+                          for parent in self.parents
+                          if type(parent) is DeterministicVariable or parent in input_values}
         parameters_dict = self._apply_link(parents_values)
         log_probability = self.distribution.calculate_log_probability(value, **parameters_dict)
-        parents_log_probability = sum([parent.calculate_log_probability(input_values, reevaluate, for_gradient,
-                                                                        normalized=normalized)
-                                       for parent in self.parents])
         if self.is_observed:
             log_probability = F.sum(log_probability, axis=1, keepdims=True)
-        if type(log_probability) is chainer.Variable and type(parents_log_probability) is chainer.Variable:
-            log_probability, parents_log_probability = partial_broadcast(log_probability, parents_log_probability)
-        if include_parents:
-            return log_probability + parents_log_probability
+            if self.has_random_dataset and self.dataset.dataset_size is not None:
+                log_probability = self._get_subsampling_scale(value)*log_probability
+        return log_probability
+
+    def _get_deterministic_parameters(self):
+        """
+        Method. It returns the parameters of the distribution of a variable whose parents are all deterministic.
+
+        Returns:
+            Dictionary(String: chainer.Variable).
+        """
+        return self._apply_link({parent: parent.value for parent in self.parents})
+
+    def _get_subsampling_scale(self, value):
+        """
+        Method. It returns the ratio between the size of the dataset of the variable and the number of datapoints in
+        the observed minibatch. Multiplying the log likelihood of the minibatch by this ratio gives an unbiased estimate
+        of the log likelihood of the whole dataset.
+
+        Args:
+            value: chainer.Variable or List. The observed minibatch.
+
+        Returns:
+            Float.
+        """
+        if isinstance(value, chainer.Variable):
+            batch_size = value.shape[1]
         else:
-            return log_probability
+            batch_size = len(value)
+        return self.dataset.dataset_size/float(batch_size)
 
     def _get_sample(self, number_samples=1, resample=True, observed=False, input_values={}):
         """
         Summary
         """
-        if self.samples and not resample:
-            return {self: self.samples[-1]}
-        if not observed:
-            if self in input_values:
-                return {self: input_values[self]}
+        context = EvaluationContext(number_samples=number_samples, observed=observed, input_values=input_values)
+        execution_plan = topological_sort([self], get_parents=lambda var: var._get_graph_parents())
+        return context.sample(context.get_sampling_plan([self], execution_plan))
+
+    def _get_graph_parents(self):
+        if self.has_random_dataset:
+            return tuple(self.parents) + tuple(self.dataset.parents)
+        return tuple(self.parents)
+
+    def _get_sampling_parents(self, context):
+        if not context.observed:
+            if self in context.input_values:
+                return ()
+            return self.parents
+        else:
+            if self.has_observed_value:
+                return ()
+            elif self.has_random_dataset:
+                return self.dataset.parents
+            return self.parents
+
+    def _sample_from_context(self, context):
+        if not context.observed:
+            if self in context.input_values:
+                return context.input_values[self]
             else:
                 var_to_sample = self
         else:
             if self.has_observed_value:
-                return {self: self._observed_value}
+                return self._observed_value
             elif self.has_random_dataset:
                 var_to_sample = self.dataset
             else:
                 var_to_sample = self
-        parents_samples_dict = join_dicts_list([parent._get_sample(number_samples, resample, observed, input_values)
-                                                for parent in var_to_sample.parents])
-        input_dict = {parent: parents_samples_dict[parent] for parent in var_to_sample.parents}
+        input_dict = {parent: context.samples[parent] for parent in var_to_sample.parents}
         parameters_dict = var_to_sample._apply_link(input_dict)
-        sample = var_to_sample.distribution.get_sample(**parameters_dict, number_samples=number_samples)
-        self.samples = [sample] #TODO: to fix
-        return {**parents_samples_dict, self: sample}
+        if var_to_sample.gradient_estimator is not None:
+            return var_to_sample.gradient_estimator.get_sample(var_to_sample.distribution, parameters_dict,
+                                                               context.number_samples)
+        return var_to_sample.distribution.get_sample(**parameters_dict, number_samples=context.number_samples)
 
     def observe(self, data, random_indices=()):
         """
@@ -455,9 +835,12 @@ class RandomVariable(Variable):
             self.dataset = data
             self.has_random_dataset = True
         else:
+            if self.plate is not None:
+                data = self.plate.expand_observation(data if isinstance(data, chainer.Variable) else np.array(data))
             self._observed_value = coerce_to_dtype(data, is_observed=True)
             self.has_observed_value = True
         self._observed = True
+        self._update_structure_version()
 
     def unobserve(self):
         self._observed = False
@@ -465,19 +848,37 @@ class RandomVariable(Variable):
         self.has_random_dataset = False
         self._observed_value = None
         self.dataset = None
+        self._update_structure_version()
 
     def reset(self):
         """
         Summary
         """
-        self.samples = []
-        self._evaluated = False
-        self._current_value = None
-        for parent in self.parents:
-            parent.reset()
+        for var in self._flatten():
+            if isinstance(var, RandomVariable):
+                var._current_value = None
 
     def _flatten(self):
-        return flatten_list([parent._flatten() for parent in self.parents]) + [self]
+        """
+        Method. It returns the variable and all its ancestors without duplicates, every variable after its parents. The
+        list is cached and it is recomputed whenever the structure of the graph changes.
+        """
+        self._validate_caches()
+        if self._flattened_variables is None:
+            self._flattened_variables = topological_sort([self], get_parents=lambda var: var.parents)
+        return list(self._flattened_variables)
+
+    def _get_variable_index(self):
+        self._validate_caches()
+        if self._variable_index is None:
+            self._variable_index = get_name_index([self], get_parents=lambda var: var.parents)
+        return self._variable_index
+
+    def _validate_caches(self):
+        if self._cache_version != BrancherClass._structure_version:
+            self._flattened_variables = None
+            self._variable_index = None
+            self._cache_version = BrancherClass._structure_version
 
 
 class ProbabilisticModel(BrancherClass):
@@ -489,9 +890,12 @@ class ProbabilisticModel(BrancherClass):
     variables : tuple of brancher variables
         Summary
     """
+    _prefetcher = None
+    is_truncated = False
+
     def __init__(self, variables):
         self.variables = self._validate_variables(variables)
-        self._set_summary()
+        self._compiled_version = None
         self.posterior_model = None
         self.posterior_sampler = None
         self.observed_submodel = None
@@ -543,6 +947,147 @@ class ProbabilisticModel(BrancherClass):
     def is_observed(self):
         return all([var.is_observed for var in self._flatten()])
 
+    def compile(self):
+        """
+        Method. It computes a topological ordering of all the variables of the model and caches it. Sampling and
+        log-probability evaluation loop over this ordering instead of recursively walking the graph. The model is compiled
+        automatically when needed and it is recompiled whenever the structure of the graph changes (e.g. when a variable
+        is observed). The index of the variable names keeps the resolution of duplicated names of the recursive
+        flattening (see brancher.utilities.get_name_index).
+
+        Args: None.
+
+        Returns: brancher.ProbabilisticModel. The compiled model.
+        """
+        structure_version = BrancherClass._structure_version
+        root_variables = self._get_root_variables()
+        self._root_variables = root_variables
+        self._variable_order = topological_sort(root_variables, get_parents=lambda var: var.parents)
+        self._variable_index = get_name_index(root_variables, get_parents=lambda var: var.parents)
+        self._execution_plan = topological_sort(root_variables, get_parents=lambda var: var._get_graph_parents())
+        self._sampling_plans = {}
+        self._model_mappings = {}
+        self._analytic_kl_pairs = {}
+        self._local_reparameterization_pairs = {}
+        self._compiled_version = structure_version
+        return self
+
+    def _get_root_variables(self):
+        root_variables = []
+        for var in self.variables:
+            if isinstance(var, ProbabilisticModel):
+                root_variables.extend(var._get_root_variables())
+            else:
+                root_variables.append(var)
+        return root_variables
+
+    @property
+    def is_compiled(self):
+        return self._compiled_version == BrancherClass._structure_version
+
+    def _get_execution_plan(self):
+        if not self.is_compiled:
+            self.compile()
+        return self._execution_plan
+
+    def _get_sampling_plan(self, context):
+        """
+        Method. It returns the sub-list of the execution plan containing the variables that need to be sampled. The
+        plans are cached for each set of input variables.
+
+        Args:
+            context: brancher.EvaluationContext.
+
+        Returns:
+            List of brancher.Variable.
+        """
+        execution_plan = self._get_execution_plan()
+        sampling_plans = self._sampling_plans
+        plan_key = (context.observed, frozenset(context.input_values))
+        if plan_key not in sampling_plans:
+            sampling_plans[plan_key] = context.get_sampling_plan(self._root_variables, execution_plan)
+        return sampling_plans[plan_key]
+
+    def _get_model_mapping(self, source_model):
+        """
+        Method. It returns the mapping from the variables of the source model to the variables of the model with the same
+        name. The mapping is computed once for each source model and it is recomputed when the graph structure changes.
+
+        Args:
+            source_model: brancher.ProbabilisticModel.
+
+        Returns:
+            Dictionary(brancher.Variable: brancher.Variable).
+        """
+        if not self.is_compiled:
+            self.compile()
+        model_mappings = self._model_mappings
+        if source_model not in model_mappings:
+            model_mappings[source_model] = get_model_mapping(source_model, self)
+        return model_mappings[source_model]
+
+    def _get_analytic_kl_pairs(self, q_model):
+        """
+        Method. It returns the pairs of posterior and model variables whose KL divergence can be computed in closed
+        form. Both variables need to have only deterministic parents and their distributions need to have a registered
+        KL divergence. Truncated posterior models (see brancher.transformations.truncate_model) have no closed-form
+        KL divergence and give no pairs.
+
+        Args:
+            q_model: brancher.ProbabilisticModel. The posterior model.
+
+        Returns:
+            List of tuples (brancher.RandomVariable, brancher.RandomVariable).
+        """
+        if not self.is_compiled:
+            self.compile()
+        analytic_kl_pairs = self._analytic_kl_pairs
+        if q_model.is_truncated:
+            return []
+        if q_model not in analytic_kl_pairs:
+            model_mapping = self._get_model_mapping(q_model)
+            analytic_kl_pairs[q_model] = [(q_var, p_var) for q_var, p_var in model_mapping.items()
+                                          if isinstance(q_var, RandomVariable) and isinstance(p_var, RandomVariable)
+                                          and not p_var.is_observed
+                                          and all([type(parent) is DeterministicVariable for parent in q_var.parents])
+                                          and all([type(parent) is DeterministicVariable for parent in p_var.parents])
+                                          and distributions.has_analytic_kl_divergence(q_var.distribution,
+                                                                                       p_var.distribution)]
+        return analytic_kl_pairs[q_model]
+
+    def _get_local_reparameterization_pairs(self, q_model):
+        """
+        Method. It returns the pairs of posterior and model variables whose samples can be replaced by NormalWeights.
+        The two variables need to be normal with deterministic parents, the posterior variable cannot have children in
+        the posterior model and the model variable has to be used by its children only as left operand of BF.matmul.
+
+        Args:
+            q_model: brancher.ProbabilisticModel. The posterior model.
+
+        Returns:
+            List of tuples (brancher.RandomVariable, brancher.RandomVariable).
+        """
+        if not self.is_compiled:
+            self.compile()
+        local_reparameterization_pairs = self._local_reparameterization_pairs
+        if q_model not in local_reparameterization_pairs:
+            model_variables = self._flatten()
+            q_variables = q_model._flatten()
+            local_reparameterization_pairs[q_model] = [(q_var, p_var) for q_var, p_var in self._get_analytic_kl_pairs(q_model)
+                                                       if type(q_var.distribution) is distributions.NormalDistribution
+                                                       and type(p_var.distribution) is distributions.NormalDistribution
+                                                       and q_var._get_deterministic_parameters()["mu"].shape[:2] == (1, 1)
+                                                       and q_var._get_deterministic_parameters()["sigma"].shape[:2] == (1, 1)
+                                                       and not any([q_var in var.parents for var in q_variables])
+                                                       and self._is_matmul_weight(p_var, model_variables)]
+        return local_reparameterization_pairs[q_model]
+
+    @staticmethod
+    def _is_matmul_weight(variable, model_variables):
+        children = [var for var in model_variables if variable in var.parents]
+        return bool(children) and all([isinstance(child, RandomVariable) and variable in child._matmul_weights
+                                       for child in children])
+
     def update_observed_submodel(self):
         """
         Summary
@@ -550,10 +1095,42 @@ class ProbabilisticModel(BrancherClass):
         Parameters
         ---------
         """
+        self.stop_prefetching()
         flattened_model = self._flatten()
         observed_variables = [var for var in flattened_model if var.is_observed]
         self.observed_submodel = ProbabilisticModel(observed_variables)
 
+    def start_prefetching(self, queue_size=2):
+        """
+        Method. It starts sampling the observed submodel in a background thread. Until stop_prefetching is called, the
+        samples of the observed variables used by get_importance_weights and estimate_log_model_evidence are taken from
+        a queue of at most queue_size prefetched minibatches.
+
+        Args:
+            queue_size: Int. The maximum number of prefetched minibatches.
+
+        Returns:
+            None
+        """
+        self.stop_prefetching()
+        self._prefetcher = MinibatchPrefetcher(self.observed_submodel, queue_size=queue_size)
+
+    def stop_prefetching(self):
+        """
+        Method. It stops the background sampling of the observed submodel.
+
+        Returns:
+            None
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+            self._prefetcher = None
+
+    def _get_empirical_samples(self):
+        if self._prefetcher is not None:
+            return self._prefetcher.get()
+        return self.observed_submodel._get_sample(1, observed=True)
+
     def set_posterior_model(self, model, sampler=None): #TODO: Clean up code duplication
         self.posterior_model = PosteriorModel(posterior_model=model, joint_model=self)
         if sampler:
@@ -571,24 +1148,45 @@ class ProbabilisticModel(BrancherClass):
 
     def calculate_log_probability(self, rv_values, for_gradient=False, normalized=True):
         """
-        Summary
+        Method. It returns the joint log probability of the values. The log probability factors of all the random
+        variables of the model are evaluated once and summed with a single broadcasted reduction.
+
+        Args:
+            rv_values: Dictionary(brancher.Variable: chainer.Variable). It has to provide the values of all the random
+            variables of the model that are not observed.
+
+        Returns:
+            chainer.Variable.
         """
-        log_probability = sum([var.calculate_log_probability(rv_values, reevaluate=False,
-                                                             for_gradient=for_gradient,
-                                                             normalized=normalized)
-                               for var in self.variables])
-        self.reset()
-        return log_probability
+        log_probability_terms = self.calculate_log_probability_terms(rv_values, for_gradient=for_gradient,
+                                                                     normalized=normalized)
+        return broadcast_sum(list(log_probability_terms.values()))
+
+    def calculate_log_probability_terms(self, rv_values, for_gradient=False, normalized=True, excluded_variables=()):
+        """
+        Method. It returns the log probability factor of each random variable of the model given the values of its
+        parents. The variables are visited once following the compiled topological ordering.
+
+        Args:
+            rv_values: Dictionary(brancher.Variable: chainer.Variable). It has to provide the values of all the random
+            variables of the model that are not observed.
+
+            excluded_variables: Iterable of brancher.RandomVariable. Variables whose factor is not evaluated.
+
+        Returns:
+            Dictionary(brancher.RandomVariable: chainer.Variable).
+        """
+        context = EvaluationContext(input_values=rv_values, for_gradient=for_gradient, normalized=normalized)
+        return {var: var._calculate_log_probability_factor(context)
+                for var in self._flatten() if isinstance(var, RandomVariable) and var not in excluded_variables}
 
     def _get_sample(self, number_samples, observed=False, input_values={}):
         """
         Summary
         """
-        joint_sample = join_dicts_list([var._get_sample(number_samples=number_samples, resample=False,
-                                                        observed=observed, input_values=input_values)
-                                        for var in self.variables])
+        context = EvaluationContext(number_samples=number_samples, observed=observed, input_values=input_values)
+        joint_sample = context.sample(self._get_sampling_plan(context))
         joint_sample.update(input_values)
-        self.reset()
         return joint_sample
 
     def get_sample(self, number_samples, input_values={}):
@@ -628,7 +1226,7 @@ class ProbabilisticModel(BrancherClass):
                                       for_gradient=False, normalized=True):  #TODO: Work in progress
         q_log_prob = q_model.calculate_log_probability(q_samples,
                                                        for_gradient=for_gradient, normalized=normalized)
-        p_samples = reassign_samples(q_samples, source_model=q_model, target_model=self)
+        p_samples = reassign_samples(q_samples, model_mapping=self._get_model_mapping(q_model))
         p_samples.update(empirical_samples)
         p_log_prob = self.calculate_log_probability(p_samples, for_gradient=for_gradient, normalized=normalized)
         return q_log_prob, p_log_prob
@@ -636,7 +1234,7 @@ class ProbabilisticModel(BrancherClass):
     def get_importance_weights(self, q_samples, q_model, empirical_samples={},
                                for_gradient=False, give_normalization=False):
         if not empirical_samples:
-            empirical_samples = self.observed_submodel._get_sample(1, observed=True)
+            empirical_samples = self._get_empirical_samples()
         q_log_prob, p_log_prob = self.get_p_and_q_log_probabilities(q_samples=q_samples,
                                                                     q_model=q_model,
                                                                     empirical_samples=empirical_samples,
@@ -653,19 +1251,94 @@ class ProbabilisticModel(BrancherClass):
         else:
             return weights, norm*np.exp(alpha)
 
-    def estimate_log_model_evidence(self, number_samples, method="ELBO", input_values={}, for_gradient=False, posterior_model=()):
+    def estimate_log_model_evidence(self, number_samples, method="ELBO", input_values={}, for_gradient=False,
+                                    posterior_model=(), analytic_kl=False, local_reparameterization=False,
+                                    enumerate_discrete=False, max_enumeration_size=64):
+        """
+        Method. It estimates the log model evidence using the posterior model.
+
+        Args:
+            analytic_kl: Bool. If true, the Monte Carlo estimates of the log probability of the posterior and model
+            variables that have deterministic parents and a closed-form KL divergence are replaced by the exact
+            KL divergence. Only the remaining terms are estimated by sampling.
+
+            local_reparameterization: Bool. If true, the normal weights that are only used as left operand of BF.matmul
+            are not sampled and the output of the matrix multiplication is sampled instead (see NormalWeights). The KL
+            divergence of these weights is always computed in closed form.
+
+            enumerate_discrete: Bool. If true, the discrete latent variables with a finite support (see
+            brancher.enumeration_tools.ENUMERABLE_SUPPORTS) are summed out exactly instead of being sampled from the
+            posterior model. Their posterior variables, if any, are ignored.
+
+            max_enumeration_size: Int. Maximum number of joint values of the enumerated variables.
+
+        Returns:
+            chainer.Variable.
+        """
         if not posterior_model:
             self.check_posterior_model()
             posterior_model = self.posterior_model
         if method is "ELBO":
-            empirical_samples = self.observed_submodel._get_sample(1, observed=True) #TODO: You need to correct for subsampling
+            empirical_samples = self._get_empirical_samples()
+            if local_reparameterization:
+                local_reparameterization_pairs = self._get_local_reparameterization_pairs(posterior_model)
+                weights_values = {q_var: NormalWeights(number_samples=number_samples,
+                                                       **q_var._get_deterministic_parameters())
+                                  for q_var, _ in local_reparameterization_pairs}
+                if weights_values:
+                    input_values = dict(input_values)
+                    input_values.update(weights_values)
+            else:
+                local_reparameterization_pairs = []
             posterior_samples = posterior_model._get_sample(number_samples=number_samples,
                                                             observed=False, input_values=input_values)
-            posterior_log_prob, joint_log_prob = self.get_p_and_q_log_probabilities(q_samples=posterior_samples,
-                                                                                    empirical_samples=empirical_samples,
-                                                                                    for_gradient=for_gradient,
-                                                                                    q_model=posterior_model)
-            log_model_evidence = F.mean(joint_log_prob - posterior_log_prob)
+            if analytic_kl:
+                analytic_kl_pairs = self._get_analytic_kl_pairs(posterior_model)
+            else:
+                analytic_kl_pairs = local_reparameterization_pairs
+            p_samples = reassign_samples(posterior_samples, model_mapping=self._get_model_mapping(posterior_model))
+            p_samples.update(empirical_samples)
+            if enumerate_discrete:
+                random_variables = [var for var in self._flatten() if isinstance(var, RandomVariable)]
+                supports = enumeration_tools.get_enumerated_variables([var for var in random_variables
+                                                                       if not var.is_observed],
+                                                                      p_samples, max_enumeration_size)
+                enumerated_factors = enumeration_tools.get_enumerated_factors(random_variables, supports)
+                analytic_kl_pairs = [(q_var, p_var) for q_var, p_var in analytic_kl_pairs
+                                     if p_var not in enumerated_factors]
+                q_enumerated_vars = [q_var for q_var, p_var in self._get_model_mapping(posterior_model).items()
+                                     if p_var in supports]
+            else:
+                supports, enumerated_factors, q_enumerated_vars = {}, [], []
+            if not analytic_kl_pairs and not supports:
+                posterior_log_prob, joint_log_prob = self.get_p_and_q_log_probabilities(q_samples=posterior_samples,
+                                                                                        empirical_samples=empirical_samples,
+                                                                                        for_gradient=for_gradient,
+                                                                                        q_model=posterior_model)
+                elbo_samples = joint_log_prob - posterior_log_prob
+            else:
+                q_analytic_vars, p_analytic_vars = zip(*analytic_kl_pairs) if analytic_kl_pairs else ((), ())
+                q_terms = posterior_model.calculate_log_probability_terms(posterior_samples, for_gradient=for_gradient,
+                                                                          excluded_variables=(list(q_analytic_vars) +
+                                                                                              q_enumerated_vars))
+                p_terms = self.calculate_log_probability_terms(p_samples, for_gradient=for_gradient,
+                                                               excluded_variables=(list(p_analytic_vars) +
+                                                                                   enumerated_factors))
+                kl_terms = [-distributions.kl_divergence(q_var.distribution, p_var.distribution,
+                                                         q_var._get_deterministic_parameters(),
+                                                         p_var._get_deterministic_parameters())
+                            for q_var, p_var in analytic_kl_pairs]
+                elbo_terms = list(p_terms.values()) + [-term for term in q_terms.values()] + kl_terms
+                if supports:
+                    elbo_terms.append(enumeration_tools.get_enumerated_log_probability(self, enumerated_factors,
+                                                                                      supports, p_samples,
+                                                                                      number_samples, for_gradient))
+                elbo_samples = broadcast_sum(elbo_terms)
+            surrogate_terms = [var.gradient_estimator.get_surrogate_term(var, elbo_samples, posterior_samples)
+                               for var in posterior_model._flatten()
+                               if isinstance(var, RandomVariable) and var.gradient_estimator is not None
+                               and var not in q_enumerated_vars]
+            log_model_evidence = F.mean(elbo_samples) + sum(surrogate_terms)
             return log_model_evidence
         else:
             raise NotImplementedError("The requested estimation method is currently not implemented.")
@@ -674,11 +1347,19 @@ class ProbabilisticModel(BrancherClass):
         """
         Summary
         """
-        for variable in self.variables:
-            variable.reset()
+        for var in self._flatten():
+            if isinstance(var, RandomVariable):
+                var._current_value = None
 
     def _flatten(self):
-        return flatten_list([var._flatten() for var in self.variables])
+        if not self.is_compiled:
+            self.compile()
+        return list(self._variable_order)
+
+    def _get_variable_index(self):
+        if not self.is_compiled:
+            self.compile()
+        return self._variable_index
 
 
 class PosteriorModel(ProbabilisticModel):
@@ -721,18 +1402,30 @@ def var2link(var):
     return PartialLink(vars=vars, fn=fn, links=set())
 
 
+def join_matmul_weights(links):
+    """
+    It returns the variables that are used by a list of links only as left operand of BF.matmul.
+    """
+    links = [link for link in links if isinstance(link, PartialLink)]
+    matmul_weights = join_sets_list([set(link.matmul_weights) for link in links])
+    other_vars = join_sets_list([set(link.vars) - link.matmul_weights for link in links])
+    return matmul_weights - other_vars
+
+
 class PartialLink(BrancherClass): #TODO: This should become "ProbabilisticProgram?"
 
-    def __init__(self, vars, fn, links):
+    def __init__(self, vars, fn, links, matmul_weights=set()):
         self.vars = vars
         self.fn = fn
         self.links = links
+        self.matmul_weights = matmul_weights
 
     def _apply_operator(self, other, op):
         other = var2link(other)
         return PartialLink(vars=self.vars.union(other.vars),
                            fn=lambda values: op(self.fn(values), other.fn(values)),
-                           links=self.links.union(other.links))
+                           links=self.links.union(other.links),
+                           matmul_weights=join_matmul_weights([self, other]))
 
     def __add__(self, other):
         return self._apply_operator(other, operator.add)
@@ -779,7 +1472,8 @@ class PartialLink(BrancherClass): #TODO: This should become "ProbabilisticProgra
         links = set()
         return PartialLink(vars=vars,
                            fn=fn,
-                           links=self.links)
+                           links=self.links,
+                           matmul_weights=self.matmul_weights)
 
     def shape(self):
         vars = self.vars
@@ -787,7 +1481,8 @@ class PartialLink(BrancherClass): #TODO: This should become "ProbabilisticProgra
         links = set()
         return PartialLink(vars=vars,
                            fn=fn,
-                           links=self.links)
+                           links=self.links,
+                           matmul_weights=self.matmul_weights)
 
     def _flatten(self):
         return flatten_list([var._flatten() for var in self.vars]) + [self]
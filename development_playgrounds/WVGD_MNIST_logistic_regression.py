@@ -52,10 +52,10 @@ particles = [ProbabilisticModel([l]) for l in particle_locations]
 # Importance sampling distributions
 voranoi_set = VoronoiSet(particle_locations) #TODO: Bug if you use variables instead of probabilistic models
 variational_samplers = [ProbabilisticModel([TruncatedNormalVariable(mu=initial_location_1, sigma=0.1,
-                                                truncation_rule=lambda a: voranoi_set(a, 0),
+                                                truncation_rule=voranoi_set.get_truncation_rule(0),
                                                 name="weights", learnable=True)]),
                         ProbabilisticModel([TruncatedNormalVariable(mu=initial_location_2, sigma=0.1,
-                                                truncation_rule=lambda a: voranoi_set(a, 1),
+                                                truncation_rule=voranoi_set.get_truncation_rule(1),
                                                 name="weights", learnable=True)])]
 
 # Inference
@@ -4,6 +4,7 @@ from brancher.variables import ProbabilisticModel
 from brancher.standard_variables import NormalVariable, LogNormalVariable
 
 from brancher.transformations import truncate_model
+from brancher.utilities import vectorized_truncation_rule
 from brancher.visualizations import plot_density
 
 # Normal model
@@ -13,7 +14,7 @@ model = ProbabilisticModel([x])
 
 # decision rule
 model_statistics = lambda dic: dic[x].data
-truncation_rule = lambda a: ((a > 0.5) & (a < 0.6)) | ((a > -0.6) & (a < -0.5))
+truncation_rule = vectorized_truncation_rule(lambda a: ((a > 0.5) & (a < 0.6)) | ((a > -0.6) & (a < -0.5)))
 
 # Truncated model
 truncated_model = truncate_model(model, truncation_rule, model_statistics)
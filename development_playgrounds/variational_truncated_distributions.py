@@ -1,3 +1,4 @@
+import numpy as np
 import chainer
 import matplotlib.pyplot as plt
 
@@ -7,12 +8,12 @@ from brancher.standard_variables import NormalVariable, LogNormalVariable, Trunc
 from brancher.visualizations import plot_posterior
 
 # Model
-a = TruncatedNormalVariable(mu=0., sigma=2., truncation_rule=lambda x: x > 0, name="a")
+a = TruncatedNormalVariable(mu=0., sigma=2., lower=0., upper=np.inf, name="a")
 b = NormalVariable(mu=a, sigma=a**2, name="b")
 model = ProbabilisticModel([a, b])
 
 # Variational model
-Qa = TruncatedNormalVariable(mu=1., sigma=0.25, truncation_rule=lambda x: x > 0.1, name="a", learnable=True)
+Qa = TruncatedNormalVariable(mu=1., sigma=0.25, lower=0.1, upper=np.inf, name="a", learnable=True)
 variational_model = ProbabilisticModel([Qa])
 model.set_posterior_model(variational_model)
 
@@ -0,0 +1,90 @@
+import sys
+
+import numpy as np
+
+from context import brancher
+from brancher.variables import ProbabilisticModel
+from brancher.standard_variables import NormalVariable
+from brancher.utilities import get_model_mapping
+from brancher.transformations import truncate_model
+
+
+def _recursive_flatten(model):
+    if isinstance(model, ProbabilisticModel):
+        return [var for submodel in model.variables for var in _recursive_flatten(submodel)]
+    return [var for parent in model.parents for var in _recursive_flatten(parent)] + [model]
+
+
+def test_deep_chain_sampling_does_not_recurse():
+    length = 3*sys.getrecursionlimit()
+    chain = [NormalVariable(0., 1., "x0")]
+    for t in range(1, length):
+        chain.append(NormalVariable(chain[-1], 1., "x{}".format(t)))
+    model = ProbabilisticModel([chain[-1]])
+    sample = model._get_sample(number_samples=2)
+    assert all([var in sample for var in chain])
+    assert sample[chain[-1]].shape[0] == 2
+    assert model._flatten().index(chain[0]) < model._flatten().index(chain[-1])
+
+
+def test_compiled_plan_is_invalidated_by_observe_and_unobserve():
+    np.random.seed(0)
+    mu = NormalVariable(0., 1., "mu")
+    x = NormalVariable(mu, 1., "x")
+    model = ProbabilisticModel([x])
+    model.compile()
+    assert model.is_compiled
+    data = np.array([[10.]], dtype="float32")
+    x.observe(data)
+    assert not model.is_compiled
+    observed_sample = model._get_sample(number_samples=3, observed=True)[x].data
+    assert np.allclose(observed_sample, 10.)
+    assert model.is_compiled
+    x.unobserve()
+    assert not model.is_compiled
+    sample = model._get_sample(number_samples=3, observed=True)[x].data
+    assert not np.allclose(sample, 10.)
+
+
+def test_duplicated_names_resolve_as_the_recursive_flattening():
+    x0 = NormalVariable(0., 1., "x0")
+    y0 = NormalVariable(x0, 0.5, "x0")
+    x1 = NormalVariable(x0, 1., "x1")
+    y1 = NormalVariable(x1, 0.5, "y1")
+    model = ProbabilisticModel([x0, x1, y0, y1])
+    recursive_index = {var.name: var for var in _recursive_flatten(model)}
+    assert all([model.get_variable(name) is var for name, var in recursive_index.items()])
+    for variable in [x0, y0, x1, y1]:
+        assert variable._get_variable_index() == {var.name: var for var in _recursive_flatten(variable)}
+
+    posterior_x0 = NormalVariable(0., 1., "x0")
+    posterior_model = ProbabilisticModel([posterior_x0])
+    assert get_model_mapping(model, posterior_model)[recursive_index["x0"]] is posterior_x0
+    assert get_model_mapping(posterior_model, model)[posterior_x0] is recursive_index["x0"]
+
+    model = ProbabilisticModel([y0])
+    assert model.get_variable("x0") is y0
+
+
+def test_deep_chain_log_probability_does_not_recurse():
+    length = 3*sys.getrecursionlimit()
+    chain = [NormalVariable(0., 1., "x0")]
+    for t in range(1, length):
+        chain.append(NormalVariable(chain[-1], 1., "x{}".format(t)))
+    model = ProbabilisticModel([chain[-1]])
+    values = {var: np.zeros((1, 1, 1), dtype="float32") for var in chain}
+    log_probability = model.calculate_log_probability(values).data
+    assert np.allclose(log_probability, -0.5*length*np.log(2*np.pi), rtol=1e-4)
+    log_probability = chain[-1].calculate_log_probability(values).data
+    assert np.allclose(log_probability, -0.5*length*np.log(2*np.pi), rtol=1e-4)
+
+
+def test_truncated_model_does_not_share_compiled_caches():
+    x = NormalVariable(0., 1., "x")
+    model = ProbabilisticModel([x]).compile()
+    truncated_model = truncate_model(model, truncation_rule=lambda a: a > 0,
+                                     model_statistics=lambda sample: sample[x].data)
+    assert not truncated_model.is_compiled
+    truncated_model.compile()
+    assert truncated_model._sampling_plans is not model._sampling_plans
+    assert np.all(truncated_model._get_sample(5)[x].data > 0)
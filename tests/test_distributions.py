@@ -0,0 +1,98 @@
+import numpy as np
+import scipy.stats
+import pytest
+import chainer
+import chainer.functions as F
+
+from context import brancher
+from brancher import distributions
+from brancher.distributions import ShuffledEpochsDistribution
+from brancher.standard_variables import BinomialVariable
+
+
+def test_shuffled_epochs_batches_have_no_duplicates():
+    dataset_size, batch_size = 10, 4
+    distribution = ShuffledEpochsDistribution(batch_size, seed=0)
+    indices = []
+    for _ in range(50):
+        batch = distribution.get_sample(range(dataset_size), [], 1)
+        assert len(set(batch)) == batch_size
+        indices.extend(batch)
+    for epoch in range(len(indices)//dataset_size):
+        assert sorted(indices[epoch*dataset_size:(epoch + 1)*dataset_size]) == list(range(dataset_size))
+
+
+def _to_parameter(value, shape=(1, 1, 1, 1)):
+    return chainer.Variable(np.full(shape, value, dtype="float32"))
+
+
+@pytest.mark.parametrize("mu, sigma, lower, upper", [(0., 2., 0., np.inf),
+                                                     (1., 0.5, -1., 1.2),
+                                                     (0., 1., 8., np.inf),
+                                                     (0., 1., -np.inf, -9.),
+                                                     (3., 1., -1., -0.5)])
+def test_truncated_normal_matches_scipy(mu, sigma, lower, upper):
+    np.random.seed(0)
+    distribution = distributions.TruncatedNormalDistribution()
+    reference = scipy.stats.truncnorm((lower - mu)/sigma, (upper - mu)/sigma, loc=mu, scale=sigma)
+    number_samples = 20000
+    sample = distribution.get_sample(mu=_to_parameter(mu, (number_samples, 1, 1, 1)), sigma=_to_parameter(sigma),
+                                     lower=_to_parameter(lower), upper=_to_parameter(upper),
+                                     number_samples=number_samples).data
+    assert np.all((sample >= lower) & (sample <= upper))
+    assert np.abs(np.mean(sample) - reference.mean()) < 0.05*sigma
+    assert np.abs(np.std(sample) - reference.std()) < 0.05*sigma
+
+    values = np.reshape(reference.ppf([0.1, 0.5, 0.9]), (3, 1, 1, 1)).astype("float32")
+    log_probability = distribution.calculate_log_probability(values, mu=_to_parameter(mu), sigma=_to_parameter(sigma),
+                                                             lower=_to_parameter(lower),
+                                                             upper=_to_parameter(upper)).data
+    assert np.allclose(np.ravel(log_probability), reference.logpdf(np.ravel(values)), atol=1e-3)
+
+
+def test_truncated_normal_reparameterization_gradient():
+    np.random.seed(0)
+    distribution = distributions.TruncatedNormalDistribution()
+    mu, sigma = _to_parameter(0.), _to_parameter(1.)
+    number_samples = 200000
+    sample = distribution.get_sample(mu=F.broadcast_to(mu, (number_samples, 1, 1, 1)), sigma=sigma,
+                                     lower=_to_parameter(0.5), upper=_to_parameter(np.inf), number_samples=1)
+    F.mean(sample).backward()
+    epsilon = 1e-3
+    mu_derivative = (scipy.stats.truncnorm(0.5 - epsilon, np.inf, loc=epsilon).mean()
+                     - scipy.stats.truncnorm(0.5 + epsilon, np.inf, loc=-epsilon).mean())/(2*epsilon)
+    sigma_derivative = (scipy.stats.truncnorm(0.5/(1 + epsilon), np.inf, scale=1 + epsilon).mean()
+                        - scipy.stats.truncnorm(0.5/(1 - epsilon), np.inf, scale=1 - epsilon).mean())/(2*epsilon)
+    assert np.abs(mu.grad.item() - mu_derivative) < 0.01
+    assert np.abs(sigma.grad.item() - sigma_derivative) < 0.01
+
+
+def test_softmax_categorical_scores_labels_and_one_hot_samples():
+    distribution = distributions.SoftmaxCategoricalDistribution()
+    z = chainer.Variable(np.reshape(np.log(np.array([0.2, 0.1, 0.7], dtype="float32")), (1, 1, 3, 1)))
+    expected_log_probability = np.log([[0.7], [0.2]])
+    labels = chainer.Variable(np.reshape(np.array([2, 0], dtype="int32"), (2, 1, 1, 1)))
+    assert np.allclose(distribution.calculate_log_probability(labels, z).data, expected_log_probability)
+    for dtype in ("float32", "int32"):
+        one_hot = chainer.Variable(np.reshape(np.eye(3, dtype=dtype)[[2, 0]], (2, 1, 3, 1)))
+        assert np.allclose(distribution.calculate_log_probability(one_hot, z).data, expected_log_probability)
+
+
+def test_large_n_binomial_matches_scipy():
+    number_trials, probability = 5000, 0.3
+    data = np.random.RandomState(0).binomial(number_trials, probability, size=(20, 1, 1)).astype("int32")
+    expected_log_probability = np.sum(scipy.stats.binom.logpmf(np.ravel(data), number_trials, probability))
+    x = BinomialVariable(number_trials, p=probability, name="x")
+    x.observe(data)
+    assert np.allclose(x.calculate_log_probability({}).data, expected_log_probability, rtol=1e-4)
+    log_coefficient = x.distribution.log_coefficient_cache[2]
+    x.calculate_log_probability({})
+    assert x.distribution.log_coefficient_cache[2] is log_coefficient
+    x.observe(data[:10])
+    assert np.allclose(x.calculate_log_probability({}).data,
+                       np.sum(scipy.stats.binom.logpmf(np.ravel(data[:10]), number_trials, probability)), rtol=1e-4)
+
+    logit = np.log(probability/(1 - probability))
+    y = BinomialVariable(number_trials, logit_p=logit, name="y")
+    y.observe(data)
+    assert np.allclose(y.calculate_log_probability({}).data, expected_log_probability, rtol=1e-4)
@@ -0,0 +1,138 @@
+import numpy as np
+import scipy.stats
+from scipy.special import logsumexp
+import chainer
+
+from context import brancher
+from brancher.variables import ProbabilisticModel, DeterministicVariable
+from brancher.standard_variables import NormalVariable, LogNormalVariable, CategoricalVariable, BinomialVariable
+from brancher import inference
+from brancher.transformations import truncate_model
+from brancher.conjugacy_tools import get_conjugate_posterior
+
+
+def test_truncated_posterior_has_no_analytic_kl():
+    mu = NormalVariable(0., 1., "mu")
+    x = NormalVariable(mu, 1., "x")
+    x.observe(np.array([[1.]], dtype="float32"))
+    model = ProbabilisticModel([x])
+    Qmu = NormalVariable(0.5, 1., "mu")
+    posterior_model = ProbabilisticModel([Qmu])
+    assert len(model._get_analytic_kl_pairs(posterior_model)) == 1
+
+    truncated_posterior = truncate_model(posterior_model, truncation_rule=lambda a: a > 0,
+                                         model_statistics=lambda sample: sample[Qmu].data)
+    assert model._get_analytic_kl_pairs(truncated_posterior) == []
+    samples = truncated_posterior._get_sample(10)
+    terms = truncated_posterior.calculate_log_probability_terms(samples, for_gradient=True)
+    assert truncated_posterior in terms
+    log_probability = truncated_posterior.calculate_log_probability(samples, for_gradient=True).data
+    assert np.allclose(log_probability, sum([term.data for term in terms.values()]))
+
+    np.random.seed(0)
+    analytic_elbo = model.estimate_log_model_evidence(10, posterior_model=truncated_posterior,
+                                                      for_gradient=True, analytic_kl=True).data
+    np.random.seed(0)
+    sampled_elbo = model.estimate_log_model_evidence(10, posterior_model=truncated_posterior,
+                                                     for_gradient=True, analytic_kl=False).data
+    assert np.allclose(analytic_elbo, sampled_elbo)
+
+
+def test_conjugate_posterior_of_a_normal_mean():
+    data = np.random.RandomState(0).normal(-2., 2., 50).astype("float32")
+    mu = NormalVariable(1., 10., "mu")
+    x = NormalVariable(mu, 2., "x")
+    x.observe(data)
+    model = ProbabilisticModel([x])
+    random_state = np.random.get_state()
+    posterior = get_conjugate_posterior(mu, model)
+    assert np.all(np.random.get_state()[1] == random_state[1])
+    parameters = posterior._get_deterministic_parameters()
+    precision = 1./10.**2 + len(data)/2.**2
+    assert np.allclose(parameters["mu"].data, (1./10.**2 + np.sum(data)/2.**2)/precision, rtol=1e-4)
+    assert np.allclose(parameters["sigma"].data, np.sqrt(1./precision), rtol=1e-4)
+
+    learnable_mu = NormalVariable(DeterministicVariable(1., "mu_mean", learnable=True), 10., "mu")
+    learnable_x = NormalVariable(learnable_mu, 2., "x")
+    learnable_x.observe(data)
+    assert get_conjugate_posterior(learnable_mu, ProbabilisticModel([learnable_x])) is None
+
+
+def _get_grid_posterior_moments(data, mu_grid, nu_grid):
+    mu_values, nu_values = np.meshgrid(mu_grid, nu_grid)
+    log_probability = -0.5*(mu_values/10.)**2 - 2*np.log(nu_values) - 0.5*np.log(nu_values)**2
+    log_probability += sum([-np.log(nu_values) - 0.5*((datapoint - mu_values)/nu_values)**2 for datapoint in data])
+    weights = np.exp(log_probability - np.max(log_probability))
+    weights /= np.sum(weights)
+    return [(np.sum(weights*values), np.sqrt(np.sum(weights*values**2) - np.sum(weights*values)**2))
+            for values in (mu_values, nu_values)]
+
+
+def test_hamiltonian_monte_carlo_posterior_moments():
+    np.random.seed(0)
+    nu = LogNormalVariable(0., 1., "nu")
+    mu = NormalVariable(0., 10., "mu")
+    x = NormalVariable(mu, nu, "x")
+    model = ProbabilisticModel([x])
+    data = np.random.RandomState(1).normal(-2., 1., 50).astype("float32")
+    x.observe(data)
+    inference.markov_chain_monte_carlo(model, number_iterations=150, number_chains=50,
+                                       inference_method=inference.HamiltonianMonteCarlo(number_adaptation_steps=100))
+    posterior_sample = model._get_posterior_sample(5000)
+    (mu_mean, mu_std), (nu_mean, nu_std) = _get_grid_posterior_moments(data, np.linspace(-3., -1., 400),
+                                                                       np.linspace(0.5, 2., 400))
+    assert np.abs(np.mean(posterior_sample[mu].data) - mu_mean) < 0.03
+    assert np.abs(np.std(posterior_sample[mu].data) - mu_std) < 0.02
+    assert np.abs(np.mean(posterior_sample[nu].data) - nu_mean) < 0.03
+    assert np.abs(np.std(posterior_sample[nu].data) - nu_std) < 0.02
+
+
+def test_stein_variational_gradient_descent_posterior_moments():
+    np.random.seed(0)
+    nu = LogNormalVariable(0., 1., "nu")
+    mu = NormalVariable(0., 10., "mu")
+    x = NormalVariable(mu, nu, "x")
+    model = ProbabilisticModel([x])
+    data = np.random.RandomState(1).normal(-2., 1., 50).astype("float32")
+    x.observe(data)
+    method = inference.SteinVariationalGradientDescent(optimizer=chainer.optimizers.Adam(0.2))
+    inference.particle_inference(model, number_iterations=1000, number_particles=100, inference_method=method)
+    posterior_sample = model._get_posterior_sample(5000)
+    (mu_mean, mu_std), (nu_mean, nu_std) = _get_grid_posterior_moments(data, np.linspace(-3., -1., 400),
+                                                                       np.linspace(0.5, 2., 400))
+    assert np.abs(np.mean(posterior_sample[mu].data) - mu_mean) < 0.03
+    assert np.abs(np.std(posterior_sample[mu].data) - mu_std) < 0.02
+    assert np.abs(np.mean(posterior_sample[nu].data) - nu_mean) < 0.03
+    assert np.abs(np.std(posterior_sample[nu].data) - nu_std) < 0.02
+
+
+def test_enumerated_elbo_matches_brute_force_summation():
+    data = np.random.RandomState(0).normal(1., 1., 3).astype("float32")
+    log_prior = np.log(np.exp([0., 1., 0.5])/np.sum(np.exp([0., 1., 0.5])))
+    z = CategoricalVariable(softmax_p=np.array([[0.], [1.], [0.5]], dtype="float32"), name="z", one_hot=False)
+    w = NormalVariable(0., 1., "w")
+    x = NormalVariable((z - 1.)*2. + 0.*w, 3., "x")
+    model = ProbabilisticModel([x, z, w])
+    x.observe(data)
+    model.set_posterior_model(ProbabilisticModel([NormalVariable(0., 1., "w")]))
+    log_evidence = logsumexp(log_prior + np.array([np.sum(scipy.stats.norm.logpdf(data, mean, 3.))
+                                                   for mean in (-2., 0., 2.)]))
+    assert np.allclose(model.estimate_log_model_evidence(20, enumerate_discrete=True).data, log_evidence, atol=1e-4)
+
+    np.random.seed(0)
+    z = BinomialVariable(5, p=0.3, name="z")
+    w = NormalVariable(0., 1., "w")
+    x = NormalVariable(z + w, 1., "x")
+    model = ProbabilisticModel([x, z, w])
+    x.observe(data)
+    model.set_posterior_model(ProbabilisticModel([NormalVariable(0.5, 0.7, "w")]))
+    nodes, weights = np.polynomial.hermite_e.hermegauss(60)
+    w_values, weights = 0.5 + 0.7*nodes, weights/np.sum(weights)
+    z_values = np.arange(6)
+    log_likelihood = logsumexp(scipy.stats.binom.logpmf(z_values, 5, 0.3)[:, None]
+                               + np.sum(scipy.stats.norm.logpdf(data[:, None, None],
+                                                                z_values[None, :, None] + w_values[None, None, :], 1.),
+                                        axis=0), axis=0)
+    elbo = np.sum(weights*(log_likelihood + scipy.stats.norm.logpdf(w_values)
+                           - scipy.stats.norm.logpdf(w_values, 0.5, 0.7)))
+    assert np.abs(model.estimate_log_model_evidence(5000, enumerate_discrete=True).data - elbo) < 0.01
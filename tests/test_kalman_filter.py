@@ -0,0 +1,97 @@
+import numpy as np
+import scipy.linalg
+import scipy.stats
+from chainer import gradient_check
+
+from context import brancher
+from brancher.variables import ProbabilisticModel
+from brancher.standard_variables import NormalVariable
+from brancher.inference import KalmanSmoother
+from brancher.kalman_filter_tools import LinearGaussianChain, KalmanFilterLogLikelihood
+from brancher.kalman_filter_tools import extract_linear_gaussian_chain, kalman_smoother
+
+
+def _get_random_chain(number_samples=3, length=7, seed=0):
+    random_state = np.random.RandomState(seed)
+    shape = (number_samples, length)
+    observed_mask = np.array([True, False, True, True, False, True, True])
+    a, c, q = [random_state.uniform(0.5, 1.2, shape), random_state.normal(0., 1., shape),
+               random_state.uniform(0.2, 1., shape)]
+    h, d, r = [random_state.uniform(0.5, 2., shape), random_state.normal(0., 1., shape),
+               random_state.uniform(0.1, 0.5, shape)]
+    h, d, r = np.where(observed_mask, h, 0.), np.where(observed_mask, d, 0.), np.where(observed_mask, r, 1.)
+    y = random_state.normal(0., 1., (1, length))
+    return LinearGaussianChain(None, a, c, q, h, d, r, y, observed_mask)
+
+
+def _get_dense_posterior(chain, sample):
+    length = chain.length
+    transition = np.eye(length) - np.diag(chain.a[sample, 1:], k=-1)
+    inverse_transition = scipy.linalg.inv(transition)
+    prior_mean = inverse_transition.dot(chain.c[sample])
+    prior_covariance = inverse_transition.dot(np.diag(chain.q[sample])).dot(inverse_transition.T)
+    steps = np.where(chain.observed_mask)[0]
+    observation_matrix = np.zeros((len(steps), length))
+    observation_matrix[np.arange(len(steps)), steps] = chain.h[sample, steps]
+    data_mean = observation_matrix.dot(prior_mean) + chain.d[sample, steps]
+    data_covariance = (observation_matrix.dot(prior_covariance).dot(observation_matrix.T)
+                       + np.diag(chain.r[sample, steps]))
+    gain = prior_covariance.dot(observation_matrix.T).dot(scipy.linalg.inv(data_covariance))
+    mean = prior_mean + gain.dot(chain.y[0, steps] - data_mean)
+    covariance = prior_covariance - gain.dot(observation_matrix).dot(prior_covariance)
+    log_likelihood = scipy.stats.multivariate_normal(data_mean, data_covariance).logpdf(chain.y[0, steps])
+    return mean, covariance, log_likelihood
+
+
+def _get_forward_moments(b, drift, sigma):
+    inverse_transition = scipy.linalg.inv(np.eye(len(b)) - np.diag(b[1:], k=-1))
+    return inverse_transition.dot(drift), inverse_transition.dot(np.diag(sigma**2)).dot(inverse_transition.T)
+
+
+def test_kalman_smoother_matches_dense_posterior():
+    chain = _get_random_chain()
+    b, drift, sigma, log_likelihood = kalman_smoother(chain)
+    for sample in range(chain.a.shape[0]):
+        mean, covariance, dense_log_likelihood = _get_dense_posterior(chain, sample)
+        smoothed_mean, smoothed_covariance = _get_forward_moments(b[sample], drift[sample], sigma[sample])
+        assert np.allclose(smoothed_mean, mean)
+        assert np.allclose(smoothed_covariance, covariance)
+        assert np.allclose(log_likelihood[sample], dense_log_likelihood)
+
+
+def test_kalman_filter_log_likelihood_gradient():
+    chain = _get_random_chain()
+    inputs = (chain.a, chain.c, chain.q, chain.h, chain.d, chain.r)
+    output_gradient = np.random.RandomState(1).normal(size=(chain.a.shape[0],))
+    gradient_check.check_backward(KalmanFilterLogLikelihood(chain.y, chain.observed_mask), inputs, output_gradient,
+                                  eps=1e-6, atol=1e-5, rtol=1e-4, dtype=np.float64)
+
+
+def test_kalman_smoother_posterior_of_a_chain_model():
+    length, transition, measure_noise = 10, 0.8, 0.5
+    x = [NormalVariable(0., 1., "x0")]
+    y = [NormalVariable(x[0], measure_noise, "y0")]
+    for t in range(1, length):
+        x.append(NormalVariable(transition*x[t - 1], 1., "x{}".format(t)))
+        y.append(NormalVariable(x[t], measure_noise, "y{}".format(t)))
+    model = ProbabilisticModel(x + y)
+    data = np.random.RandomState(0).normal(0., 2., length).astype("float32")
+    for variable, value in zip(y, data):
+        variable.observe(np.array([[value]], dtype="float32"))
+
+    ones = np.ones((1, length))
+    dense_chain = LinearGaussianChain(None, transition*ones, 0.*ones, ones, ones, 0.*ones, measure_noise**2*ones,
+                                      data[None, :].astype("float64"), np.ones((length,), dtype=bool))
+    mean, covariance, log_likelihood = _get_dense_posterior(dense_chain, 0)
+    chain = extract_linear_gaussian_chain(model).get_data()
+    b, drift, sigma, _ = kalman_smoother(chain)
+    smoothed_mean, smoothed_covariance = _get_forward_moments(b[0], drift[0], sigma[0])
+    assert np.allclose(smoothed_mean, mean, atol=1e-4)
+    assert np.allclose(smoothed_covariance, covariance, atol=1e-4)
+
+    np.random.seed(0)
+    posterior_model = KalmanSmoother().compute_posterior(model)
+    assert np.allclose(model.diagnostics["log marginal likelihood"], log_likelihood, rtol=1e-4)
+    posterior_sample = posterior_model._get_sample(20000)
+    sample_mean = np.array([np.mean(posterior_sample[posterior_model.get_variable(var.name)].data) for var in x])
+    assert np.allclose(sample_mean, mean, atol=0.05)
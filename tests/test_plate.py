@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from context import brancher
+from brancher.variables import ProbabilisticModel, Plate
+from brancher.standard_variables import NormalVariable
+
+
+@pytest.mark.parametrize("data_shape, observed_shape", [((5,), (1, 1, 5, 1, 1)),
+                                                        ((3, 5), (1, 3, 5, 1, 1)),
+                                                        ((1, 5, 1, 1), (1, 1, 5, 1, 1))])
+def test_observations_are_mapped_onto_the_plate_axis(data_shape, observed_shape):
+    plate = Plate("groups", 5)
+    mu = NormalVariable(0., 1., "mu", plate=plate)
+    y = NormalVariable(mu, 1., "y", plate=plate)
+    data = np.arange(np.prod(data_shape)).reshape(data_shape).astype("float32")
+    y.observe(data)
+    value = y.value.data
+    assert value.shape == observed_shape
+    assert np.allclose(value.reshape(-1, 5), data.reshape(-1, 5))
+    sample = ProbabilisticModel([y])._get_sample(2)
+    assert sample[mu].shape == (2, 1, 5, 1, 1)
+
+
+def test_observations_with_a_wrong_size_are_refused():
+    plate = Plate("groups", 5)
+    y = NormalVariable(0., 1., "y", plate=plate)
+    with pytest.raises(ValueError):
+        y.observe(np.zeros((4,), dtype="float32"))